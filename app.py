@@ -8,6 +8,7 @@ import traceback
 import tempfile
 import mysql.connector
 import sqlalchemy
+from db_utils import get_engine
 
 # Page configuration
 st.set_page_config(
@@ -177,7 +178,8 @@ def get_sql_connection(db_type, host, port, database, username, password):
             st.error(f"Unsupported database type: {db_type}")
             return None
             
-        engine = sqlalchemy.create_engine(connection_string)
+        # Reuse the process-wide engine so connections come from its pool
+        engine = get_engine(connection_string)
         conn = engine.connect()
         print(f"{db_type.upper()} connection successful to {host}:{port}/{database}")
         return conn
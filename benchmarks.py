@@ -0,0 +1,267 @@
+import argparse
+import os
+import random
+import resource
+import sqlite3
+import statistics
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from db_utils import GovernedQuery, SQLitePool, pa, result_column_types
+from llm_sql import (
+    SimilarQuestionIndex, estimate_tokens, format_schema_for_prompt, invalidate_schema_cache,
+    render_schema_bullets, render_schema_ddl
+)
+
+# Building blocks for synthetic questions
+BENCH_ENTITIES = ["customers", "orders", "products", "suppliers", "order items", "invoices", "employees",
+                  "shipments", "payments", "reviews", "categories", "stores", "regions", "returns"]
+BENCH_MEASURES = ["total amount", "average price", "number of orders", "stock quantity", "loyalty points",
+                  "revenue", "discount", "shipping cost", "rating", "quantity sold"]
+BENCH_FILTERS = ["in Texas", "in 2023", "last month", "with status shipped", "over 500 dollars",
+                 "in the electronics category", "from new suppliers", "with no orders", "this year"]
+BENCH_TEMPLATES = [
+    "show me all {entity} {filter}",
+    "what is the {measure} of {entity} {filter}",
+    "list the top {n} {entity} by {measure}",
+    "how many {entity} are there {filter}",
+    "{measure} by {entity} {filter}",
+]
+
+def make_question(rng):
+    """Build one random question from the templates."""
+    # The reference token keeps 100k questions distinct, which is the worst case for lookups
+    return rng.choice(BENCH_TEMPLATES).format(
+        entity=rng.choice(BENCH_ENTITIES),
+        measure=rng.choice(BENCH_MEASURES),
+        filter=rng.choice(BENCH_FILTERS),
+        n=rng.randint(1, 50)
+    ) + f" {rng.choice(['please', 'now', ''])} ref{rng.randint(0, 10 ** 6)}"
+
+def bench_similar_index(args):
+    """Time similarity lookups against an index of synthetic questions."""
+    rng = random.Random(7)
+    index = SimilarQuestionIndex()
+
+    start = time.perf_counter()
+    for _ in range(args.questions):
+        index.add(make_question(rng), "SELECT 1")
+    build_time = time.perf_counter() - start
+
+    timings = []
+    matches = 0
+    for _ in range(args.lookups):
+        start = time.perf_counter()
+        if index.find(make_question(rng), 0.8) is not None:
+            matches += 1
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    print(f"Indexed {len(index)} distinct questions in {build_time:.1f}s")
+    print(f"Lookups: {args.lookups}, matches: {matches}")
+    print(f"Latency ms: mean {statistics.mean(timings):.3f}, p50 {timings[len(timings) // 2]:.3f}, "
+          f"p99 {timings[int(len(timings) * 0.99)]:.3f}, max {timings[-1]:.3f}")
+
+def make_schema(table_count, rng):
+    """Build a synthetic schema dict shaped like the ones the app extracts."""
+    types = ["INTEGER", "TEXT", "REAL", "DATE", "VARCHAR(255)", "DECIMAL(10,2)"]
+    schema_info = {}
+    for t in range(table_count):
+        columns = [{"name": f"table_{t}_id", "type": "INTEGER", "notnull": 1, "default_value": None, "is_primary_key": 1}]
+        for c in range(rng.randint(5, 20)):
+            columns.append({
+                "name": f"{rng.choice(['customer', 'order', 'product', 'amount', 'status', 'created'])}_{c}",
+                "type": rng.choice(types),
+                "notnull": rng.random() < 0.3,
+                "default_value": None,
+                "is_primary_key": 0
+            })
+        if t > 0:
+            parent = rng.randrange(t)
+            columns.append({
+                "name": f"table_{parent}_id", "type": "INTEGER", "notnull": 0, "default_value": None,
+                "is_primary_key": 0, "foreign_key": {"table": f"table_{parent}", "column": f"table_{parent}_id"}
+            })
+        schema_info[f"table_{t}"] = columns
+    return schema_info
+
+def time_call(func, *args, repeat=5):
+    """Best-of-N wall time of a call in milliseconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+def bench_schema_prompt(args):
+    """Compare token counts and rendering time of the bullet and DDL schema renderings."""
+    rng = random.Random(11)
+    print(f"{'tables':>7} {'bullet tok':>11} {'ddl tok':>9} {'saved':>6} {'bullet ms':>10} {'ddl ms':>8} {'memo us':>8}")
+    for table_count in args.sizes:
+        schema_info = make_schema(table_count, rng)
+        bullet_tokens = estimate_tokens(render_schema_bullets(schema_info))
+        ddl_tokens = estimate_tokens(render_schema_ddl(schema_info))
+
+        invalidate_schema_cache()
+        format_schema_for_prompt(schema_info, style="bullet")
+        memo_us = time_call(format_schema_for_prompt, schema_info, "bullet") * 1000
+
+        print(f"{table_count:>7} {bullet_tokens:>11} {ddl_tokens:>9} {1 - ddl_tokens / bullet_tokens:>6.0%} "
+              f"{time_call(render_schema_bullets, schema_info):>10.2f} {time_call(render_schema_ddl, schema_info):>8.2f} "
+              f"{memo_us:>8.1f}")
+
+def make_sqlite_database(path, rows, rng):
+    """Write an orders table of the given size with an index on customer_id."""
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE orders (order_id INTEGER PRIMARY KEY, customer_id INTEGER, status TEXT, total_amount REAL)")
+    conn.executemany(
+        "INSERT INTO orders (customer_id, status, total_amount) VALUES (?, ?, ?)",
+        ((rng.randint(1, 5000), rng.choice(["pending", "shipped", "delivered"]), rng.random() * 500) for _ in range(rows))
+    )
+    conn.execute("CREATE INDEX idx_orders_customer_id ON orders (customer_id)")
+    conn.commit()
+    conn.close()
+
+def bench_sqlite_connections(args):
+    """Compare warm-query latency on pooled read-only connections with a new connection per query."""
+    rng = random.Random(5)
+    queries = {
+        "lookup": ("SELECT * FROM orders WHERE customer_id = ?", lambda: (rng.randint(1, 5000),)),
+        "aggregate": ("SELECT status, COUNT(*), SUM(total_amount) FROM orders GROUP BY status", lambda: ()),
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "bench.db")
+        make_sqlite_database(db_path, args.rows, rng)
+        pools = {"pooled": SQLitePool(db_path), "pooled immutable": SQLitePool(db_path, immutable=True)}
+
+        def per_call(sql, params):
+            # What the app did before: connect, query and throw the connection away
+            conn = sqlite3.connect(db_path, check_same_thread=False)
+            conn.execute(sql, params).fetchall()
+            conn.close()
+
+        def pooled(pool):
+            def run(sql, params):
+                with pool.connection() as conn:
+                    conn.execute(sql, params).fetchall()
+            return run
+
+        modes = {"connect per call": per_call, **{name: pooled(pool) for name, pool in pools.items()}}
+        print(f"{args.rows} rows, {args.queries} queries per mode")
+        print(f"{'query':>10} {'mode':>17} {'mean ms':>8} {'p50 ms':>7} {'p99 ms':>7}")
+        for query_name, (sql, make_params) in queries.items():
+            for mode_name, run in modes.items():
+                # Warm up once so the pooled modes start from an open connection, as they would in the app
+                run(sql, make_params())
+                timings = []
+                for _ in range(args.queries):
+                    params = make_params()
+                    start = time.perf_counter()
+                    run(sql, params)
+                    timings.append((time.perf_counter() - start) * 1000)
+                timings.sort()
+                print(f"{query_name:>10} {mode_name:>17} {statistics.mean(timings):>8.3f} "
+                      f"{timings[len(timings) // 2]:>7.3f} {timings[int(len(timings) * 0.99)]:>7.3f}")
+        for pool in pools.values():
+            pool.close()
+
+def make_results_database(path, rows, rng):
+    """Write a wide orders table with dates and free text, the kind of result that is slow to render."""
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE orders (order_id INTEGER PRIMARY KEY, customer_id INTEGER, status TEXT, total_amount REAL, "
+        "quantity INTEGER, order_date DATE, notes TEXT)"
+    )
+    conn.executemany(
+        "INSERT INTO orders (customer_id, status, total_amount, quantity, order_date, notes) VALUES (?, ?, ?, ?, ?, ?)",
+        ((rng.randint(1, 50000), rng.choice(["pending", "shipped", "delivered"]), round(rng.random() * 500, 2),
+          rng.randint(1, 20), f"2023-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+          None if rng.random() < 0.2 else f"note {rng.randint(0, 10 ** 6)}") for _ in range(rows))
+    )
+    conn.commit()
+    conn.close()
+
+def run_result_path(db_path, arrow):
+    """Fetch and render a whole table in this process; returns timings and peak RSS."""
+    schema_info = {"orders": [
+        {"name": name, "type": declared} for name, declared in [
+            ("order_id", "INTEGER"), ("customer_id", "INTEGER"), ("status", "TEXT"), ("total_amount", "REAL"),
+            ("quantity", "INTEGER"), ("order_date", "DATE"), ("notes", "TEXT")
+        ]
+    ]}
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    start = time.perf_counter()
+    outcome = GovernedQuery(
+        "SELECT * FROM orders", "sqlite", conn, timeout=0, max_rows=0, max_bytes=0,
+        column_types=result_column_types("SELECT * FROM orders", schema_info), arrow=arrow
+    ).start().result()
+    df = outcome["data"]
+    fetch_time = time.perf_counter() - start
+
+    # What st.dataframe does with a frame: convert it to an Arrow table and send it as an IPC stream
+    start = time.perf_counter()
+    table = pa.Table.from_pandas(df)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    payload_bytes = sink.getvalue().size
+    render_time = time.perf_counter() - start
+    conn.close()
+    return {
+        "rows": len(df),
+        "fetch": fetch_time,
+        "render": render_time,
+        "result_mb": outcome["bytes"] / 1024 ** 2,
+        "payload_mb": payload_bytes / 1024 ** 2,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def bench_arrow_results(args):
+    """Compare peak memory and end-to-end fetch-and-render time of object and Arrow-backed result frames."""
+    if pa is None:
+        print("pyarrow is not installed")
+        return
+    rng = random.Random(3)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "results.db")
+        make_results_database(db_path, args.rows, rng)
+        print(f"{args.rows} rows, 7 columns")
+        print(f"{'path':>8} {'fetch s':>8} {'render s':>9} {'total s':>8} {'frame MB':>9} {'payload MB':>11} {'peak RSS MB':>12}")
+        for name, arrow in (("object", False), ("arrow", True)):
+            # A fresh process per path, so each peak RSS is its own
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                result = executor.submit(run_result_path, db_path, arrow).result()
+            print(f"{name:>8} {result['fetch']:>8.2f} {result['render']:>9.2f} {result['fetch'] + result['render']:>8.2f} "
+                  f"{result['result_mb']:>9.1f} {result['payload_mb']:>11.1f} {result['peak_rss_mb']:>12.0f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Performance benchmarks for the Text-to-SQL app")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    similar_parser = subparsers.add_parser("similar-index", help="Near-duplicate question lookup latency")
+    similar_parser.add_argument("--questions", type=int, default=100000)
+    similar_parser.add_argument("--lookups", type=int, default=2000)
+    similar_parser.set_defaults(func=bench_similar_index)
+
+    schema_parser = subparsers.add_parser("schema-prompt", help="Schema rendering token counts and time")
+    schema_parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500, 1000, 5000])
+    schema_parser.set_defaults(func=bench_schema_prompt)
+
+    sqlite_parser = subparsers.add_parser("sqlite-connections", help="Warm-query latency, pooled vs connect per call")
+    sqlite_parser.add_argument("--rows", type=int, default=200000)
+    sqlite_parser.add_argument("--queries", type=int, default=500)
+    sqlite_parser.set_defaults(func=bench_sqlite_connections)
+
+    arrow_parser = subparsers.add_parser("arrow-results", help="Peak RSS and fetch-and-render time, object vs Arrow frames")
+    arrow_parser.add_argument("--rows", type=int, default=1000000)
+    arrow_parser.set_defaults(func=bench_arrow_results)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1575 @@
+import os
+import re
+import json
+import math
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import quote
+import pandas as pd
+from sqlalchemy import create_engine, event, inspect, text
+
+try:
+    import sqlglot
+    from sqlglot import exp
+    from sqlglot.errors import SqlglotError
+except ImportError:
+    sqlglot = None
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# sqlglot dialect names for the database types the app connects to
+SQLGLOT_DIALECTS = {"sqlite": "sqlite", "mysql": "mysql", "postgresql": "postgres"}
+
+# Read-only SQLite connections kept open per database file, with their tuning pragmas
+SQLITE_POOL_SIZE = int(os.environ.get("SQLITE_POOL_SIZE", "8"))
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+# Page cache per connection; negative values are KiB, positive values pages
+SQLITE_CACHE_SIZE = int(os.environ.get("SQLITE_CACHE_SIZE", "-65536"))
+# "memory" keeps temp tables and indexes off disk, but measured ~3x slower on large GROUP BY sorts than SQLite's default
+SQLITE_TEMP_STORE = os.environ.get("SQLITE_TEMP_STORE", "default")
+SQLITE_CACHED_STATEMENTS = int(os.environ.get("SQLITE_CACHED_STATEMENTS", "256"))
+
+# Connection pool of each shared MySQL/PostgreSQL engine
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+# Seconds before a pooled connection is replaced, so server-side idle timeouts never hit a pooled one
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", "1800"))
+# Test each connection with a lightweight ping on checkout and reconnect if it has gone stale
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+# Query governor defaults for the deployment; each can be overridden per query (0 disables a limit)
+QUERY_TIMEOUT = float(os.environ.get("QUERY_TIMEOUT", "30"))
+QUERY_MAX_ROWS = int(os.environ.get("QUERY_MAX_ROWS", "100000"))
+QUERY_MAX_RESULT_MB = float(os.environ.get("QUERY_MAX_RESULT_MB", "200"))
+
+# Rows fetched per round trip (the chunk size); each batch can be shown while the next one is read
+QUERY_FETCH_BATCH_ROWS = int(os.environ.get("QUERY_FETCH_BATCH_ROWS", "1000"))
+
+# Build result frames on pyarrow-backed dtypes, typed from the schema, when pyarrow is installed
+RESULT_ARROW_BACKEND = os.environ.get("RESULT_ARROW_BACKEND", "true").lower() in ("1", "true", "yes") and pa is not None
+
+# SQLite virtual machine instructions between deadline and cancellation checks
+SQLITE_PROGRESS_INTERVAL = 1000
+
+# Background threads that fetch the next page of a result paged in the database
+PAGE_PREFETCH_WORKERS = int(os.environ.get("PAGE_PREFETCH_WORKERS", "4"))
+
+# Estimated plan cost above which a query needs confirmation before it runs (0 disables the check).
+# SQLite has no cost model, so its plans are costed in estimated rows examined; PostgreSQL and MySQL
+# thresholds are in the planner's own cost units.
+QUERY_COST_THRESHOLDS = {
+    "sqlite": float(os.environ.get("QUERY_COST_THRESHOLD_SQLITE", "1000000")),
+    "postgresql": float(os.environ.get("QUERY_COST_THRESHOLD_POSTGRESQL", "100000")),
+    "mysql": float(os.environ.get("QUERY_COST_THRESHOLD_MYSQL", "100000")),
+}
+
+# Query results shared by every session, bounded by their total in-memory size
+RESULT_CACHE_MAX_MB = float(os.environ.get("RESULT_CACHE_MAX_MB", "512"))
+# "lru" evicts the least recently used result, "lfu" the least often reused one (ties go to the least recent)
+RESULT_CACHE_POLICY = os.environ.get("RESULT_CACHE_POLICY", "lru").lower()
+# Seconds a result stays fresh. SQLite keys include the file's modification time, so a changed file is never
+# served from the cache; server databases can change underneath a result, so their results expire sooner.
+RESULT_CACHE_TTLS = {
+    "sqlite": float(os.environ.get("RESULT_CACHE_TTL_SQLITE", "1800")),
+    "postgresql": float(os.environ.get("RESULT_CACHE_TTL_POSTGRESQL", "300")),
+    "mysql": float(os.environ.get("RESULT_CACHE_TTL_MYSQL", "300")),
+}
+
+# Rows SQLite's planner assumes an index equality lookup returns when the table has not been ANALYZEd
+SQLITE_DEFAULT_ROWS_PER_LOOKUP = 10
+
+class PooledSQLiteConnection(sqlite3.Connection):
+    """SQLite connection whose close() hands it back to its pool instead of closing it."""
+
+    pool = None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            super().close()
+
+class SQLitePool:
+    """
+    Thread-safe pool of tuned, read-only connections to one SQLite file.
+
+    Connections are opened with mode=ro, plus immutable=1 for snapshots nothing else writes to, which
+    also skips SQLite's file locking. Reusing them keeps their page cache, memory map and prepared
+    statements warm between queries.
+    """
+
+    def __init__(self, db_path, immutable=False, size=SQLITE_POOL_SIZE):
+        self.db_path = os.path.abspath(db_path)
+        self.immutable = immutable
+        self.size = size
+        self.checkouts = 0
+        self.connects = 0
+        self._idle = []
+        self._in_use = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def _open(self):
+        uri = f"file:{quote(self.db_path)}?mode=ro" + ("&immutable=1" if self.immutable else "")
+        conn = sqlite3.connect(
+            uri, uri=True, check_same_thread=False, factory=PooledSQLiteConnection,
+            cached_statements=SQLITE_CACHED_STATEMENTS
+        )
+        if SQLITE_MMAP_SIZE:
+            conn.execute(f"PRAGMA mmap_size = {int(SQLITE_MMAP_SIZE)}")
+        conn.execute(f"PRAGMA cache_size = {int(SQLITE_CACHE_SIZE)}")
+        if SQLITE_TEMP_STORE.lower() in ("default", "file", "memory"):
+            conn.execute(f"PRAGMA temp_store = {SQLITE_TEMP_STORE.upper()}")
+        conn.pool = self
+        return conn
+
+    def acquire(self):
+        """Check out an idle connection, opening a new one if none is free."""
+        with self._lock:
+            self.checkouts += 1
+            self._in_use += 1
+            if self._idle:
+                return self._idle.pop()
+            self.connects += 1
+        try:
+            return self._open()
+        except Exception:
+            with self._lock:
+                self._in_use -= 1
+            raise
+
+    def release(self, conn):
+        """Return a connection; it is closed instead if the pool is full or closed."""
+        if conn.in_transaction:
+            conn.rollback()
+        conn.set_progress_handler(None, 0)
+        with self._lock:
+            self._in_use -= 1
+            if not self._closed and len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        sqlite3.Connection.close(conn)
+
+    @contextmanager
+    def connection(self):
+        """Context manager that checks a connection out for the duration of the block."""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def close(self):
+        """Close idle connections; connections still checked out are closed when they come back."""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            sqlite3.Connection.close(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "db_path": self.db_path,
+                "immutable": self.immutable,
+                "checkouts": self.checkouts,
+                "connects": self.connects,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                # Share of checkouts served by an already open connection
+                "reuse_ratio": (self.checkouts - self.connects) / self.checkouts if self.checkouts else 0.0,
+            }
+
+# SQLite pools shared by every session, keyed by absolute database path
+_sqlite_pools = {}
+_sqlite_pools_lock = threading.Lock()
+
+def get_sqlite_pool(db_path, immutable=False):
+    """
+    Return the process-wide read-only connection pool for an SQLite file, creating it on first use.
+
+    Args:
+        db_path (str): Path of the SQLite database file
+        immutable (bool): Open it as an immutable snapshot, for uploaded copies nothing else writes to.
+            Only used when the pool is created.
+
+    Returns:
+        SQLitePool: The pool for this file
+    """
+    key = os.path.abspath(db_path)
+    with _sqlite_pools_lock:
+        pool = _sqlite_pools.get(key)
+        if pool is None:
+            pool = SQLitePool(key, immutable=immutable)
+            _sqlite_pools[key] = pool
+        return pool
+
+def close_sqlite_pool(db_path):
+    """Close and forget the pool of an SQLite file, e.g. when an uploaded snapshot is disconnected."""
+    with _sqlite_pools_lock:
+        pool = _sqlite_pools.pop(os.path.abspath(db_path), None)
+    if pool is not None:
+        pool.close()
+
+def get_sqlite_pool_stats():
+    """
+    Report checkouts, connections opened and reuse of every SQLite pool.
+
+    Returns:
+        list: One stats dict per database file
+    """
+    with _sqlite_pools_lock:
+        pools = list(_sqlite_pools.values())
+    return [pool.stats() for pool in pools]
+
+def open_sqlite_readonly(db_path):
+    """Check a read-only connection out of the file's pool, so validation can never change it; close() returns it."""
+    return get_sqlite_pool(db_path).acquire()
+
+def validate_sql(sql_query, db_type, db_path=None):
+    """
+    Check that a query compiles without running it.
+
+    SQLite compiles the statement with EXPLAIN against the real database, which also catches unknown
+    tables and columns. MySQL and PostgreSQL queries are only parsed with sqlglot, when it is installed.
+
+    Args:
+        sql_query (str): The SQL query to check
+        db_type (str): "sqlite", "mysql" or "postgresql"
+        db_path (str, optional): Path of the SQLite database file
+
+    Returns:
+        str or None: The error message if the query is invalid, otherwise None
+    """
+    if not sql_query or not sql_query.strip():
+        return "The query is empty."
+
+    if db_type == "sqlite":
+        if not db_path or not os.path.exists(db_path):
+            return None
+        conn = open_sqlite_readonly(db_path)
+        try:
+            # EXPLAIN prepares the statement and lists its bytecode without executing it
+            conn.execute(f"EXPLAIN {sql_query.strip().rstrip(';')}")
+            return None
+        except (sqlite3.Warning, sqlite3.Error) as e:
+            return str(e)
+        finally:
+            conn.close()
+
+    if sqlglot is None or db_type not in SQLGLOT_DIALECTS:
+        return None
+    try:
+        statements = [statement for statement in sqlglot.parse(sql_query, read=SQLGLOT_DIALECTS[db_type]) if statement is not None]
+    except SqlglotError as e:
+        return str(e)
+    if len(statements) != 1:
+        return f"Expected exactly one SQL statement, found {len(statements)}."
+    return None
+
+# Statements that change data or schema or lock rows, wherever they appear in a parsed query (e.g. a data-modifying CTE)
+_WRITE_EXPRESSIONS = tuple(
+    getattr(exp, name) for name in ("Insert", "Update", "Delete", "Merge", "Create", "Drop", "Alter", "Command", "Into", "Lock")
+    if hasattr(exp, name)
+) if sqlglot is not None else ()
+
+def is_read_only_select(sql_query, db_type):
+    """
+    Check that SQL is exactly one SELECT statement that cannot change anything.
+
+    Without sqlglot only the statement's leading keyword and the absence of further statements are checked.
+
+    Args:
+        sql_query (str): The SQL to check
+        db_type (str): "sqlite", "mysql" or "postgresql"
+
+    Returns:
+        bool: True for a single read-only SELECT
+    """
+    if not sql_query or not sql_query.strip():
+        return False
+    if sqlglot is None:
+        body = sql_query.strip().rstrip(';')
+        return re.match(r"\s*select\b", body, re.IGNORECASE) is not None and ";" not in body
+    try:
+        statements = [statement for statement in sqlglot.parse(sql_query, read=SQLGLOT_DIALECTS.get(db_type, "sqlite")) if statement is not None]
+    except SqlglotError:
+        return False
+    if len(statements) != 1 or not isinstance(statements[0], exp.Query):
+        return False
+    return statements[0].find(*_WRITE_EXPRESSIONS) is None
+
+# Engines shared by every session, keyed by a fingerprint of the connection URL
+_engine_registry = {}
+_engine_registry_lock = threading.Lock()
+
+def _track_pool_events(engine, stats):
+    """Count pool checkouts and new DBAPI connections of an engine."""
+    lock = threading.Lock()
+
+    def on_connect(dbapi_connection, connection_record):
+        with lock:
+            stats["connects"] += 1
+
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        with lock:
+            stats["checkouts"] += 1
+
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        with lock:
+            stats["invalidated"] += 1
+
+    event.listen(engine, "connect", on_connect)
+    event.listen(engine, "checkout", on_checkout)
+    event.listen(engine, "invalidate", on_invalidate)
+
+def get_engine(connection_string):
+    """
+    Return the process-wide SQLAlchemy engine for a connection URL, creating it on first use.
+
+    Every session connecting to the same database shares one engine, so connections come from its pool
+    instead of paying TCP and authentication setup on each query.
+
+    Args:
+        connection_string (str): SQLAlchemy database URL
+
+    Returns:
+        Engine: Engine with a QueuePool sized by DB_POOL_SIZE and DB_MAX_OVERFLOW
+    """
+    fingerprint = hashlib.sha256(connection_string.encode("utf-8")).hexdigest()
+    with _engine_registry_lock:
+        entry = _engine_registry.get(fingerprint)
+        if entry is None:
+            engine = create_engine(
+                connection_string,
+                pool_size=DB_POOL_SIZE,
+                max_overflow=DB_MAX_OVERFLOW,
+                pool_timeout=DB_POOL_TIMEOUT,
+                pool_recycle=DB_POOL_RECYCLE,
+                pool_pre_ping=DB_POOL_PRE_PING,
+            )
+            entry = {"engine": engine, "stats": {"connects": 0, "checkouts": 0, "invalidated": 0}}
+            _track_pool_events(engine, entry["stats"])
+            _engine_registry[fingerprint] = entry
+        return entry["engine"]
+
+def get_pool_stats(connection_string):
+    """
+    Report the state of the shared connection pool behind one connection URL.
+
+    Only the caller's own engine is reported, since the registry also holds other sessions' databases.
+
+    Args:
+        connection_string (str): SQLAlchemy database URL
+
+    Returns:
+        dict: The URL (password hidden), pool size, checked-out and overflow connections, checkouts, new
+        connections, invalidated connections and the reuse ratio, or None if no engine exists for the URL yet
+    """
+    fingerprint = hashlib.sha256(connection_string.encode("utf-8")).hexdigest()
+    with _engine_registry_lock:
+        entry = _engine_registry.get(fingerprint)
+    if entry is None:
+        return None
+    engine = entry["engine"]
+    pool = engine.pool
+    checkouts = entry["stats"]["checkouts"]
+    connects = entry["stats"]["connects"]
+    return {
+        "url": engine.url.render_as_string(hide_password=True),
+        "pool_size": pool.size() if hasattr(pool, "size") else None,
+        "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+        "overflow": max(pool.overflow(), 0) if hasattr(pool, "overflow") else None,
+        "checkouts": checkouts,
+        "connects": connects,
+        "invalidated": entry["stats"]["invalidated"],
+        # Share of checkouts served by an already open connection
+        "reuse_ratio": max(checkouts - connects, 0) / checkouts if checkouts else 0.0,
+    }
+
+class QueryTimeoutError(RuntimeError):
+    """Raised when a query runs past its deadline and is interrupted."""
+
+class QueryCancelledError(RuntimeError):
+    """Raised when a running query is cancelled."""
+
+# Declared column types mapped to Arrow types, checked in order (SQLite affinity rules match on substrings)
+_ARROW_TYPE_RULES = [
+    # Keep the time zone the driver returns instead of converting to naive UTC
+    (re.compile(r"TIMESTAMPTZ|TIME ZONE", re.IGNORECASE), None),
+    (re.compile(r"TIMESTAMP|DATETIME", re.IGNORECASE), "timestamp"),
+    (re.compile(r"DATE", re.IGNORECASE), "date"),
+    (re.compile(r"BOOL", re.IGNORECASE), "bool"),
+    (re.compile(r"INTERVAL|POINT", re.IGNORECASE), None),
+    (re.compile(r"INT", re.IGNORECASE), "int"),
+    (re.compile(r"CHAR|CLOB|TEXT|STRING|UUID|ENUM|JSON", re.IGNORECASE), "string"),
+    # Exact numerics keep the decimal type inferred from the driver's Decimal values; a float cast would round them
+    (re.compile(r"DEC|NUMERIC|MONEY", re.IGNORECASE), None),
+    (re.compile(r"REAL|FLOA|DOUB", re.IGNORECASE), "float"),
+    (re.compile(r"BLOB|BINARY|BYTEA", re.IGNORECASE), "binary"),
+]
+
+def _arrow_type(declared_type):
+    """Arrow type for a declared column type, or None to infer it from the values."""
+    if pa is None or not declared_type:
+        return None
+    for pattern, name in _ARROW_TYPE_RULES:
+        if pattern.search(str(declared_type)):
+            if name is None:
+                return None
+            return {
+                "timestamp": pa.timestamp("us"), "date": pa.date32(), "bool": pa.bool_(), "int": pa.int64(),
+                "string": pa.string(), "float": pa.float64(), "binary": pa.binary()
+            }[name]
+    return None
+
+def result_column_types(sql_query, schema_info, dialect="sqlite"):
+    """
+    Map the result columns of a query that are bare column references to the Arrow type of their declared type.
+
+    Only projections such as `o.customer_id` or `customer_id AS id` (and `*` over the tables in FROM) take
+    the declared type; expressions, aggregates and anything that cannot be resolved to exactly one schema
+    column keep the types inferred from their values.
+
+    Args:
+        sql_query (str): The query whose result is being read
+        schema_info (dict): Table name mapped to its list of column dicts
+        dialect (str): sqlglot dialect of the database
+
+    Returns:
+        dict: Lowercased result column name mapped to a pyarrow DataType (empty without pyarrow or sqlglot)
+    """
+    if pa is None or sqlglot is None or not schema_info:
+        return {}
+    try:
+        select = sqlglot.parse_one(sql_query.strip().rstrip(';'), read=dialect)
+    except SqlglotError:
+        return {}
+    if not isinstance(select, exp.Select):
+        return {}
+
+    declared = {name.lower(): {column["name"].lower(): column.get("type") for column in columns} for name, columns in schema_info.items()}
+    ctes = {cte.alias_or_name.lower() for cte in select.find_all(exp.CTE)}
+    # Tables of the outer FROM and JOINs by the name the query refers to them with; subqueries map to None
+    sources = {}
+    source = select.args.get("from_") or select.args.get("from")
+    for node in ([source.this] if source is not None else []) + [join.this for join in select.args.get("joins") or []]:
+        is_table = isinstance(node, exp.Table) and node.name.lower() not in ctes
+        sources[node.alias_or_name.lower()] = node.name.lower() if is_table and node.name.lower() in declared else None
+
+    def resolve(column):
+        if column.table:
+            tables = [sources.get(column.table.lower())]
+        else:
+            tables = [table for table in sources.values() if table is None or column.name.lower() in declared[table]]
+            if len(tables) != 1:
+                return None
+        table = tables[0]
+        if table is None or column.name.lower() not in declared[table]:
+            return None
+        return _arrow_type(declared[table][column.name.lower()])
+
+    types = {}
+    seen = set()
+    for projection in select.expressions:
+        column = projection.this if isinstance(projection, exp.Alias) else projection
+        if isinstance(column, exp.Star) or (isinstance(column, exp.Column) and isinstance(column.this, exp.Star)):
+            qualifier = column.table.lower() if isinstance(column, exp.Column) else ""
+            names = [sources.get(qualifier)] if qualifier else list(sources.values())
+            if None in names:
+                # A subquery's columns are unknown, so any result name could be one of them
+                return {}
+            outputs = [(name, _arrow_type(declared_type)) for table in names for name, declared_type in declared[table].items()]
+        elif isinstance(column, exp.Column):
+            outputs = [(projection.alias_or_name.lower(), resolve(column))]
+        else:
+            outputs = [(projection.alias_or_name.lower(), None)]
+        for name, arrow_type in outputs:
+            if name in seen:
+                # The same name twice in the result cannot be typed by name
+                types.pop(name, None)
+            else:
+                types[name] = arrow_type
+            seen.add(name)
+    return {name: arrow_type for name, arrow_type in types.items() if arrow_type is not None}
+
+def _arrow_column(values, arrow_type):
+    """Convert one column of a batch to an Arrow array, casting it to the declared type when a safe cast allows it."""
+    try:
+        array = pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError, OverflowError):
+        # SQLite columns can mix storage classes, which no single Arrow type holds; keep them as text
+        return pa.array([None if value is None else str(value) for value in values], type=pa.string())
+    # Dates SQLite stores as text stay text, as they were before
+    if arrow_type is not None and array.type != arrow_type and not (pa.types.is_string(array.type) and pa.types.is_temporal(arrow_type)):
+        try:
+            # A safe cast refuses to truncate or overflow, so e.g. fractional values stay floats
+            return array.cast(arrow_type, safe=True)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+            pass
+    return array
+
+def arrow_table(rows, columns, column_types=None):
+    """
+    Build an Arrow table from fetched rows, column by column.
+
+    Args:
+        rows (list): Row tuples as returned by the driver
+        columns (list): Result column names
+        column_types (dict, optional): Lowercased column name mapped to a pyarrow DataType, from result_column_types()
+
+    Returns:
+        pa.Table: The rows
+    """
+    column_types = column_types or {}
+    arrays = [
+        _arrow_column(list(values), column_types.get(str(name).lower()))
+        for name, values in zip(columns, zip(*rows))
+    ]
+    return pa.Table.from_arrays(arrays, names=[str(name) for name in columns])
+
+def arrow_to_frame(table):
+    """DataFrame of pyarrow-backed columns over an Arrow table."""
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+class GovernedQuery:
+    """
+    Runs one query on a worker thread under a deadline and row and size caps, and can be cancelled.
+
+    SQLite checks the deadline and cancellation from a progress handler, so the statement stops inside
+    the VM. PostgreSQL and MySQL also get a server-side limit (statement_timeout / MAX_EXECUTION_TIME),
+    and cancelling sends a cancel request or KILL QUERY for the running statement.
+
+    Results are streamed: SQLite steps its cursor, PostgreSQL reads a server-side cursor and MySQL an
+    unbuffered one, a batch at a time. Each batch is available from batches_since() as soon as it is
+    fetched, and fetching stops at the row or size cap instead of loading the whole result.
+
+    With pyarrow installed, batches are built as Arrow tables typed from the declared schema types rather
+    than inferred from the values, and become one frame of pyarrow-backed columns when the result is read.
+    """
+
+    def __init__(self, sql_query, db_type, conn, timeout=None, max_rows=None, max_bytes=None, close_connection=False,
+                 column_types=None, arrow=None):
+        """
+        Args:
+            sql_query (str): The SQL query to run
+            db_type (str): "sqlite", "mysql" or "postgresql"
+            conn: sqlite3 connection, or SQLAlchemy connection for MySQL and PostgreSQL
+            timeout (float, optional): Seconds before the query is interrupted (0 for no limit)
+            max_rows (int, optional): Rows kept before the result is truncated (0 for no limit)
+            max_bytes (int, optional): In-memory size of the result before it is truncated (0 for no limit)
+            close_connection (bool): Close the connection (returning it to its pool) once the statement has
+                really finished, which may be after a caller that stopped waiting has moved on
+            column_types (dict, optional): Arrow types of result columns by lowercased name, from result_column_types()
+            arrow (bool, optional): Build pyarrow-backed frames (defaults to RESULT_ARROW_BACKEND)
+        """
+        self.sql_query = sql_query.strip().rstrip(';')
+        self.db_type = db_type
+        self.conn = conn
+        self.timeout = QUERY_TIMEOUT if timeout is None else timeout
+        self.max_rows = QUERY_MAX_ROWS if max_rows is None else max_rows
+        self.max_bytes = int(QUERY_MAX_RESULT_MB * 1024 * 1024) if max_bytes is None else max_bytes
+        self.close_connection = close_connection
+        self.column_types = column_types or {}
+        self.arrow = RESULT_ARROW_BACKEND if arrow is None else arrow and pa is not None
+        self.start_time = None
+        self.stop_reason = None
+        self._result = None
+        self._error = None
+        self._server_id = None
+        self._session_timeout_set = False
+        self._columns = []
+        self._frames = []
+        self.rows_fetched = 0
+        self.bytes_fetched = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._done = threading.Event()
+
+    def start(self):
+        """Start the query on a worker thread and return self."""
+        self.start_time = time.monotonic()
+        threading.Thread(target=self._run, name="governed-query", daemon=True).start()
+        return self
+
+    def elapsed(self):
+        """Seconds since the query started."""
+        return time.monotonic() - self.start_time if self.start_time else 0.0
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, seconds):
+        """
+        Wait up to `seconds` for the query to finish, interrupting it once the deadline has passed.
+
+        Returns:
+            bool: True if the query has finished
+        """
+        finished = self._done.wait(seconds)
+        if not finished and self.timeout and self.elapsed() > self.timeout:
+            self.stop("timeout")
+        return finished
+
+    def stop(self, reason="cancelled"):
+        """Interrupt the running statement. The reason is "cancelled" or "timeout"."""
+        # Held while interrupting so the worker cannot finish and hand the connection to another query meanwhile
+        with self._lock:
+            if self._done.is_set() or self.stop_reason:
+                return
+            self.stop_reason = reason
+            self._stop_event.set()
+            try:
+                if self.db_type == "sqlite":
+                    self.conn.interrupt()
+                elif self.db_type == "postgresql":
+                    self.conn.connection.dbapi_connection.cancel()
+                elif self.db_type == "mysql" and self._server_id:
+                    # The busy connection cannot take another statement, so kill its query from a second one
+                    with self.conn.engine.connect() as killer:
+                        killer.execute(text(f"KILL QUERY {int(self._server_id)}"))
+            except Exception as e:
+                print(f"Could not interrupt the running query: {str(e)}")
+
+    def batches_since(self, index, count=None):
+        """Batches fetched so far, starting at the given batch number (at most `count` of them)."""
+        with self._lock:
+            batches = self._frames[index:] if count is None else self._frames[index:index + count]
+        # Arrow batches stay tables until someone looks at them
+        return [arrow_to_frame(batch) if self.arrow else batch for batch in batches]
+
+    def result(self, poll_interval=0.1):
+        """
+        Wait for the query to finish and combine its batches into one DataFrame.
+
+        Returns:
+            dict: The DataFrame, rows and bytes fetched, whether the result was truncated and why,
+            and the execution time
+
+        Raises:
+            QueryTimeoutError: The query ran past its deadline
+            QueryCancelledError: The query was cancelled
+        """
+        while not self.wait(poll_interval):
+            pass
+        self._raise_if_failed()
+        with self._lock:
+            if "data" not in self._result:
+                # The batches are released once combined so the result is not held twice
+                frames, self._frames = self._frames, []
+                if not frames:
+                    df = pd.DataFrame(columns=self._columns)
+                elif self.arrow:
+                    df = self._combine_arrow(frames)
+                elif len(frames) == 1:
+                    df = frames[0]
+                else:
+                    # Batches can infer different dtypes (e.g. a batch of only NULLs), so settle them on the whole result
+                    df = pd.concat(frames, ignore_index=True).infer_objects()
+                self._result["data"] = df
+        return self._result
+
+    @staticmethod
+    def _combine_arrow(tables):
+        names = tables[0].column_names
+        for i, name in enumerate(names):
+            # A column that fell back to text in one batch becomes text in every batch
+            if len({table.schema.field(i).type for table in tables} - {pa.null()}) > 1:
+                tables = [table.set_column(i, name, table.column(i).cast(pa.string())) for table in tables]
+        try:
+            # Converting once is much cheaper than per batch; "permissive" widens batches of only NULLs
+            return arrow_to_frame(pa.concat_tables(tables, promote_options="permissive"))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, TypeError):
+            return pd.concat([arrow_to_frame(table) for table in tables], ignore_index=True).infer_objects()
+
+    def _raise_if_failed(self):
+        if self.stop_reason == "timeout":
+            raise QueryTimeoutError(f"Query stopped after exceeding the {self.timeout:g}s time limit.")
+        if self.stop_reason == "cancelled":
+            raise QueryCancelledError("Query cancelled.")
+        if self._error is not None:
+            raise self._error
+
+    def _progress_check(self):
+        # A non-zero return makes SQLite abort the statement with an "interrupted" error
+        if self._stop_event.is_set():
+            return 1
+        if self.timeout and self.elapsed() > self.timeout:
+            with self._lock:
+                self.stop_reason = self.stop_reason or "timeout"
+            return 1
+        return 0
+
+    def _run(self):
+        try:
+            self._result = self._fetch()
+        except Exception as e:
+            self._error = e
+        finally:
+            if self.db_type == "sqlite":
+                self.conn.set_progress_handler(None, 0)
+            elif self._session_timeout_set:
+                self._reset_session_timeout()
+            if self._result is not None:
+                self._result["execution_time"] = self.elapsed()
+            with self._lock:
+                self._done.set()
+            if self.close_connection:
+                try:
+                    self.conn.close()
+                except Exception as e:
+                    print(f"Could not close the query connection: {str(e)}")
+
+    def _reset_session_timeout(self):
+        # The setting outlives the statement, and pooled connections serve later queries with other limits
+        if self.conn.invalidated:
+            return
+        try:
+            self.conn.execute(text("SET SESSION MAX_EXECUTION_TIME = DEFAULT"))
+        except Exception as e:
+            print(f"Could not reset the query time limit, dropping the connection: {str(e)}")
+            self.conn.invalidate()
+
+    def _fetch(self):
+        timeout_ms = int(self.timeout * 1000)
+        cursor = None
+        result = None
+        if self.db_type == "sqlite":
+            self.conn.set_progress_handler(self._progress_check, SQLITE_PROGRESS_INTERVAL)
+            cursor = self.conn.execute(self.sql_query)
+            columns = [column[0] for column in cursor.description or []]
+            fetch = cursor.fetchmany if cursor.description else None
+        elif self.db_type == "mysql":
+            self._server_id = self.conn.execute(text("SELECT CONNECTION_ID()")).scalar()
+            if timeout_ms:
+                self.conn.execute(text(f"SET SESSION MAX_EXECUTION_TIME = {timeout_ms}"))
+                self._session_timeout_set = True
+            # SQLAlchemy always buffers mysql-connector results, so stream through an unbuffered DBAPI cursor
+            cursor = self.conn.connection.dbapi_connection.cursor(buffered=False)
+            cursor.execute(self.sql_query)
+            columns = [column[0] for column in cursor.description or []]
+            fetch = cursor.fetchmany if cursor.description else None
+        else:
+            if self.db_type == "postgresql" and timeout_ms:
+                # SET LOCAL only lasts for the transaction the connection is in
+                self.conn.execute(text(f"SET LOCAL statement_timeout = {timeout_ms}"))
+            # stream_results reads through a server-side cursor instead of buffering every row client-side
+            result = self.conn.execution_options(
+                stream_results=True, max_row_buffer=QUERY_FETCH_BATCH_ROWS
+            ).execute(text(self.sql_query))
+            columns = list(result.keys()) if result.returns_rows else []
+            fetch = result.fetchmany if result.returns_rows else None
+        self._columns = columns
+
+        truncated_by = None
+        exhausted = fetch is None
+        try:
+            while not exhausted and not self._stop_event.is_set():
+                # Ask for one row past the cap so a result of exactly max_rows is not reported as truncated
+                batch_size = min(QUERY_FETCH_BATCH_ROWS, self.max_rows - self.rows_fetched + 1) if self.max_rows else QUERY_FETCH_BATCH_ROWS
+                batch = fetch(batch_size)
+                if not batch:
+                    exhausted = True
+                    break
+                if self.max_rows and self.rows_fetched + len(batch) > self.max_rows:
+                    batch = batch[:self.max_rows - self.rows_fetched]
+                    truncated_by = "row limit"
+                if self.arrow:
+                    frame = arrow_table(batch, columns, self.column_types)
+                    frame_bytes = frame.nbytes
+                else:
+                    frame = pd.DataFrame.from_records([tuple(row) for row in batch], columns=columns)
+                    frame_bytes = int(frame.memory_usage(deep=True).sum())
+                if self.max_bytes and self.bytes_fetched + frame_bytes > self.max_bytes:
+                    # Keep the share of the batch that fits, assuming its rows are of similar size
+                    keep = int(len(frame) * (self.max_bytes - self.bytes_fetched) / frame_bytes)
+                    if self.arrow:
+                        frame = frame.slice(0, keep)
+                        frame_bytes = frame.nbytes if keep else 0
+                    else:
+                        frame = frame.iloc[:keep]
+                        frame_bytes = int(frame.memory_usage(deep=True).sum()) if keep else 0
+                    truncated_by = "size limit"
+                with self._lock:
+                    if len(frame):
+                        self._frames.append(frame)
+                    self.rows_fetched += len(frame)
+                    self.bytes_fetched += frame_bytes
+                if truncated_by:
+                    break
+        finally:
+            if self.db_type == "mysql" and not exhausted:
+                # Unread rows of an unbuffered cursor block the connection; dropping it is cheaper than draining them
+                self.conn.invalidate()
+            elif cursor is not None:
+                cursor.close()
+            elif result is not None:
+                result.close()
+
+        return {"rows": self.rows_fetched, "bytes": self.bytes_fetched, "truncated": truncated_by is not None, "truncated_by": truncated_by}
+
+def _quote_sqlite_name(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def get_sqlite_indexes(db_path):
+    """
+    Read the indexes of every table in an SQLite database.
+
+    Partial and expression indexes are left out because they cannot be assumed to serve arbitrary
+    queries. The primary key is reported as an index, since SQLite does not list rowid aliases.
+
+    Args:
+        db_path (str): Path of the SQLite database file
+
+    Returns:
+        dict: Table name mapped to a list of {"name", "columns", "unique"} dicts
+    """
+    conn = open_sqlite_readonly(db_path)
+    try:
+        indexes = {}
+        tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")]
+        for table in tables:
+            table_indexes = []
+            # index_list rows are (seq, name, unique, origin, partial)
+            for row in conn.execute(f"PRAGMA index_list({_quote_sqlite_name(table)})"):
+                if len(row) > 4 and row[4]:
+                    continue
+                columns = [info[2] for info in conn.execute(f"PRAGMA index_info({_quote_sqlite_name(row[1])})")]
+                if columns and None not in columns:
+                    table_indexes.append({"name": row[1], "columns": columns, "unique": bool(row[2])})
+
+            primary_key = [info[1] for info in sorted(conn.execute(f"PRAGMA table_info({_quote_sqlite_name(table)})"), key=lambda info: info[5]) if info[5]]
+            if primary_key and not any(index["columns"][:len(primary_key)] == primary_key for index in table_indexes):
+                table_indexes.append({"name": "PRIMARY KEY", "columns": primary_key, "unique": True})
+            indexes[table] = table_indexes
+        return indexes
+    finally:
+        conn.close()
+
+def get_sqlalchemy_indexes(engine):
+    """
+    Read the indexes of every table through the SQLAlchemy inspector.
+
+    Args:
+        engine (Engine): Engine of the connected MySQL or PostgreSQL database
+
+    Returns:
+        dict: Table name mapped to a list of {"name", "columns", "unique"} dicts, primary keys included
+    """
+    inspector = inspect(engine)
+    indexes = {}
+    for table in inspector.get_table_names():
+        table_indexes = [
+            {"name": index["name"], "columns": list(index["column_names"]), "unique": bool(index.get("unique"))}
+            for index in inspector.get_indexes(table)
+            if index.get("column_names") and None not in index["column_names"]
+        ]
+        primary_key = inspector.get_pk_constraint(table).get("constrained_columns") or []
+        if primary_key:
+            table_indexes.append({"name": "PRIMARY KEY", "columns": list(primary_key), "unique": True})
+        indexes[table] = table_indexes
+    return indexes
+
+_SQLITE_ACCESS_PATTERN = re.compile(r'^(SCAN|SEARCH)\s+(?:TABLE\s+)?(\S+)(?:\s+AS\s+(\S+))?', re.IGNORECASE)
+_TABLE_ALIAS_PATTERN = re.compile(r'(?:\bFROM|\bJOIN|,)\s*[`"\[]?(\w+)[`"\]]?(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+_NOT_ALIASES = {"where", "join", "inner", "left", "right", "full", "cross", "outer", "on", "using", "group",
+                "order", "limit", "having", "union", "natural", "window", "offset", "except", "intersect"}
+
+def _plan_node(label, rows=None, cost=None, full_scan=False, temp_structure=False, children=None):
+    return {
+        "label": label,
+        "rows": rows,
+        "cost": cost,
+        "full_scan": full_scan,
+        "temp_structure": temp_structure,
+        "children": children or [],
+    }
+
+def _walk_plan(nodes):
+    for node in nodes:
+        yield node
+        yield from _walk_plan(node["children"])
+
+def _sqlite_table_rows(conn, table):
+    """Row count estimate for an SQLite table, from sqlite_stat1 when ANALYZE has run, else MAX(rowid)."""
+    try:
+        row = conn.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = ? LIMIT 1", (table,)).fetchone()
+        if row and row[0]:
+            return int(row[0].split()[0])
+    except sqlite3.Error:
+        pass
+    try:
+        # MAX(rowid) is answered from the end of the table b-tree, unlike COUNT(*)
+        row = conn.execute(f"SELECT MAX(_rowid_) FROM {_quote_sqlite_name(table)}").fetchone()
+        return int(row[0] or 0)
+    except sqlite3.Error:
+        return None
+
+def _sqlite_unique_index(conn, table, index_name):
+    try:
+        return any(row[1] == index_name and row[2] for row in conn.execute(f"PRAGMA index_list({_quote_sqlite_name(table)})"))
+    except sqlite3.Error:
+        return False
+
+def _cost_sqlite_plan(conn, nodes, aliases, materialized):
+    """
+    Cost one loop nest of an SQLite plan in rows examined and fill in each node's row estimate.
+
+    Sibling SCAN and SEARCH steps are nested loops, so each runs once per row produced by the steps before it.
+    """
+    cost = 0.0
+    rows = 1.0
+    for node in nodes:
+        detail = node["label"]
+        access = _SQLITE_ACCESS_PATTERN.match(detail)
+        if access:
+            kind = access.group(1).upper()
+            name = access.group(2)
+            table = name if access.group(3) else aliases.get(name.lower(), name)
+            table_rows = materialized.get(name.lower())
+            if table_rows is None:
+                table_rows = _sqlite_table_rows(conn, table)
+            table_rows = max(table_rows or 1, 1)
+            if kind == "SCAN":
+                node["rows"] = int(table_rows)
+                # SCAN reads every row of the table, or of the whole index with USING COVERING INDEX
+                node["full_scan"] = True
+                cost += rows * table_rows
+                rows *= table_rows
+            else:
+                using = re.search(r'USING (?:COVERING )?INDEX (\S+)', detail, re.IGNORECASE)
+                equality_only = "=?" in detail and not re.search(r'[<>]', detail)
+                if ("PRIMARY KEY" in detail.upper() and equality_only) or (
+                        using and equality_only and _sqlite_unique_index(conn, table, using.group(1))):
+                    per_lookup = 1
+                else:
+                    per_lookup = min(table_rows, SQLITE_DEFAULT_ROWS_PER_LOOKUP)
+                node["rows"] = int(per_lookup)
+                cost += rows * (math.log2(table_rows + 1) + per_lookup)
+                rows *= per_lookup
+            continue
+
+        upper = detail.upper()
+        if "TEMP B-TREE" in upper:
+            node["temp_structure"] = True
+            node["rows"] = int(rows)
+            cost += rows * math.log2(rows + 1)
+        sub_cost, sub_rows = _cost_sqlite_plan(conn, node["children"], aliases, materialized)
+        if upper.startswith("CORRELATED"):
+            # Re-evaluated for every outer row
+            cost += rows * sub_cost
+        else:
+            cost += sub_cost
+        if upper.startswith(("MATERIALIZE", "CO-ROUTINE")):
+            materialized[detail.split()[-1].lower()] = sub_rows
+        if node["children"] and node["rows"] is None:
+            node["rows"] = int(sub_rows)
+    return cost, rows
+
+def _explain_sqlite(sql_query, db_path):
+    conn = open_sqlite_readonly(db_path)
+    try:
+        rows = conn.execute(f"EXPLAIN QUERY PLAN {sql_query}").fetchall()
+        # Rows are (id, parent, notused, detail); parent 0 is the top level
+        nodes = {}
+        roots = []
+        for node_id, parent_id, _, detail in rows:
+            node = _plan_node(detail)
+            nodes[node_id] = node
+            (nodes[parent_id]["children"] if parent_id in nodes else roots).append(node)
+
+        aliases = {}
+        for table, alias in _TABLE_ALIAS_PATTERN.findall(sql_query):
+            if alias and alias.lower() not in _NOT_ALIASES:
+                aliases[alias.lower()] = table
+        cost, output_rows = _cost_sqlite_plan(conn, roots, aliases, {})
+        return roots, cost, int(output_rows)
+    finally:
+        conn.close()
+
+def _postgres_plan_node(plan):
+    node_type = plan.get("Node Type", "")
+    label = node_type
+    if plan.get("Relation Name"):
+        label += f" on {plan['Relation Name']}"
+        if plan.get("Alias") and plan["Alias"] != plan["Relation Name"]:
+            label += f" {plan['Alias']}"
+    if plan.get("Index Name"):
+        label += f" using {plan['Index Name']}"
+    return _plan_node(
+        label,
+        rows=plan.get("Plan Rows"),
+        cost=plan.get("Total Cost"),
+        full_scan=node_type == "Seq Scan",
+        temp_structure=node_type in ("Sort", "Incremental Sort", "Materialize", "Hash") or plan.get("Strategy") == "Hashed",
+        children=[_postgres_plan_node(child) for child in plan.get("Plans", [])],
+    )
+
+_MYSQL_OPERATIONS = {
+    "ordering_operation": "ORDER BY",
+    "grouping_operation": "GROUP BY",
+    "duplicates_removal": "DISTINCT",
+    "windowing": "Window functions",
+    "union_result": "UNION",
+}
+
+def _mysql_plan_nodes(block):
+    """Turn a MySQL EXPLAIN FORMAT=JSON block into plan nodes, one per table access or operation."""
+    nodes = []
+    for key, value in block.items():
+        if key == "table" and isinstance(value, dict):
+            cost_info = value.get("cost_info", {})
+            label = f"{value.get('access_type', '?')} access on {value.get('table_name', '?')}"
+            if value.get("key"):
+                label += f" using {value['key']}"
+            nodes.append(_plan_node(
+                label,
+                rows=value.get("rows_examined_per_scan"),
+                cost=float(cost_info["prefix_cost"]) if "prefix_cost" in cost_info else None,
+                # "index" reads the whole index, "ALL" the whole table
+                full_scan=value.get("access_type") in ("ALL", "index"),
+                temp_structure=bool(value.get("using_temporary_table") or value.get("using_join_buffer")),
+                children=_mysql_plan_nodes(value),
+            ))
+        elif key in _MYSQL_OPERATIONS and isinstance(value, dict):
+            nodes.append(_plan_node(
+                _MYSQL_OPERATIONS[key],
+                temp_structure=bool(value.get("using_temporary_table") or value.get("using_filesort")),
+                children=_mysql_plan_nodes(value),
+            ))
+        elif isinstance(value, dict):
+            nodes.extend(_mysql_plan_nodes(value))
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict):
+                    nodes.extend(_mysql_plan_nodes(item))
+    return nodes
+
+def explain_query_plan(sql_query, db_type, db_path=None, conn=None):
+    """
+    Ask the database for the execution plan of a query without running it.
+
+    SQLite uses EXPLAIN QUERY PLAN and its plan is costed here in estimated rows examined, from table
+    sizes and SQLite's own default selectivity. PostgreSQL and MySQL use EXPLAIN in JSON format and
+    report the planner's estimated cost and rows.
+
+    Args:
+        sql_query (str): The SQL query to explain
+        db_type (str): "sqlite", "mysql" or "postgresql"
+        db_path (str, optional): Path of the SQLite database file
+        conn (Connection, optional): SQLAlchemy connection for MySQL and PostgreSQL
+
+    Returns:
+        dict: The plan tree as nested nodes, its estimated cost and rows, the fully scanned relations,
+        the temporary structures it builds and an error message if the plan could not be read
+    """
+    sql_query = sql_query.strip().rstrip(';')
+    result = {
+        "dialect": db_type,
+        "nodes": [],
+        "estimated_cost": None,
+        "cost_unit": "rows examined" if db_type == "sqlite" else "planner cost units",
+        "estimated_rows": None,
+        "full_scans": [],
+        "temp_structures": [],
+        "error": None,
+    }
+    try:
+        if db_type == "sqlite":
+            result["nodes"], result["estimated_cost"], result["estimated_rows"] = _explain_sqlite(sql_query, db_path)
+        elif db_type == "postgresql":
+            plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql_query}")).scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            root = plan[0]["Plan"]
+            result["nodes"] = [_postgres_plan_node(root)]
+            result["estimated_cost"] = root.get("Total Cost")
+            result["estimated_rows"] = root.get("Plan Rows")
+        elif db_type == "mysql":
+            plan = json.loads(conn.execute(text(f"EXPLAIN FORMAT=JSON {sql_query}")).scalar())
+            query_block = plan.get("query_block", {})
+            result["nodes"] = _mysql_plan_nodes(query_block)
+            query_cost = query_block.get("cost_info", {}).get("query_cost")
+            result["estimated_cost"] = float(query_cost) if query_cost is not None else None
+            produced = [node["rows"] for node in result["nodes"] if node["rows"] is not None]
+            result["estimated_rows"] = max(produced) if produced else None
+        else:
+            result["error"] = f"Query plans are not supported for {db_type}."
+            return result
+    except Exception as e:
+        result["error"] = str(e)
+        return result
+
+    for node in _walk_plan(result["nodes"]):
+        if node["full_scan"]:
+            result["full_scans"].append(node["label"])
+        if node["temp_structure"]:
+            result["temp_structures"].append(node["label"])
+    return result
+
+def plan_needs_confirmation(plan, threshold):
+    """
+    True when a plan's estimated cost is above the threshold, or when the plan could not be costed at all
+    (a threshold of 0 disables the check).
+    """
+    if not threshold:
+        return False
+    return plan.get("estimated_cost") is None or plan["estimated_cost"] > threshold
+
+def plan_pagination(sql_query, schema_info, dialect="sqlite"):
+    """
+    Decide how a query's result can be paged in the database.
+
+    Keyset pagination needs a plain single-table SELECT whose output includes the table's single-column
+    primary key and that is ordered by nothing else, so each page is an index seek past the last key.
+    Anything else (joins, grouping, DISTINCT, LIMIT, set operations, other orderings) is paged with
+    LIMIT/OFFSET around the original query. Each offset page runs the query again, so its pages only line
+    up when the query has an ORDER BY; "ordered" tells callers whether to page it in memory instead.
+
+    Args:
+        sql_query (str): The SQL query to page
+        schema_info (dict): Schema information with primary key flags
+        dialect (str): sqlglot dialect of the database
+
+    Returns:
+        dict: "mode" ("keyset" or "offset"), "ordered" (whether pages come out in a stable order), and for
+        keyset the table, key column, output column, sort direction and whether the query filters rows
+    """
+    offset_plan = {"mode": "offset", "ordered": False}
+    if sqlglot is None:
+        return offset_plan
+    try:
+        select = sqlglot.parse_one(sql_query.strip().rstrip(';'), read=dialect)
+    except SqlglotError:
+        return offset_plan
+    offset_plan["ordered"] = isinstance(select, exp.Query) and select.args.get("order") is not None
+    if not isinstance(select, exp.Select) or select.args.get("joins") or select.args.get("with_"):
+        return offset_plan
+    if any(select.args.get(arg) for arg in ("group", "having", "distinct", "limit", "offset", "qualify")):
+        return offset_plan
+    if any(projection.find(exp.AggFunc, exp.Window) for projection in select.expressions):
+        return offset_plan
+    source = select.args.get("from_") or select.args.get("from")
+    if source is None or not isinstance(source.this, exp.Table):
+        return offset_plan
+    table = source.this.name
+    columns = next((cols for name, cols in (schema_info or {}).items() if name.lower() == table.lower()), None)
+    primary_key = [column["name"] for column in columns or [] if column.get("is_primary_key")]
+    if len(primary_key) != 1:
+        return offset_plan
+    key = primary_key[0]
+
+    # The key must come out of the query, under whatever name the projection gives it
+    output_column = None
+    for projection in select.expressions:
+        if isinstance(projection, exp.Star) or (isinstance(projection, exp.Column) and isinstance(projection.this, exp.Star)):
+            output_column = key
+            break
+        column = projection.this if isinstance(projection, exp.Alias) else projection
+        if isinstance(column, exp.Column) and column.name.lower() == key.lower():
+            output_column = projection.alias_or_name
+            break
+    if output_column is None:
+        return offset_plan
+
+    descending = False
+    order = select.args.get("order")
+    if order is not None:
+        if len(order.expressions) != 1:
+            return offset_plan
+        ordered = order.expressions[0]
+        if not isinstance(ordered.this, exp.Column) or ordered.this.name.lower() != key.lower():
+            return offset_plan
+        descending = bool(ordered.args.get("desc"))
+
+    return {
+        "mode": "keyset",
+        "ordered": True,
+        "table": table,
+        "table_alias": source.this.alias_or_name,
+        "key": key,
+        "output_column": output_column,
+        "descending": descending,
+        "filtered": select.args.get("where") is not None,
+    }
+
+def build_page_query(sql_query, pagination, page_size, after=None, offset=0, dialect="sqlite"):
+    """
+    Rewrite a query so it returns one page, plus one row to tell whether another page follows.
+
+    Args:
+        sql_query (str): The original query
+        pagination (dict): Result of plan_pagination
+        page_size (int): Rows per page
+        after: Keyset mode: key of the last row on the previous page (None for the first page)
+        offset (int): Offset mode: rows to skip
+        dialect (str): sqlglot dialect of the database
+
+    Returns:
+        str: The page query
+    """
+    sql_query = sql_query.strip().rstrip(';')
+    if pagination["mode"] == "keyset":
+        select = sqlglot.parse_one(sql_query, read=dialect)
+        key = exp.column(pagination["key"], table=pagination["table_alias"])
+        if after is not None:
+            comparison = exp.LT if pagination["descending"] else exp.GT
+            select = select.where(comparison(this=key.copy(), expression=exp.convert(after)))
+        # Parsed in the dialect so no NULLS FIRST/LAST clause is added that would stop the key's index serving the order
+        select = select.order_by(key.sql(dialect=dialect) + (" DESC" if pagination["descending"] else ""), append=False, dialect=dialect)
+        return select.limit(page_size + 1).sql(dialect=dialect)
+    # The derived table needs an alias on MySQL and PostgreSQL; an ORDER BY inside it is kept by all three in practice
+    return f"SELECT * FROM ({sql_query}) AS page_source LIMIT {int(page_size) + 1} OFFSET {int(offset)}"
+
+def estimate_row_count(sql_query, db_type, conn, pagination):
+    """
+    Estimate how many rows a query returns without counting them.
+
+    An unfiltered keyset query returns the whole table, so table statistics are used (sqlite_stat1 or
+    MAX(rowid), pg_class.reltuples, information_schema.TABLES). Otherwise the planner's row estimate is used.
+
+    Returns:
+        int or None: The estimate, or None if nothing cheap is available
+    """
+    try:
+        if pagination["mode"] == "keyset" and not pagination["filtered"]:
+            table = pagination["table"]
+            if db_type == "sqlite":
+                return _sqlite_table_rows(conn, table)
+            if db_type == "postgresql":
+                estimate = conn.execute(text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:t)"), {"t": table}).scalar()
+                # reltuples is -1 until the table has been vacuumed or analyzed
+                if estimate is not None and estimate >= 0:
+                    return int(estimate)
+            elif db_type == "mysql":
+                estimate = conn.execute(text(
+                    "SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :t"
+                ), {"t": table}).scalar()
+                if estimate is not None:
+                    return int(estimate)
+        if db_type == "sqlite":
+            plan = explain_query_plan(sql_query, db_type, db_path=conn.pool.db_path if getattr(conn, "pool", None) else None)
+        else:
+            plan = explain_query_plan(sql_query, db_type, conn=conn)
+        return int(plan["estimated_rows"]) if plan["estimated_rows"] is not None else None
+    except Exception as e:
+        print(f"Could not estimate the row count: {str(e)}")
+        return None
+
+# Shared by every pager, so prefetching cannot start more than a few page reads at once
+_page_prefetch_executor = ThreadPoolExecutor(max_workers=PAGE_PREFETCH_WORKERS, thread_name_prefix="page-prefetch")
+
+class ResultPager:
+    """
+    Pages through a query's result in the database, one page of rows per read.
+
+    Keyset pages seek past the last key of the previous page, so every page costs the same. Offset pages
+    skip rows in the database, which gets slower on deep pages but still only transfers one page. The
+    page after the one shown is read in the background, so moving forward is usually instant.
+    """
+
+    def __init__(self, sql_query, db_type, connect, schema_info, page_size=50, dialect="sqlite", timeout=None):
+        """
+        Args:
+            sql_query (str): The query whose result is paged
+            db_type (str): "sqlite", "mysql" or "postgresql"
+            connect (callable): Returns a pooled connection; closing it gives it back
+            schema_info (dict): Schema information with primary key flags
+            page_size (int): Rows per page
+            dialect (str): sqlglot dialect of the database
+            timeout (float, optional): Time limit for each page read
+        """
+        self.sql_query = sql_query
+        self.db_type = db_type
+        self.connect = connect
+        self.page_size = page_size
+        self.dialect = dialect
+        self.timeout = timeout
+        self.pagination = plan_pagination(sql_query, schema_info, dialect)
+        self.column_types = result_column_types(sql_query, schema_info, dialect)
+        self.page_number = 0
+        self.prefetch_hits = 0
+        self.page_reads = 0
+        self._estimate = None
+        self._estimated = False
+        # Keyset mode: key of the last row before each page, learned as pages are read
+        self._page_starts = [None]
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    @property
+    def mode(self):
+        return self.pagination["mode"]
+
+    def _read_page(self, page_number, after):
+        page_sql = build_page_query(
+            self.sql_query, self.pagination, self.page_size, after=after,
+            offset=page_number * self.page_size, dialect=self.dialect
+        )
+        conn = self.connect()
+        try:
+            outcome = GovernedQuery(
+                page_sql, self.db_type, conn, timeout=self.timeout, max_rows=0, max_bytes=0, column_types=self.column_types
+            ).start().result()
+        finally:
+            conn.close()
+        df = outcome["data"]
+        has_next = len(df) > self.page_size
+        df = df.iloc[:self.page_size].reset_index(drop=True)
+        with self._lock:
+            self.page_reads += 1
+            if self.mode == "keyset" and has_next and len(self._page_starts) == page_number + 1:
+                last_key = df[self.pagination["output_column"]].iloc[-1]
+                # numpy scalars are unwrapped so sqlglot can write them as literals
+                self._page_starts.append(last_key.item() if hasattr(last_key, "item") else last_key)
+        return {"data": df, "has_next": has_next, "read_time": outcome["execution_time"]}
+
+    def _submit(self, page_number):
+        """Start reading a page unless it is cached or its starting key is not known yet."""
+        with self._lock:
+            if page_number in self._pages:
+                return self._pages[page_number]
+            if self.mode == "keyset" and page_number >= len(self._page_starts):
+                return None
+            after = self._page_starts[page_number] if self.mode == "keyset" else None
+            future = _page_prefetch_executor.submit(self._read_page, page_number, after)
+            self._pages[page_number] = future
+            return future
+
+    def page(self, page_number=None):
+        """
+        Read a page (the current one by default) and start prefetching the next.
+
+        Returns:
+            dict: The page's DataFrame, whether a next page exists, its read time and whether it was prefetched
+        """
+        page_number = self.page_number if page_number is None else page_number
+        with self._lock:
+            prefetched = page_number in self._pages and self._pages[page_number].done()
+        future = self._submit(page_number)
+        if future is None:
+            raise ValueError(f"Page {page_number + 1} cannot be reached before the pages in front of it are read.")
+        try:
+            page = dict(future.result())
+        except Exception:
+            # Do not keep a failed read around; the next request tries again
+            with self._lock:
+                self._pages.pop(page_number, None)
+            raise
+        if prefetched:
+            self.prefetch_hits += 1
+        page["prefetched"] = prefetched
+
+        with self._lock:
+            # Only the neighbours of the page being shown are kept in memory
+            for cached in [number for number in self._pages if abs(number - page_number) > 1]:
+                self._pages.pop(cached).cancel()
+        if page["has_next"]:
+            self._submit(page_number + 1)
+        return page
+
+    def estimated_total(self):
+        """Cheap estimate of the total row count, computed once."""
+        if not self._estimated:
+            conn = self.connect()
+            try:
+                self._estimate = estimate_row_count(self.sql_query, self.db_type, conn, self.pagination)
+            finally:
+                conn.close()
+            self._estimated = True
+        return self._estimate
+
+    def can_jump(self):
+        """Offset pages can be opened directly; keyset pages only by walking to them."""
+        return self.mode == "offset"
+
+def connection_fingerprint(db_type, db_path=None, connection_string=None):
+    """
+    Identify the database a result was read from, for result cache keys.
+
+    SQLite fingerprints include the size and modification time of the file and its write-ahead log,
+    so results cached before the file changed are no longer found.
+
+    Args:
+        db_type (str): "sqlite", "mysql" or "postgresql"
+        db_path (str, optional): Path of the SQLite database file
+        connection_string (str, optional): SQLAlchemy URL of a MySQL or PostgreSQL database
+
+    Returns:
+        str: A hex digest; connection strings are hashed so passwords are not kept in keys
+    """
+    if db_type == "sqlite":
+        parts = [os.path.abspath(db_path)]
+        for path in (db_path, db_path + "-wal"):
+            try:
+                stat = os.stat(path)
+                parts.append(f"{stat.st_size}:{stat.st_mtime_ns}")
+            except OSError:
+                parts.append("-")
+        identity = "\n".join(parts)
+    else:
+        identity = connection_string or ""
+    return hashlib.sha256(f"{db_type}\n{identity}".encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """
+    Thread-safe, process-wide cache of query results bounded by their total size in bytes.
+
+    Entries are keyed by connection fingerprint and normalized SQL, expire after the TTL of their database
+    type, and are evicted least recently used first ("lru") or least often reused first ("lfu") once the
+    byte budget is exceeded. Results larger than the whole budget are not stored.
+    """
+
+    def __init__(self, max_bytes=int(RESULT_CACHE_MAX_MB * 1024 * 1024), policy=RESULT_CACHE_POLICY, ttls=None):
+        self.max_bytes = max_bytes
+        self.policy = policy if policy in ("lru", "lfu") else "lru"
+        self.ttls = dict(RESULT_CACHE_TTLS if ttls is None else ttls)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejections = 0
+        # Least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expired(self, entry, now):
+        return entry["ttl"] > 0 and now - entry["timestamp"] > entry["ttl"]
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= entry["bytes"]
+
+    def get(self, fingerprint, normalized_sql):
+        """
+        Look up a fresh result and mark it as used.
+
+        Returns:
+            dict: "data" (a shallow copy of the cached DataFrame), "execution_time", "timestamp" and "hits",
+            or None on a miss
+        """
+        key = (fingerprint, normalized_sql)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry, now):
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            entry["hits"] += 1
+            self.hits += 1
+            # Sessions share the entry, so each gets its own frame object over the same data
+            return {**entry, "data": entry["data"].copy(deep=False)}
+
+    def contains(self, fingerprint, normalized_sql):
+        """Whether a fresh result is cached, without counting a lookup or marking it as used."""
+        with self._lock:
+            entry = self._entries.get((fingerprint, normalized_sql))
+            return entry is not None and not self._expired(entry, time.time())
+
+    def put(self, fingerprint, normalized_sql, db_type, df, execution_time, nbytes=None):
+        """
+        Store a result, evicting others until the cache is back within its byte budget.
+
+        Args:
+            fingerprint (str): connection_fingerprint() of the database the result was read from
+            normalized_sql (str): The query, normalized so formatting-only variants share the entry
+            db_type (str): Database type, which selects the TTL
+            df (pd.DataFrame): The result; it must not be modified afterwards
+            execution_time (float): Seconds the query took
+            nbytes (int, optional): In-memory size of the result if already known
+
+        Returns:
+            bool: Whether the result was stored
+        """
+        if nbytes is None:
+            nbytes = int(df.memory_usage(deep=True).sum())
+        key = (fingerprint, normalized_sql)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if nbytes > self.max_bytes:
+                self.rejections += 1
+                return False
+            self._entries[key] = {
+                "data": df,
+                "execution_time": execution_time,
+                "timestamp": time.time(),
+                "ttl": self.ttls.get(db_type, RESULT_CACHE_TTLS["sqlite"]),
+                "bytes": nbytes,
+                "hits": 0,
+                "fingerprint": fingerprint,
+            }
+            self.bytes += nbytes
+            self._evict(keep=key)
+        return True
+
+    def _evict(self, keep):
+        now = time.time()
+        # Expired entries go first, whatever the policy
+        for key in [key for key, entry in self._entries.items() if self._expired(entry, now)]:
+            self._remove(key)
+            self.expirations += 1
+        while self.bytes > self.max_bytes and len(self._entries) > 1:
+            candidates = (key for key in self._entries if key != keep)
+            if self.policy == "lfu":
+                # min() keeps the first of equal counts, which is the least recently used
+                victim = min(candidates, key=lambda key: self._entries[key]["hits"])
+            else:
+                victim = next(candidates)
+            self._remove(victim)
+            self.evictions += 1
+
+    def invalidate(self, fingerprint):
+        """Drop every result read from one database."""
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry["fingerprint"] == fingerprint]:
+                self._remove(key)
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """Return size, entry count and hit, miss, eviction, expiration and rejection counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "policy": self.policy,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "rejections": self.rejections,
+            }
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+def get_result_cache():
+    """Return the process-wide result cache, creating it on first use."""
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache()
+        return _result_cache
@@ -1,11 +1,1797 @@
 import os
 import json
 import logging
-from openai import OpenAI
+import hashlib
+import sqlite3
+import threading
+import queue
+import time
+import random
+import contextvars
+import functools
+import types
+import itertools
+import collections
+import email.utils
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_for_futures
+import httpx
+from openai import OpenAI, APIConnectionError, APIStatusError, RateLimitError
 import re
 import streamlit as st
 
-def gpt_generate_sql(user_input, schema_info, api_key=None):
+try:
+    import sqlglot
+    from sqlglot import exp
+except ImportError:
+    sqlglot = None
+
+# Chat model used for every request
+OPENAI_MODEL = os.environ.get("OPENAI_MODEL", "gpt-3.5-turbo")
+
+# Bump whenever the SQL generation prompt changes so stale cached SQL is not reused
+SQL_PROMPT_VERSION = "1"
+
+# Bump whenever the explanation or follow-up prompts change so stale cached text is not reused
+ANNOTATION_PROMPT_VERSION = "1"
+
+# Persistent NL-to-SQL generation cache settings
+GENERATION_CACHE_PATH = os.environ.get("GENERATION_CACHE_PATH", ".text2sql_cache.db")
+GENERATION_CACHE_TTL = float(os.environ.get("GENERATION_CACHE_TTL", str(7 * 24 * 3600)))
+GENERATION_CACHE_MAX_ENTRIES = int(os.environ.get("GENERATION_CACHE_MAX_ENTRIES", "10000"))
+
+# Minimum Jaccard similarity for reusing SQL cached for a differently worded question (0 disables)
+SIMILAR_QUESTION_THRESHOLD = float(os.environ.get("SIMILAR_QUESTION_THRESHOLD", "0.8"))
+
+# Rule-based fast path for simple list/count/group-by/top-N questions and the confidence it needs to skip the LLM
+FAST_PATH_ENABLED = os.environ.get("FAST_PATH_ENABLED", "true").lower() in ("1", "true", "yes")
+FAST_PATH_MIN_CONFIDENCE = float(os.environ.get("FAST_PATH_MIN_CONFIDENCE", "0.85"))
+
+# LLM attempts at repairing generated SQL that fails validation (0 only validates)
+SQL_REPAIR_MAX_ATTEMPTS = int(os.environ.get("SQL_REPAIR_MAX_ATTEMPTS", "2"))
+
+# Questions scoring at least this precision skip the question-improvement call (above 1 always makes it)
+QUESTION_PRECISION_THRESHOLD = float(os.environ.get("QUESTION_PRECISION_THRESHOLD", "0.75"))
+
+# Schema rendering used in prompts ("bullet" or the more compact "ddl") and how many renderings to memoize
+SCHEMA_PROMPT_STYLE = os.environ.get("SCHEMA_PROMPT_STYLE", "bullet")
+SCHEMA_RENDER_CACHE_SIZE = int(os.environ.get("SCHEMA_RENDER_CACHE_SIZE", "256"))
+
+# Schema pruning: tables kept per prompt (0 sends the full schema) and columns kept per wide table
+SCHEMA_PRUNE_TOP_K = int(os.environ.get("SCHEMA_PRUNE_TOP_K", "8"))
+SCHEMA_PRUNE_MAX_COLUMNS = int(os.environ.get("SCHEMA_PRUNE_MAX_COLUMNS", "40"))
+
+# Connection pool settings for the shared OpenAI clients
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "10"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get("OPENAI_KEEPALIVE_EXPIRY", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get("OPENAI_CONNECT_TIMEOUT", "10"))
+OPENAI_READ_TIMEOUT = float(os.environ.get("OPENAI_READ_TIMEOUT", "60"))
+
+# Worker threads shared by the per-question LLM pipelines of all sessions
+LLM_PIPELINE_WORKERS = int(os.environ.get("LLM_PIPELINE_WORKERS", "16"))
+
+# Process-wide OpenAI quotas enforced before each request (0 disables a limit) and the longest a call may queue
+OPENAI_RPM_LIMIT = int(os.environ.get("OPENAI_RPM_LIMIT", "500"))
+OPENAI_TPM_LIMIT = int(os.environ.get("OPENAI_TPM_LIMIT", "200000"))
+OPENAI_RATE_LIMIT_MAX_WAIT = float(os.environ.get("OPENAI_RATE_LIMIT_MAX_WAIT", "30"))
+
+# Retries of throttled, timed out and 5xx calls with jittered exponential backoff
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "3"))
+OPENAI_BACKOFF_BASE = float(os.environ.get("OPENAI_BACKOFF_BASE", "0.5"))
+OPENAI_BACKOFF_MAX = float(os.environ.get("OPENAI_BACKOFF_MAX", "20"))
+
+# Consecutive failed attempts that open the circuit breaker and how long it stays open before a probe
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_BREAKER_FAILURE_THRESHOLD", "5"))
+CIRCUIT_BREAKER_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_BREAKER_RESET_TIMEOUT", "30"))
+
+# Speculative warm-up of suggested follow-up questions: worker threads, LLM generations per minute across all
+# sessions (0 disables warm-up) and the share of the tokens-per-minute quota that must be free before warming
+SPECULATIVE_WARMUP_WORKERS = int(os.environ.get("SPECULATIVE_WARMUP_WORKERS", "2"))
+SPECULATIVE_WARMUP_RPM = int(os.environ.get("SPECULATIVE_WARMUP_RPM", "20"))
+SPECULATIVE_MIN_TOKEN_HEADROOM = float(os.environ.get("SPECULATIVE_MIN_TOKEN_HEADROOM", "0.5"))
+
+# Hard deadline for one LLM call including retries, in seconds
+LLM_CALL_DEADLINE = float(os.environ.get("LLM_CALL_DEADLINE", "30"))
+
+# Hedging: send a duplicate of a non-streamed call once it is slower than this latency percentile (0 disables),
+# after at least LLM_HEDGE_MIN_SAMPLES calls of that kind have been observed
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", "0"))
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get("LLM_HEDGE_MIN_SAMPLES", "20"))
+
+# Memoized schema renderings keyed by (schema fingerprint, style)
+_schema_render_cache = collections.OrderedDict()
+_schema_render_cache_lock = threading.Lock()
+
+# Fingerprints of recently used schema dicts keyed by id(), evicted least recently used first; the dict
+# is kept alive so its id cannot be reused. Schemas mutated in place must go through invalidate_schema_cache.
+SCHEMA_FINGERPRINT_CACHE_SIZE = 32
+_schema_fingerprint_cache = collections.OrderedDict()
+
+# Clients are shared by every session in the process, keyed by (API key hash, base URL)
+_client_registry = {}
+_client_registry_lock = threading.Lock()
+
+# Counters for new vs. reused HTTP connections across all shared clients
+_connection_stats = {"requests": 0, "new_connections": 0, "reused_connections": 0}
+_connection_stats_lock = threading.Lock()
+
+def _track_connection_on_request(request):
+    """Attach an httpcore trace hook that notes whether a new TCP connection was opened."""
+    state = {"new_connection": False}
+
+    def trace(event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            state["new_connection"] = True
+
+    request.extensions["trace"] = trace
+    request.extensions["connection_state"] = state
+
+def _track_connection_on_response(response):
+    """Record whether the request that produced this response reused a pooled connection."""
+    state = response.request.extensions.get("connection_state")
+    if state is None:
+        return
+
+    with _connection_stats_lock:
+        _connection_stats["requests"] += 1
+        if state["new_connection"]:
+            _connection_stats["new_connections"] += 1
+        else:
+            _connection_stats["reused_connections"] += 1
+
+# Rolling window of recent call latencies per purpose
+LATENCY_WINDOW_SIZE = int(os.environ.get("LATENCY_WINDOW_SIZE", "500"))
+_latency_stats = {}
+_latency_stats_lock = threading.Lock()
+
+# Token usage of the current question, shared by the pipeline threads working on it
+_usage_collector = contextvars.ContextVar("usage_collector", default=None)
+
+# Per-mode totals so combined and separate generation can be compared
+_generation_mode_stats = {}
+_generation_mode_stats_lock = threading.Lock()
+
+def _new_usage_collector():
+    """Create an empty token usage accumulator for one question."""
+    return {
+        "lock": threading.Lock(), "llm_calls": 0, "prompt_tokens": 0, "completion_tokens": 0,
+        "schema_tokens_saved": 0, "coalesced_calls": 0, "timings": {}
+    }
+
+class LLMUnavailableError(RuntimeError):
+    """Raised when a call is refused locally because the provider is throttling or unhealthy."""
+
+class CircuitOpenError(LLMUnavailableError):
+    """Raised without calling the API while the circuit breaker is open."""
+
+class LLMDeadlineError(LLMUnavailableError):
+    """Raised when a call has not completed within its deadline."""
+
+class TokenBucket:
+    """Thread-safe token bucket that hands out reservations instead of blocking inside the lock."""
+
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = float(capacity)
+        self.refill_per_second = float(refill_per_second)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    def reserve(self, amount):
+        """
+        Take tokens, going into debt if the bucket is short.
+        
+        Args:
+            amount (float): Tokens to take; requests larger than the bucket are capped at its capacity
+        
+        Returns:
+            float: Seconds the caller has to wait before its reservation is covered
+        """
+        with self.lock:
+            self._refill()
+            self.tokens -= min(amount, self.capacity)
+            return max(0.0, -self.tokens / self.refill_per_second)
+
+    def refund(self, amount):
+        """Return tokens (or take more when amount is negative) after the real cost is known."""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def available(self):
+        with self.lock:
+            self._refill()
+            return self.tokens
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute buckets shared by every session in the process."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute, max_wait):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60.0) if requests_per_minute > 0 else None
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60.0) if tokens_per_minute > 0 else None
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.paused_until = 0.0
+        self.waits = 0
+        self.total_wait_time = 0.0
+        self.rejections = 0
+
+    def acquire(self, estimated_tokens):
+        """
+        Wait until one request with the estimated token cost fits the quotas.
+        
+        Args:
+            estimated_tokens (int): Prompt plus completion tokens the request may use
+        
+        Raises:
+            LLMUnavailableError: If the wait would exceed the configured maximum
+        """
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(estimated_tokens))
+        with self.lock:
+            wait = max(wait, self.paused_until - time.monotonic())
+            if wait > self.max_wait:
+                self.rejections += 1
+            elif wait > 0:
+                self.waits += 1
+                self.total_wait_time += wait
+        
+        if wait > self.max_wait:
+            self.release(estimated_tokens)
+            raise LLMUnavailableError(
+                f"OpenAI rate limit reached; the next slot is {wait:.0f}s away. Please try again shortly."
+            )
+        if wait > 0:
+            time.sleep(wait)
+
+    def try_acquire(self, estimated_tokens):
+        """Take one request slot only if it is available right now. Returns whether it was taken."""
+        with self.lock:
+            if self.paused_until > time.monotonic():
+                return False
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(estimated_tokens))
+        if wait > 0:
+            self.release(estimated_tokens)
+            return False
+        return True
+
+    def release(self, estimated_tokens):
+        """Give back a reservation for a request that was never sent."""
+        if self.requests is not None:
+            self.requests.refund(1)
+        if self.tokens is not None:
+            self.tokens.refund(estimated_tokens)
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """Correct the token bucket once the response reports how many tokens were really used."""
+        if self.tokens is not None and actual_tokens is not None:
+            self.tokens.refund(estimated_tokens - actual_tokens)
+
+    def pause(self, seconds):
+        """Hold back every caller, e.g. for the Retry-After period of a 429."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                "waits": self.waits, "total_wait_time": self.total_wait_time, "rejections": self.rejections,
+                "paused_for": max(0.0, self.paused_until - time.monotonic())
+            }
+        stats["requests_available"] = self.requests.available() if self.requests is not None else None
+        stats["requests_capacity"] = self.requests.capacity if self.requests is not None else None
+        stats["tokens_available"] = self.tokens.available() if self.tokens is not None else None
+        stats["tokens_capacity"] = self.tokens.capacity if self.tokens is not None else None
+        return stats
+
+class CircuitBreaker:
+    """
+    Fails fast after repeated provider failures.
+    
+    Closed: calls go through. Open: calls are refused until the reset timeout passes.
+    Half-open: a single probe call is let through; its outcome closes or re-opens the circuit.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.times_opened = 0
+        self.rejected_calls = 0
+
+    def before_call(self):
+        """
+        Check whether a call may go to the API.
+        
+        Raises:
+            CircuitOpenError: While the circuit is open or a half-open probe is already running
+        """
+        with self.lock:
+            if self.state == self.OPEN:
+                remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+                if remaining > 0:
+                    self.rejected_calls += 1
+                    raise CircuitOpenError(
+                        f"OpenAI is failing repeatedly; pausing AI requests for another {remaining:.0f}s."
+                    )
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                if self.probe_in_flight:
+                    self.rejected_calls += 1
+                    raise CircuitOpenError("OpenAI is recovering; waiting for a test request to succeed.")
+                self.probe_in_flight = True
+
+    def release(self):
+        """Forget a call that was cleared but never reached the API."""
+        with self.lock:
+            self.probe_in_flight = False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                print("OpenAI circuit breaker closed")
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.probe_in_flight = False
+            if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold
+            ):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+                print(f"OpenAI circuit breaker opened after {self.consecutive_failures} consecutive failures")
+
+    def stats(self):
+        with self.lock:
+            state = self.state
+            if state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                state = self.HALF_OPEN
+            return {
+                "state": state, "consecutive_failures": self.consecutive_failures,
+                "times_opened": self.times_opened, "rejected_calls": self.rejected_calls,
+                "retry_in": max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at)) if state == self.OPEN else 0.0
+            }
+
+# Shared by every session so concurrent users back off together
+_rate_limiter = RateLimiter(OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT, OPENAI_RATE_LIMIT_MAX_WAIT)
+_circuit_breaker = CircuitBreaker(CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_RESET_TIMEOUT)
+_retry_stats = {"retries": 0, "retry_after_honored": 0, "gave_up": 0}
+_retry_stats_lock = threading.Lock()
+
+# Threads for hedged calls; the original and the duplicate both run here so the caller can wait on either
+_hedge_executor = ThreadPoolExecutor(max_workers=LLM_PIPELINE_WORKERS * 2, thread_name_prefix="llm-hedge")
+_tail_latency_stats = {
+    "hedge_eligible_calls": 0, "hedges_fired": 0, "hedges_skipped": 0, "hedge_wins": 0,
+    "time_saved": 0.0, "measured_wins": 0, "hedge_extra_tokens": 0, "deadlines_exceeded": 0
+}
+_tail_latency_stats_lock = threading.Lock()
+
+# Identical requests currently in flight, keyed by (client, request hash), so later callers share the first one's result
+_inflight_calls = {}
+_inflight_calls_lock = threading.Lock()
+_coalescing_stats = {"leader_calls": 0, "coalesced_calls": 0}
+
+def _is_retryable_error(error):
+    """Throttling, timeouts, dropped connections and server errors are worth retrying; bad requests are not."""
+    if isinstance(error, (RateLimitError, APIConnectionError)):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code in (408, 409) or (error.status_code or 0) >= 500
+    return False
+
+def _retry_after_seconds(error):
+    """Read the server's requested delay from Retry-After / retry-after-ms headers, if any."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+        try:
+            retry_date = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            # A malformed header must not break the retry path; fall back to our own backoff
+            return None
+        if retry_date is not None:
+            return max(0.0, retry_date.timestamp() - time.time())
+    return None
+
+def _estimate_request_tokens(params):
+    """Prompt tokens plus the completion budget, which is what tokens-per-minute quotas count."""
+    prompt_tokens = sum(estimate_tokens(message.get("content") or "") for message in params.get("messages", []))
+    return prompt_tokens + (params.get("max_tokens") or 256)
+
+def get_resilience_stats():
+    """
+    Report the shared rate limiter, circuit breaker and retry counters.
+    
+    Returns:
+        dict: "limiter", "breaker" and "retries" sections
+    """
+    with _retry_stats_lock:
+        retries = dict(_retry_stats)
+    return {"limiter": _rate_limiter.stats(), "breaker": _circuit_breaker.stats(), "retries": retries}
+
+class _InflightCall:
+    """One in-flight request that other callers can wait on, replaying its streamed chunks as they arrive."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.chunks = []
+        self.done = False
+        self.response = None
+        self.error = None
+
+    def publish(self, delta):
+        with self.condition:
+            self.chunks.append(delta)
+            self.condition.notify_all()
+
+    def finish(self, response=None, error=None):
+        with self.condition:
+            self.response = response
+            self.error = error
+            self.done = True
+            self.condition.notify_all()
+
+    def follow(self, on_delta=None):
+        """Block until the request finishes, passing each chunk to on_delta. Returns the response or raises its error."""
+        seen = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.done or len(self.chunks) > seen)
+                new_chunks = self.chunks[seen:]
+                finished = self.done
+            seen += len(new_chunks)
+            if on_delta is not None:
+                for delta in new_chunks:
+                    on_delta(delta)
+            if finished:
+                break
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+def _request_key(client, params):
+    """Identify a request by client, model and every parameter, so only truly identical calls are shared."""
+    payload = json.dumps(params, sort_keys=True, default=str)
+    return id(client), hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def get_coalescing_stats():
+    """
+    Report how many LLM calls were answered by an identical request already in flight.
+    
+    Returns:
+        dict: Leader (actually sent) and coalesced call counts plus the share of calls coalesced
+    """
+    with _inflight_calls_lock:
+        stats = dict(_coalescing_stats)
+        stats["in_flight"] = len(_inflight_calls)
+    total = stats["leader_calls"] + stats["coalesced_calls"]
+    stats["coalesced_ratio"] = stats["coalesced_calls"] / total if total else 0.0
+    return stats
+
+def _chat_completion(client, purpose, on_delta=None, **params):
+    """
+    Create a chat completion, sharing one request among identical calls made at the same time.
+    
+    The first caller sends the request; identical calls from any session that arrive while it is in flight
+    wait for its response (and receive its streamed chunks) instead of sending their own.
+    
+    Args:
+        client (OpenAI): Shared client from get_openai_client
+        purpose (str): Which call this is ("generate_sql", "explain", ...), used for latency tracking
+        on_delta (callable, optional): Called with each text chunk of the response as it arrives
+        **params: Parameters for chat.completions.create
+    
+    Returns:
+        ChatCompletion: The response, possibly shared with other callers
+    """
+    key = _request_key(client, params)
+    with _inflight_calls_lock:
+        inflight = _inflight_calls.get(key)
+        is_leader = inflight is None
+        if is_leader:
+            inflight = _InflightCall()
+            _inflight_calls[key] = inflight
+            _coalescing_stats["leader_calls"] += 1
+        else:
+            _coalescing_stats["coalesced_calls"] += 1
+    
+    if not is_leader:
+        start_time = time.time()
+        response = inflight.follow(on_delta)
+        collector = _usage_collector.get()
+        if collector is not None:
+            with collector["lock"]:
+                collector["coalesced_calls"] += 1
+                collector["timings"][purpose] = {"first_token_time": None, "total_time": time.time() - start_time}
+        return response
+    
+    def relay(delta):
+        inflight.publish(delta)
+        on_delta(delta)
+    
+    try:
+        response = _resilient_chat_completion(client, purpose, relay if on_delta is not None else None, **params)
+    except BaseException as e:
+        inflight.finish(error=e)
+        raise
+    finally:
+        with _inflight_calls_lock:
+            _inflight_calls.pop(key, None)
+    inflight.finish(response=response)
+    return response
+
+def _resilient_chat_completion(client, purpose, on_delta=None, **params):
+    """
+    Send a chat completion, recording token usage and latency for the current question.
+    
+    Calls pass through the shared rate limiter and circuit breaker, and throttled, timed out or 5xx
+    attempts are retried with jittered exponential backoff that honors Retry-After. Streamed calls are
+    only retried until their first chunk has been handed to on_delta. The whole call, retries included,
+    must finish within LLM_CALL_DEADLINE, and slow non-streamed attempts may be hedged.
+    
+    Args:
+        client (OpenAI): Shared client from get_openai_client
+        purpose (str): Which call this is ("generate_sql", "explain", ...), used for latency tracking
+        on_delta (callable, optional): Streams the completion and calls this with each text chunk as it arrives
+        **params: Parameters for chat.completions.create
+    
+    Returns:
+        ChatCompletion: The response. Streamed responses are reassembled into the same shape.
+    
+    Raises:
+        LLMUnavailableError: If the call was refused by the rate limiter or the open circuit breaker,
+            or LLMDeadlineError if it ran past its deadline
+    """
+    start_time = time.time()
+    deadline = start_time + LLM_CALL_DEADLINE
+    estimated_tokens = _estimate_request_tokens(params)
+    progress = {"first_token_time": None}
+    
+    attempt = 0
+    while True:
+        _circuit_breaker.before_call()
+        try:
+            _rate_limiter.acquire(estimated_tokens)
+        except LLMUnavailableError:
+            _circuit_breaker.release()
+            raise
+        
+        try:
+            if on_delta is None:
+                response, usage = _hedged_completion(client, purpose, params, estimated_tokens, deadline)
+            else:
+                response, usage = _create_completion(client, on_delta, params, start_time, progress, deadline)
+        except LLMDeadlineError:
+            _circuit_breaker.record_failure()
+            with _tail_latency_stats_lock:
+                _tail_latency_stats["deadlines_exceeded"] += 1
+            raise
+        except Exception as e:
+            if not _is_retryable_error(e):
+                # The provider answered (e.g. a 400), so this says nothing about its health
+                _circuit_breaker.record_success()
+                raise
+            _circuit_breaker.record_failure()
+            
+            retry_after = _retry_after_seconds(e)
+            if retry_after is not None and isinstance(e, RateLimitError):
+                _rate_limiter.pause(retry_after)
+            delay = random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            if attempt >= OPENAI_MAX_RETRIES or progress["first_token_time"] is not None:
+                with _retry_stats_lock:
+                    _retry_stats["gave_up"] += 1
+                raise
+            if time.time() + delay >= deadline:
+                with _tail_latency_stats_lock:
+                    _tail_latency_stats["deadlines_exceeded"] += 1
+                raise LLMDeadlineError(f"The AI request did not finish within {LLM_CALL_DEADLINE:.0f}s.") from e
+            
+            with _retry_stats_lock:
+                _retry_stats["retries"] += 1
+                if retry_after is not None:
+                    _retry_stats["retry_after_honored"] += 1
+            print(f"OpenAI {purpose} call failed ({type(e).__name__}); retry {attempt + 1} in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+            continue
+        
+        _circuit_breaker.record_success()
+        if usage is not None:
+            _rate_limiter.settle(estimated_tokens, getattr(usage, "total_tokens", None))
+        break
+    
+    first_token_time = progress["first_token_time"]
+    
+    total_time = time.time() - start_time
+    _record_latency(purpose, total_time, first_token_time)
+    
+    collector = _usage_collector.get()
+    if collector is not None:
+        with collector["lock"]:
+            collector["llm_calls"] += 1
+            if usage is not None:
+                collector["prompt_tokens"] += usage.prompt_tokens or 0
+                collector["completion_tokens"] += usage.completion_tokens or 0
+            collector["timings"][purpose] = {"first_token_time": first_token_time, "total_time": total_time}
+    return response
+
+def _create_completion(client, on_delta, params, start_time, progress, deadline):
+    """Make one chat completion request, streaming it to on_delta when given. Returns (response, usage)."""
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise LLMDeadlineError(f"The AI request did not finish within {LLM_CALL_DEADLINE:.0f}s.")
+    
+    if on_delta is None:
+        response = client.chat.completions.create(timeout=remaining, **params)
+        return response, getattr(response, "usage", None)
+    
+    chunks = []
+    usage = None
+    stream = client.chat.completions.create(stream=True, stream_options={"include_usage": True}, timeout=remaining, **params)
+    for chunk in stream:
+        # The HTTP timeout applies per read, so a slow trickle of chunks is cut off here
+        if time.time() > deadline:
+            stream.close()
+            raise LLMDeadlineError(f"The AI request did not finish within {LLM_CALL_DEADLINE:.0f}s.")
+        if chunk.usage is not None:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            if progress["first_token_time"] is None:
+                progress["first_token_time"] = time.time() - start_time
+            chunks.append(delta)
+            on_delta(delta)
+    message = types.SimpleNamespace(content="".join(chunks))
+    response = types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=usage)
+    return response, usage
+
+def _hedge_delay(purpose):
+    """Seconds after which a call of this kind is hedged, or None when hedging is off or data is short."""
+    if LLM_HEDGE_PERCENTILE <= 0:
+        return None
+    with _latency_stats_lock:
+        window = _latency_stats.get(purpose)
+        totals = list(window["total"]) if window else []
+    if len(totals) < LLM_HEDGE_MIN_SAMPLES:
+        return None
+    return _percentile(totals, LLM_HEDGE_PERCENTILE)
+
+def _hedged_completion(client, purpose, params, estimated_tokens, deadline):
+    """
+    Make one non-streamed request, sending a duplicate if it is slower than the hedge threshold.
+    
+    The first successful response wins. The sync client cannot abort a request that is already on the
+    wire, so the slower one runs to completion in the background and its result is discarded; its
+    latency and tokens are still recorded so the extra cost of hedging is visible.
+    
+    Returns:
+        tuple: (response, usage) of the winning request
+    """
+    hedge_delay = _hedge_delay(purpose)
+    if hedge_delay is None:
+        return _create_completion(client, None, params, time.time(), {"first_token_time": None}, deadline)
+    
+    with _tail_latency_stats_lock:
+        _tail_latency_stats["hedge_eligible_calls"] += 1
+    started_at = time.time()
+    primary = _hedge_executor.submit(_create_completion, client, None, params, started_at, {"first_token_time": None}, deadline)
+    done, _ = wait_for_futures([primary], timeout=min(hedge_delay, max(0.0, deadline - started_at)))
+    if done or time.time() >= deadline or not _rate_limiter.try_acquire(estimated_tokens):
+        if not done:
+            with _tail_latency_stats_lock:
+                _tail_latency_stats["hedges_skipped"] += 1
+        return _wait_for_first_success([primary], deadline)[0].result()
+    
+    with _tail_latency_stats_lock:
+        _tail_latency_stats["hedges_fired"] += 1
+    hedge = _hedge_executor.submit(_create_completion, client, None, params, time.time(), {"first_token_time": None}, deadline)
+    winner, losers = _wait_for_first_success([primary, hedge], deadline)
+    won_at = time.time()
+    
+    for loser in losers:
+        loser.cancel()
+        loser.add_done_callback(functools.partial(
+            _record_hedge_loser, estimated_tokens=estimated_tokens,
+            time_saved=(lambda: time.time() - won_at) if loser is primary else None
+        ))
+    if winner is hedge:
+        with _tail_latency_stats_lock:
+            _tail_latency_stats["hedge_wins"] += 1
+    return winner.result()
+
+def _wait_for_first_success(futures, deadline):
+    """
+    Wait for the first of several request futures to succeed.
+    
+    Returns:
+        tuple: (winning future, list of futures still running)
+    
+    Raises:
+        LLMDeadlineError: If none succeeded before the deadline; otherwise the last request's error
+    """
+    pending = set(futures)
+    error = None
+    while pending:
+        done, pending = wait_for_futures(pending, timeout=max(0.0, deadline - time.time()), return_when=FIRST_COMPLETED)
+        if not done:
+            raise LLMDeadlineError(f"The AI request did not finish within {LLM_CALL_DEADLINE:.0f}s.")
+        for future in done:
+            if future.exception() is None:
+                return future, list(pending)
+            error = future.exception()
+    raise error
+
+def _record_hedge_loser(future, estimated_tokens, time_saved=None):
+    """Account for the discarded request of a hedged pair once it finishes."""
+    if future.cancelled() or future.exception() is not None:
+        _rate_limiter.settle(estimated_tokens, 0)
+        return
+    
+    usage = future.result()[1]
+    actual_tokens = getattr(usage, "total_tokens", None) if usage is not None else None
+    _rate_limiter.settle(estimated_tokens, actual_tokens)
+    with _tail_latency_stats_lock:
+        _tail_latency_stats["hedge_extra_tokens"] += actual_tokens or 0
+        if time_saved is not None:
+            # The original finished after the hedge, so the difference is latency the user did not wait for
+            _tail_latency_stats["time_saved"] += time_saved()
+            _tail_latency_stats["measured_wins"] += 1
+
+def get_tail_latency_stats():
+    """
+    Report deadline and hedging counters so the hedge percentile can be tuned against its extra cost.
+    
+    Returns:
+        dict: Hedge eligibility, fire and win counts, fire rate, latency saved by wins whose original
+            eventually completed, extra tokens spent on discarded requests and deadlines exceeded
+    """
+    with _tail_latency_stats_lock:
+        stats = dict(_tail_latency_stats)
+    stats["fire_rate"] = stats["hedges_fired"] / stats["hedge_eligible_calls"] if stats["hedge_eligible_calls"] else 0.0
+    stats["avg_time_saved"] = stats["time_saved"] / stats["measured_wins"] if stats["measured_wins"] else 0.0
+    return stats
+
+def _record_latency(purpose, total_time, first_token_time=None):
+    """Add one call's latency to the rolling per-purpose window."""
+    with _latency_stats_lock:
+        window = _latency_stats.setdefault(purpose, {
+            "total": collections.deque(maxlen=LATENCY_WINDOW_SIZE),
+            "first_token": collections.deque(maxlen=LATENCY_WINDOW_SIZE)
+        })
+        window["total"].append(total_time)
+        if first_token_time is not None:
+            window["first_token"].append(first_token_time)
+
+def _percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def get_latency_stats():
+    """
+    Summarize recent LLM call latency per purpose.
+    
+    Returns:
+        dict: Purpose mapped to call count and p50/p95 time-to-complete, plus p50/p95
+            time-to-first-token for streamed calls
+    """
+    with _latency_stats_lock:
+        snapshot = {purpose: {name: list(values) for name, values in window.items()} for purpose, window in _latency_stats.items()}
+    
+    summary = {}
+    for purpose, window in snapshot.items():
+        stats = {
+            "calls": len(window["total"]),
+            "p50_total": _percentile(window["total"], 0.5),
+            "p95_total": _percentile(window["total"], 0.95)
+        }
+        if window["first_token"]:
+            stats["p50_first_token"] = _percentile(window["first_token"], 0.5)
+            stats["p95_first_token"] = _percentile(window["first_token"], 0.95)
+        summary[purpose] = stats
+    return summary
+
+def _record_generation_metrics(metrics):
+    """Add one question's metrics to the per-mode totals."""
+    with _generation_mode_stats_lock:
+        totals = _generation_mode_stats.setdefault(metrics["mode"], {
+            "questions": 0, "llm_calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "wall_time": 0.0
+        })
+        totals["questions"] += 1
+        for field in ("llm_calls", "prompt_tokens", "completion_tokens", "wall_time"):
+            totals[field] += metrics[field]
+
+def get_generation_mode_stats():
+    """
+    Summarize token use and latency per generation mode.
+    
+    Returns:
+        dict: Mode name mapped to question count and average calls, tokens and wall time per question
+    """
+    with _generation_mode_stats_lock:
+        snapshot = {mode: dict(totals) for mode, totals in _generation_mode_stats.items()}
+    
+    summary = {}
+    for mode, totals in snapshot.items():
+        questions = totals["questions"]
+        summary[mode] = {
+            "questions": questions,
+            "avg_llm_calls": totals["llm_calls"] / questions,
+            "avg_prompt_tokens": totals["prompt_tokens"] / questions,
+            "avg_completion_tokens": totals["completion_tokens"] / questions,
+            "avg_wall_time": totals["wall_time"] / questions
+        }
+    return summary
+
+def get_openai_client(api_key=None, base_url=None):
+    """
+    Return a long-lived OpenAI client shared across calls and Streamlit sessions.
+    
+    Args:
+        api_key (str, optional): OpenAI API key to use. If not provided, falls back to environment variable.
+        base_url (str, optional): API base URL. If not provided, falls back to OPENAI_BASE_URL or the SDK default.
+    
+    Returns:
+        OpenAI: Client backed by a keep-alive HTTP connection pool
+    """
+    api_key = api_key or os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OpenAI API key not found. Please provide an API key.")
+    base_url = base_url or os.environ.get("OPENAI_BASE_URL")
+    
+    registry_key = (hashlib.sha256(api_key.encode('utf-8')).hexdigest(), base_url)
+    with _client_registry_lock:
+        client = _client_registry.get(registry_key)
+        if client is None:
+            http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+                ),
+                timeout=httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+                event_hooks={
+                    "request": [_track_connection_on_request],
+                    "response": [_track_connection_on_response]
+                }
+            )
+            # Retries are handled by _chat_completion so they respect the shared limiter and breaker
+            client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+            _client_registry[registry_key] = client
+            print(f"Created shared OpenAI client ({len(_client_registry)} client(s) in registry)")
+    return client
+
+def close_openai_clients():
+    """Close every shared OpenAI client and release its connection pool."""
+    with _client_registry_lock:
+        for client in _client_registry.values():
+            client.close()
+        _client_registry.clear()
+
+def get_openai_connection_stats():
+    """
+    Report how many OpenAI requests reused a pooled connection versus opening a new one.
+    
+    Returns:
+        dict: Request, new-connection and reused-connection counts plus the reuse ratio
+    """
+    with _connection_stats_lock:
+        stats = dict(_connection_stats)
+    with _client_registry_lock:
+        stats["clients"] = len(_client_registry)
+    stats["reuse_ratio"] = stats["reused_connections"] / stats["requests"] if stats["requests"] else 0.0
+    return stats
+
+class PersistentCache:
+    """Thread-safe key/value cache in a SQLite file with TTL expiry and LRU eviction."""
+    
+    def __init__(self, path, ttl=GENERATION_CACHE_TTL, max_entries=GENERATION_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        # WAL lets several app processes share the file without blocking readers
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                scope TEXT,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_accessed REAL NOT NULL,
+                hit_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (namespace, key)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_entries_last_accessed ON cache_entries(last_accessed)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_entries_scope ON cache_entries(namespace, scope)")
+    
+    def get(self, namespace, key):
+        """Return the cached value, or None if it is missing or older than the TTL."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                (namespace, key)
+            ).fetchone()
+            
+            if row is None:
+                self.misses += 1
+                return None
+            
+            if now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key))
+                self.misses += 1
+                return None
+            
+            self._conn.execute(
+                "UPDATE cache_entries SET last_accessed = ?, hit_count = hit_count + 1 WHERE namespace = ? AND key = ?",
+                (now, namespace, key)
+            )
+            self.hits += 1
+        return json.loads(row[0])
+    
+    def set(self, namespace, key, value, scope=None):
+        """Store a JSON-serializable value and evict the least recently used entries over the size limit."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache_entries (namespace, key, scope, value, created_at, last_accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (namespace, key, scope, json.dumps(value), now, now)
+            )
+            
+            overflow = self._conn.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM cache_entries WHERE rowid IN "
+                    "(SELECT rowid FROM cache_entries ORDER BY last_accessed LIMIT ?)",
+                    (overflow,)
+                )
+                self.evictions += overflow
+    
+    def delete(self, namespace, key):
+        """Remove one entry, if present."""
+        with self._lock:
+            self._conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key))
+    
+    def values_in_scope(self, namespace, scope):
+        """Return every unexpired value stored under a scope."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT value FROM cache_entries WHERE namespace = ? AND scope = ? AND created_at >= ?",
+                (namespace, scope, time.time() - self.ttl)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+    
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._conn.execute("DELETE FROM cache_entries")
+    
+    def stats(self):
+        """Return entry count and hit, miss and eviction counters."""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+            return {
+                "entries": entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "max_entries": self.max_entries,
+                "ttl": self.ttl
+            }
+
+_generation_cache = None
+_generation_cache_lock = threading.Lock()
+
+def get_generation_cache():
+    """
+    Return the process-wide persistent generation cache, opening it on first use.
+    
+    Returns:
+        PersistentCache: The shared cache, or None if the cache file cannot be opened
+    """
+    global _generation_cache
+    with _generation_cache_lock:
+        if _generation_cache is None:
+            try:
+                _generation_cache = PersistentCache(GENERATION_CACHE_PATH)
+                print(f"Opened generation cache at {GENERATION_CACHE_PATH}")
+            except Exception as e:
+                print(f"Generation cache disabled: {str(e)}")
+                return None
+    return _generation_cache
+
+def schema_fingerprint(schema_info):
+    """
+    Compute a stable hash of the schema so cached results are tied to the schema they were built for.
+    
+    Args:
+        schema_info (dict or str): Database schema information
+    
+    Returns:
+        str: Hex digest of the schema
+    """
+    if not isinstance(schema_info, dict):
+        return hashlib.sha256(str(schema_info).encode('utf-8')).hexdigest()
+    
+    # Serializing a large schema costs far more than rendering it, so fingerprints are memoized per dict object
+    with _schema_render_cache_lock:
+        entry = _schema_fingerprint_cache.get(id(schema_info))
+        if entry is not None and entry[0] is schema_info:
+            _schema_fingerprint_cache.move_to_end(id(schema_info))
+            return entry[1]
+    
+    canonical = json.dumps(schema_info, sort_keys=True, default=str)
+    fingerprint = hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+    with _schema_render_cache_lock:
+        _schema_fingerprint_cache[id(schema_info)] = (schema_info, fingerprint)
+        while len(_schema_fingerprint_cache) > SCHEMA_FINGERPRINT_CACHE_SIZE:
+            _schema_fingerprint_cache.popitem(last=False)
+    return fingerprint
+
+def normalize_question(question):
+    """Lowercase the question and strip whitespace and trailing punctuation so trivial variants share a cache key."""
+    return re.sub(r'\s+', ' ', question.strip().lower()).rstrip('?.!; ')
+
+def _generation_scope(schema_info):
+    """Build the cache scope shared by questions asked against the same schema, model and prompt."""
+    return f"{schema_fingerprint(schema_info)}:{OPENAI_MODEL}:{SQL_PROMPT_VERSION}:{SCHEMA_PROMPT_STYLE}"
+
+def normalize_sql(sql_query, lowercase=True):
+    """
+    Canonicalize SQL text so formatting-only differences share a cache key.
+    
+    Comments, trailing semicolons and repeated whitespace are removed and everything outside string
+    literals and quoted identifiers is lowercased, unless lowercase is False (for MySQL, whose table
+    names can be case-sensitive).
+    """
+    parts = re.split(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""", sql_query)
+    for index in range(0, len(parts), 2):
+        code = re.sub(r"--[^\n]*|/\*.*?\*/", " ", parts[index], flags=re.DOTALL)
+        code = re.sub(r"\s+", " ", code)
+        parts[index] = code.lower() if lowercase else code
+    normalized = "".join(parts).strip()
+    return re.sub(r"\s*;\s*$", "", normalized).strip()
+
+def _annotation_cache_key(sql_query, schema_info):
+    """Cache key and scope for explanations and follow-ups of a query against a schema."""
+    scope = f"{schema_fingerprint(schema_info)}:{OPENAI_MODEL}:{ANNOTATION_PROMPT_VERSION}"
+    return hashlib.sha256(f"{scope}\n{normalize_sql(sql_query)}".encode('utf-8')).hexdigest(), scope
+
+def get_cached_annotation(namespace, sql_query, schema_info):
+    """
+    Look up a cached explanation ("explanation") or follow-up list ("followups") for a query.
+    
+    Returns:
+        The cached value, or None on a miss or when the cache is unavailable
+    """
+    cache = get_generation_cache()
+    if cache is None:
+        return None
+    try:
+        cached = cache.get(namespace, _annotation_cache_key(sql_query, schema_info)[0])
+    except Exception as e:
+        print(f"Error reading {namespace} cache: {str(e)}")
+        cached = None
+    with _annotation_cache_stats_lock:
+        _annotation_cache_stats[namespace]["hits" if cached is not None else "misses"] += 1
+    return cached["value"] if cached is not None else None
+
+def store_annotation(namespace, sql_query, schema_info, value):
+    """Write an explanation or follow-up list for a query to the shared cache."""
+    cache = get_generation_cache()
+    if cache is None:
+        return
+    key, scope = _annotation_cache_key(sql_query, schema_info)
+    try:
+        cache.set(namespace, key, {"value": value}, scope=scope)
+    except Exception as e:
+        print(f"Error writing {namespace} cache: {str(e)}")
+
+def get_annotation_cache_stats():
+    """
+    Report cache hits and misses for query explanations and follow-up questions.
+    
+    Returns:
+        dict: "explanation" and "followups" mapped to their hit and miss counts
+    """
+    with _annotation_cache_stats_lock:
+        return {namespace: dict(counts) for namespace, counts in _annotation_cache_stats.items()}
+
+def _generation_cache_key(user_input, scope):
+    """Build the cache key for a question within a scope."""
+    return hashlib.sha256(f"{scope}:{normalize_question(user_input)}".encode('utf-8')).hexdigest()
+
+# Words that carry no meaning for matching questions against each other
+_QUESTION_STOPWORDS = frozenset("""
+a an the of in on at for to by with and or from per me my our us i we you your their them it its
+all each every any show list display give get find fetch return tell what which who whose whom
+is are was were be been has have had do does did how please can could would should that this
+these those there where when
+""".split())
+
+# Common rewordings mapped to one canonical word
+_QUESTION_SYNONYMS = {
+    "much": "total", "sum": "total",
+    "many": "count", "number": "count",
+    "spend": "spent", "spending": "spent",
+    "highest": "top", "most": "top", "biggest": "top", "largest": "top", "best": "top",
+    "lowest": "bottom", "least": "bottom", "smallest": "bottom", "worst": "bottom",
+    "client": "customer", "buyer": "customer",
+    "purchase": "order",
+    "item": "product"
+}
+
+def _stem_word(word):
+    """Strip common English suffixes so plural and -ing forms compare equal."""
+    if len(word) > 5 and word.endswith("ing"):
+        return word[:-3]
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+def question_shingles(question):
+    """
+    Reduce a question to the canonical word shingles and numbers used for similarity matching.
+    
+    Args:
+        question (str): Natural language question
+    
+    Returns:
+        tuple: (frozenset of word shingles, tuple of numbers in the question)
+    """
+    words = re.findall(r"[a-z0-9_]+", question.lower())
+    numbers = tuple(w for w in words if w.isdigit())
+    shingles = set()
+    for word in words:
+        if word in _QUESTION_STOPWORDS or word.isdigit():
+            continue
+        word = _stem_word(word)
+        shingles.add(_QUESTION_SYNONYMS.get(word, word))
+    return frozenset(shingles), numbers
+
+# MinHash LSH layout: 12 bands of 5 rows puts the candidate threshold near 0.6 Jaccard
+_MINHASH_BANDS = 12
+_MINHASH_ROWS_PER_BAND = 5
+_MINHASH_PRIME = (1 << 61) - 1
+
+def _minhash_permutations(count, seed=20240501):
+    """Build fixed hash permutations so signatures are comparable across indexes and restarts."""
+    rng = random.Random(seed)
+    return [(rng.randrange(1, _MINHASH_PRIME), rng.randrange(0, _MINHASH_PRIME)) for _ in range(count)]
+
+_MINHASH_PERMUTATIONS = _minhash_permutations(_MINHASH_BANDS * _MINHASH_ROWS_PER_BAND)
+
+@functools.lru_cache(maxsize=100000)
+def _minhash_values(shingle):
+    """Hash one shingle under every permutation; cached because the vocabulary is small and reused."""
+    value = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+    return tuple((a * value + b) % _MINHASH_PRIME for a, b in _MINHASH_PERMUTATIONS)
+
+class SimilarQuestionIndex:
+    """
+    In-memory MinHash LSH index over previously answered questions for one schema scope.
+    
+    Holds at most max_entries questions and drops the least recently used beyond that. Entries can
+    outlive the generation cache they were loaded from, so callers check a match is still cached.
+    """
+    
+    def __init__(self, max_entries=GENERATION_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()   # (shingles, numbers) -> (question, sql)
+        self._buckets = [dict() for _ in range(_MINHASH_BANDS)]
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def _signature(self, shingles):
+        return [min(values) for values in zip(*(_minhash_values(shingle) for shingle in shingles))]
+    
+    def _band_keys(self, signature):
+        rows = _MINHASH_ROWS_PER_BAND
+        return [tuple(signature[band * rows:(band + 1) * rows]) for band in range(_MINHASH_BANDS)]
+    
+    def add(self, question, sql_query):
+        """Index a question and the SQL that answered it."""
+        shingles, numbers = question_shingles(question)
+        if not shingles:
+            return
+        entry_key = (shingles, numbers)
+        
+        with self._lock:
+            is_new = entry_key not in self._entries
+            self._entries[entry_key] = (question, sql_query)
+            self._entries.move_to_end(entry_key)
+            if is_new:
+                for band, band_key in enumerate(self._band_keys(self._signature(shingles))):
+                    self._buckets[band].setdefault(band_key, []).append(entry_key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+    
+    def remove(self, question):
+        """Drop a question from the index, e.g. once its generation cache entry has expired."""
+        shingles, numbers = question_shingles(question)
+        with self._lock:
+            if (shingles, numbers) in self._entries:
+                self._drop((shingles, numbers))
+    
+    def _drop(self, entry_key):
+        del self._entries[entry_key]
+        for band, band_key in enumerate(self._band_keys(self._signature(entry_key[0]))):
+            bucket = self._buckets[band].get(band_key)
+            if bucket is None:
+                continue
+            bucket.remove(entry_key)
+            if not bucket:
+                del self._buckets[band][band_key]
+    
+    def find(self, question, threshold):
+        """
+        Find the most similar indexed question.
+        
+        Args:
+            question (str): Natural language question
+            threshold (float): Minimum Jaccard similarity of the word shingles
+        
+        Returns:
+            dict: 'question', 'sql' and 'similarity' of the best match, or None
+        """
+        shingles, numbers = question_shingles(question)
+        if not shingles:
+            return None
+        
+        with self._lock:
+            exact = self._entries.get((shingles, numbers))
+            if exact is not None:
+                self._entries.move_to_end((shingles, numbers))
+                return {"question": exact[0], "sql": exact[1], "similarity": 1.0}
+            
+            # Only questions sharing at least two LSH bands are verified; at the default threshold this
+            # keeps recall above 90% while skipping most weakly related candidates
+            band_hits = collections.Counter(itertools.chain.from_iterable(
+                self._buckets[band].get(band_key, ())
+                for band, band_key in enumerate(self._band_keys(self._signature(shingles)))
+            ))
+            candidates = [candidate for candidate, hits in band_hits.items() if hits >= 2]
+            
+            best = None
+            best_score = threshold
+            size = len(shingles)
+            for candidate_shingles, candidate_numbers in candidates:
+                # Different numbers ("top 5" vs "top 10") always need different SQL
+                if candidate_numbers != numbers:
+                    continue
+                # The size ratio bounds the Jaccard score, so most candidates are skipped without a set operation
+                candidate_size = len(candidate_shingles)
+                if min(size, candidate_size) < best_score * max(size, candidate_size):
+                    continue
+                overlap = len(shingles & candidate_shingles)
+                score = overlap / (size + candidate_size - overlap)
+                if score >= best_score:
+                    best, best_score = (candidate_shingles, candidate_numbers), score
+            
+            if best is None:
+                return None
+            matched_question, matched_sql = self._entries[best]
+            self._entries.move_to_end(best)
+        return {"question": matched_question, "sql": matched_sql, "similarity": best_score}
+
+_similar_indexes = {}
+_similar_indexes_lock = threading.Lock()
+
+def get_similar_question_index(scope):
+    """
+    Return the similarity index for a schema scope, loading it from the generation cache on first use.
+    
+    Args:
+        scope (str): Generation scope (schema fingerprint, model and prompt version)
+    
+    Returns:
+        SimilarQuestionIndex: The shared index for the scope
+    """
+    with _similar_indexes_lock:
+        index = _similar_indexes.get(scope)
+        if index is not None:
+            return index
+        index = SimilarQuestionIndex()
+        _similar_indexes[scope] = index
+    
+    cache = get_generation_cache()
+    if cache is not None:
+        try:
+            for value in cache.values_in_scope("sql", scope):
+                index.add(value["question"], value["sql"])
+            print(f"Loaded {len(index)} previously answered questions into the similarity index")
+        except Exception as e:
+            print(f"Error loading similarity index: {str(e)}")
+    return index
+
+# Question shapes the fast path answers. Names are matched loosely here and resolved against the schema later.
+_FAST_PATH_VERBS = r"(?:(?:can you |please )?(?:show|list|display|get|give|fetch|find|return|view|see)(?: me)? )?"
+_FAST_PATH_NAME = r"[a-z0-9_ ]+?"
+_FAST_PATH_PATTERNS = [
+    ("top_n", re.compile(
+        rf"^{_FAST_PATH_VERBS}(?:the )?(?P<direction>top|bottom) (?P<n>\d+) (?P<table>{_FAST_PATH_NAME}) "
+        rf"(?:by|ordered by|sorted by|ranked by) (?P<column>{_FAST_PATH_NAME})$"
+    )),
+    ("group_count", re.compile(
+        rf"^(?:{_FAST_PATH_VERBS}(?:the )?(?:count|number) of|count(?: the| all)?|how many) (?P<table>{_FAST_PATH_NAME}) "
+        rf"(?:are there )?(?:by|per|for each|for every|in each|grouped by|group by) (?P<column>{_FAST_PATH_NAME})$"
+    )),
+    ("group_count", re.compile(
+        rf"^{_FAST_PATH_VERBS}(?P<table>{_FAST_PATH_NAME}) count(?:s)? (?:by|per|for each) (?P<column>{_FAST_PATH_NAME})$"
+    )),
+    ("count", re.compile(
+        rf"^(?:how many|count(?: the| all)?|(?:what is |show me )?the (?:total )?(?:number|count) of|(?:total )?number of) "
+        rf"(?P<table>{_FAST_PATH_NAME})(?: are there| do we have| are in the database| exist| in total| total)?$"
+    )),
+    ("list", re.compile(
+        rf"^{_FAST_PATH_VERBS}(?:(?:all|every|the) )*(?:of the )?(?P<table>{_FAST_PATH_NAME})"
+        rf"(?: records| rows| entries| data| table)?$"
+    )),
+]
+
+_SQL_RESERVED_WORDS = frozenset("""
+select from where group order by limit table index key user values default check primary foreign references
+""".split())
+
+# Rule-based fast path counters shared across sessions
+_fast_path_stats = {"attempts": 0, "hits": 0, "match_time": 0.0, "intents": {}}
+_fast_path_stats_lock = threading.Lock()
+
+# Identifier quote character per sqlglot dialect; the others use ANSI double quotes
+_IDENTIFIER_QUOTES = {"mysql": "`"}
+
+def _quote_identifier(name, dialect="sqlite"):
+    """Quote a table or column name for the dialect only when it is not a plain identifier."""
+    plain = (re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", name) is not None and name.lower() not in _SQL_RESERVED_WORDS
+             # PostgreSQL folds unquoted names to lower case
+             and not (dialect == "postgres" and name != name.lower()))
+    if plain and sqlglot is not None:
+        # sqlglot also knows the dialect's own reserved words, such as MySQL's RANK
+        plain = exp.to_identifier(name).sql(dialect=dialect) == name
+    if plain:
+        return name
+    quote = _IDENTIFIER_QUOTES.get(dialect, '"')
+    return quote + name.replace(quote, quote * 2) + quote
+
+def _resolve_name(phrase, names):
+    """
+    Match a phrase from a question to one of the given table or column names.
+    
+    Args:
+        phrase (str): Words from the question, e.g. "order items" or "loyalty points"
+        names (iterable): Candidate identifiers
+    
+    Returns:
+        tuple: (name, confidence) for an unambiguous match, otherwise (None, 0.0). Exact word matches
+            score 1.0, matches after synonym mapping 0.9 and a unique partial match 0.85.
+    """
+    words = [word for word in re.findall(r"[a-z0-9]+", phrase.lower()) if word not in ("the", "all", "every")]
+    if not words:
+        return None, 0.0
+    phrase_tokens = {_stem_word(word) for word in words}
+    synonym_tokens = {_stem_word(_QUESTION_SYNONYMS.get(_stem_word(word), _stem_word(word))) for word in words}
+    name_tokens = {name: _identifier_tokens(name) for name in names}
+    
+    for tokens, confidence in ((phrase_tokens, 1.0), (synonym_tokens, 0.9)):
+        matches = [name for name, candidate in name_tokens.items() if candidate == tokens]
+        if len(matches) == 1:
+            return matches[0], confidence
+        if len(matches) > 1:
+            return None, 0.0
+    
+    partial = [name for name, candidate in name_tokens.items() if phrase_tokens < candidate]
+    if len(partial) == 1:
+        return partial[0], 0.85
+    return None, 0.0
+
+def match_simple_question(user_input, schema_info, dialect="sqlite"):
+    """
+    Answer a simple list, count, group-by-count or top-N question with SQL built from rules.
+    
+    List questions return every row, like the LLM would; the result row cap and paging bound them.
+    
+    Args:
+        user_input (str): The user's natural language query
+        schema_info (dict): Database schema information; schema strings are never matched
+        dialect (str): sqlglot dialect the SQL is written for ("sqlite", "mysql" or "postgres")
+    
+    Returns:
+        dict or None: 'sql', 'intent', 'table' and 'confidence' when the question matches a known shape
+            and its names resolve against the schema with at least FAST_PATH_MIN_CONFIDENCE, else None
+    """
+    if not isinstance(schema_info, dict) or not schema_info:
+        return None
+    question = re.sub(r"\s+", " ", re.sub(r"[?.!]+$", "", user_input.strip().lower()))
+    
+    for intent, pattern in _FAST_PATH_PATTERNS:
+        match = pattern.match(question)
+        if match is None:
+            continue
+        
+        table, confidence = _resolve_name(match.group("table"), schema_info.keys())
+        if table is None:
+            continue
+        column = None
+        if "column" in pattern.groupindex:
+            column, column_confidence = _resolve_name(match.group("column"), [col["name"] for col in schema_info[table]])
+            if column is None:
+                continue
+            confidence = min(confidence, column_confidence)
+        if confidence < FAST_PATH_MIN_CONFIDENCE:
+            continue
+        
+        table_sql = _quote_identifier(table, dialect)
+        if intent == "list":
+            sql_query = f"SELECT * FROM {table_sql};"
+        elif intent == "count":
+            sql_query = f"SELECT COUNT(*) AS total_count FROM {table_sql};"
+        elif intent == "group_count":
+            column_sql = _quote_identifier(column, dialect)
+            sql_query = (f"SELECT {column_sql}, COUNT(*) AS total_count FROM {table_sql} "
+                         f"GROUP BY {column_sql} ORDER BY total_count DESC;")
+        else:
+            direction = "DESC" if match.group("direction") == "top" else "ASC"
+            column_sql = _quote_identifier(column, dialect)
+            sql_query = (f"SELECT * FROM {table_sql} WHERE {column_sql} IS NOT NULL "
+                         f"ORDER BY {column_sql} {direction} LIMIT {int(match.group('n'))};")
+        return {"sql": sql_query, "intent": intent, "table": table, "confidence": confidence}
+    return None
+
+def get_fast_path_stats():
+    """
+    Report how often the rule-based fast path answered a question without the LLM.
+    
+    Returns:
+        dict: Attempts, hits, hit rate, average matching time in milliseconds and hits per intent
+    """
+    with _fast_path_stats_lock:
+        stats = dict(_fast_path_stats)
+        stats["intents"] = dict(_fast_path_stats["intents"])
+    stats["hit_rate"] = stats["hits"] / stats["attempts"] if stats["attempts"] else 0.0
+    stats["avg_match_ms"] = stats["match_time"] * 1000 / stats["attempts"] if stats["attempts"] else 0.0
+    return stats
+
+def generate_sql_with_metadata(user_input, schema_info, api_key=None, use_cache=True, allow_similar=True, on_delta=None,
+                               allow_fast_path=True, store=True, dialect="sqlite"):
+    """
+    Generate SQL for a question, answering simple questions by rule and reusing the persistent
+    generation cache when possible.
+    
+    Args:
+        user_input (str): The user's natural language query
+        schema_info (dict or str): Database schema information
+        api_key (str, optional): OpenAI API key to use. If not provided, falls back to environment variable.
+        use_cache (bool): Whether to read from and write to the generation cache
+        allow_similar (bool): Whether SQL cached for a near-duplicate question may be reused
+        on_delta (callable, optional): Streams a fresh generation and calls this with each text chunk
+        allow_fast_path (bool): Whether simple questions may be answered by match_simple_question
+        store (bool): Whether a fresh generation is written to the generation cache. Callers that validate
+            the SQL first pass False and store it themselves once it is known to be valid.
+        dialect (str): sqlglot dialect of the connected database, used to quote fast path identifiers
+    
+    Returns:
+        dict: 'sql', 'source' ("fast_path", "cache", "similar" or "llm") and 'generation_time' in seconds.
+            Fast path answers also include 'intent' and 'confidence'; similar matches include
+            'matched_question' and 'similarity'; streamed generations include 'first_token_time'.
+    """
+    start_time = time.time()
+    
+    if allow_fast_path and FAST_PATH_ENABLED:
+        fast_match = match_simple_question(user_input, schema_info, dialect)
+        match_time = time.time() - start_time
+        with _fast_path_stats_lock:
+            _fast_path_stats["attempts"] += 1
+            _fast_path_stats["match_time"] += match_time
+            if fast_match is not None:
+                _fast_path_stats["hits"] += 1
+                _fast_path_stats["intents"][fast_match["intent"]] = _fast_path_stats["intents"].get(fast_match["intent"], 0) + 1
+        if fast_match is not None:
+            print(f"Fast path answered '{user_input}' as {fast_match['intent']} (confidence {fast_match['confidence']:.2f})")
+            return {
+                "sql": fast_match["sql"],
+                "source": "fast_path",
+                "intent": fast_match["intent"],
+                "confidence": fast_match["confidence"],
+                "generation_time": match_time
+            }
+    
+    cache = get_generation_cache() if use_cache else None
+    scope = _generation_scope(schema_info)
+    cache_key = _generation_cache_key(user_input, scope)
+    
+    if cache is not None:
+        try:
+            cached = cache.get("sql", cache_key)
+        except Exception as e:
+            print(f"Error reading generation cache: {str(e)}")
+            cached = None
+        if cached is not None:
+            print(f"Generation cache hit for: '{user_input}'")
+            return {"sql": cached["sql"], "source": "cache", "generation_time": time.time() - start_time}
+        
+        if allow_similar and SIMILAR_QUESTION_THRESHOLD > 0:
+            match = _find_cached_similar_question(cache, scope, user_input)
+            if match is not None:
+                print(f"Reusing SQL from similar question '{match['question']}' (similarity {match['similarity']:.2f})")
+                return {
+                    "sql": match["sql"],
+                    "source": "similar",
+                    "matched_question": match["question"],
+                    "similarity": match["similarity"],
+                    "generation_time": time.time() - start_time
+                }
+    
+    first_token = {}
+    def stream_delta(delta):
+        first_token.setdefault("time", time.time() - start_time)
+        on_delta(delta)
+    
+    sql_query = _gpt_generate_sql_uncached(user_input, schema_info, api_key=api_key,
+                                           on_delta=stream_delta if on_delta is not None else None)
+    
+    if cache is not None and store:
+        store_generated_sql(user_input, schema_info, sql_query)
+    result = {"sql": sql_query, "source": "llm", "generation_time": time.time() - start_time}
+    if "time" in first_token:
+        result["first_token_time"] = first_token["time"]
+    return result
+
+# Validation and repair outcomes across all sessions
+_sql_repair_stats = {
+    "validated": 0, "invalid": 0, "repaired": 0, "unrepaired": 0, "repair_calls": 0,
+    "validation_time": 0.0, "repair_time": 0.0
+}
+_sql_repair_stats_lock = threading.Lock()
+
+def _strip_code_fences(sql_query):
+    """Remove a Markdown code fence the model sometimes wraps around SQL."""
+    match = re.match(r"^```(?:sql)?\s*(.*?)\s*```$", sql_query.strip(), re.DOTALL | re.IGNORECASE)
+    return match.group(1) if match else sql_query.strip()
+
+def repair_sql(user_input, sql_query, error_message, schema_info, api_key=None):
+    """
+    Ask the model to fix a query that failed validation.
+    
+    Args:
+        user_input (str): The question the query answers
+        sql_query (str): The failing SQL query
+        error_message (str): The database or parser error
+        schema_info (dict or str): Database schema information
+        api_key (str, optional): OpenAI API key to use. If not provided, falls back to environment variable.
+    
+    Returns:
+        str: The corrected SQL query
+    """
+    api_key = api_key or os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OpenAI API key not found. Please provide an API key.")
+    
+    schema_description = _schema_for_prompt(schema_info, f"{user_input}\n{sql_query}")
+    client = get_openai_client(api_key)
+    
+    prompt = f"""The following SQL query was written to answer a question, but the database rejected it.
+Fix the query so it is valid for this schema and still answers the question.
+
+Database Schema:
+{schema_description}
+
+Question: "{user_input}"
+
+SQL Query:
+{sql_query}
+
+Error:
+{error_message}
+
+Provide ONLY the corrected SQL query, nothing else - no explanations or comments.
+"""
+    
+    print(f"Repairing SQL after validation error: {error_message}")
+    response = _chat_completion(
+        client,
+        "repair_sql",
+        model=OPENAI_MODEL,
+        messages=[
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0,
+        max_tokens=500
+    )
+    return response.choices[0].message.content.strip()
+
+def validate_and_repair_sql(user_input, sql_query, schema_info, validate, api_key=None, max_attempts=None):
+    """
+    Validate a generated query and send validation errors back to the model for a bounded number of fixes.
+    
+    Args:
+        user_input (str): The question the query answers
+        sql_query (str): The generated SQL query
+        schema_info (dict or str): Database schema information
+        validate (callable): Takes a query and returns an error message, or None when it is valid
+        api_key (str, optional): OpenAI API key to use
+        max_attempts (int, optional): Repair attempts. Defaults to SQL_REPAIR_MAX_ATTEMPTS.
+    
+    Returns:
+        dict: 'sql' (the last candidate), 'valid', 'validation_error' (the first error, if any),
+            'last_error', 'repair_attempts' and 'repair_time' in seconds
+    """
+    max_attempts = SQL_REPAIR_MAX_ATTEMPTS if max_attempts is None else max_attempts
+    start_time = time.time()
+    candidate = _strip_code_fences(sql_query)
+    error = validate(candidate)
+    validation_time = time.time() - start_time
+    first_error = error
+    attempts = 0
+    
+    while error is not None and attempts < max_attempts:
+        attempts += 1
+        try:
+            candidate = _strip_code_fences(repair_sql(user_input, candidate, error, schema_info, api_key=api_key))
+        except Exception as e:
+            print(f"SQL repair failed: {str(e)}")
+            break
+        error = validate(candidate)
+    
+    repair_time = time.time() - start_time - validation_time if first_error is not None else 0.0
+    with _sql_repair_stats_lock:
+        _sql_repair_stats["validated"] += 1
+        _sql_repair_stats["validation_time"] += validation_time
+        if first_error is not None:
+            _sql_repair_stats["invalid"] += 1
+            _sql_repair_stats["repair_calls"] += attempts
+            _sql_repair_stats["repair_time"] += repair_time
+            _sql_repair_stats["repaired" if error is None else "unrepaired"] += 1
+    
+    return {
+        "sql": candidate,
+        "valid": error is None,
+        "validation_error": first_error,
+        "last_error": error,
+        "repair_attempts": attempts,
+        "repair_time": repair_time
+    }
+
+def get_sql_repair_stats():
+    """
+    Report how often generated SQL failed validation and how well the repair loop fixed it.
+    
+    Returns:
+        dict: Validation and repair counts, repair success rate, average validation and repair time, and
+            the median time of a fresh SQL generation, which is what a user retrying by hand would wait for
+    """
+    with _sql_repair_stats_lock:
+        stats = dict(_sql_repair_stats)
+    stats["repair_success_rate"] = stats["repaired"] / stats["invalid"] if stats["invalid"] else 0.0
+    stats["avg_validation_time"] = stats["validation_time"] / stats["validated"] if stats["validated"] else 0.0
+    stats["avg_repair_time"] = stats["repair_time"] / stats["invalid"] if stats["invalid"] else 0.0
+    stats["p50_generation_time"] = get_latency_stats().get("generate_sql", {}).get("p50_total")
+    return stats
+
+def _generate_checked_sql(user_input, schema_info, api_key=None, validate=None, use_cache=True, **kwargs):
+    """Generate SQL and, when a validator is given, validate and repair it before anything else uses it."""
+    # With a validator, nothing is cached until the SQL is known to be valid
+    result = generate_sql_with_metadata(user_input, schema_info, api_key=api_key, use_cache=use_cache,
+                                        store=validate is None, **kwargs)
+    if validate is None:
+        return result
+    
+    check = validate_and_repair_sql(user_input, result["sql"], schema_info, validate, api_key=api_key)
+    source = result["source"]
+    result.update({key: check[key] for key in ("sql", "valid", "validation_error", "repair_attempts", "repair_time")})
+    if use_cache:
+        if check["validation_error"] is not None and source in ("cache", "similar"):
+            # Cached SQL that does not validate would fail again on every later ask; a valid repair is stored below
+            evict_generated_sql(result.get("matched_question", user_input), schema_info)
+        if check["valid"] and (source == "llm" or check["repair_attempts"]):
+            store_generated_sql(user_input, schema_info, check["sql"])
+    return result
+
+def _find_cached_similar_question(cache, scope, user_input):
+    """
+    Find a similar answered question whose SQL is still in the generation cache.
+    
+    Matches whose cache entry has expired or been evicted are dropped from the index, so the index never
+    hands out SQL the cache no longer vouches for.
+    
+    Returns:
+        dict: 'question', 'sql' and 'similarity' of the best live match, or None
+    """
+    index = get_similar_question_index(scope)
+    while True:
+        match = index.find(user_input, SIMILAR_QUESTION_THRESHOLD)
+        if match is None:
+            return None
+        try:
+            cached = cache.get("sql", _generation_cache_key(match["question"], scope))
+        except Exception as e:
+            print(f"Error reading generation cache: {str(e)}")
+            return None
+        if cached is not None:
+            match["sql"] = cached["sql"]
+            return match
+        index.remove(match["question"])
+
+def evict_generated_sql(user_input, schema_info):
+    """Remove the SQL cached for a question from the generation cache and the similarity index."""
+    cache = get_generation_cache()
+    if cache is None:
+        return
+    scope = _generation_scope(schema_info)
+    try:
+        cache.delete("sql", _generation_cache_key(user_input, scope))
+    except Exception as e:
+        print(f"Error writing generation cache: {str(e)}")
+    get_similar_question_index(scope).remove(user_input)
+
+def store_generated_sql(user_input, schema_info, sql_query):
+    """Write SQL generated for a question to the persistent generation cache."""
+    cache = get_generation_cache()
+    if cache is None:
+        return
+    scope = _generation_scope(schema_info)
+    try:
+        cache.set("sql", _generation_cache_key(user_input, scope), {"question": user_input, "sql": sql_query}, scope=scope)
+    except Exception as e:
+        print(f"Error writing generation cache: {str(e)}")
+    get_similar_question_index(scope).add(user_input, sql_query)
+
+def gpt_generate_sql(user_input, schema_info, api_key=None, use_cache=True):
     """
     Generate SQL query from natural language using OpenAI's GPT.
     
@@ -13,25 +1799,26 @@ def gpt_generate_sql(user_input, schema_info, api_key=None):
         user_input (str): The user's natural language query
         schema_info (dict or str): Dictionary containing database schema information or string with formatted schema
         api_key (str, optional): OpenAI API key to use. If not provided, falls back to environment variable.
+        use_cache (bool): Whether to reuse SQL from the persistent generation cache
     
     Returns:
         str: Generated SQL query
     """
+    return generate_sql_with_metadata(user_input, schema_info, api_key=api_key, use_cache=use_cache)["sql"]
+
+def _gpt_generate_sql_uncached(user_input, schema_info, api_key=None, on_delta=None):
+    """Generate SQL with a fresh LLM call, bypassing every cache. Streams chunks to on_delta when given."""
     # Get API key from parameter or environment variable
     api_key = api_key or os.environ.get("OPENAI_API_KEY")
     if not api_key:
         raise ValueError("OpenAI API key not found. Please provide an API key.")
     
-    # Format schema information for the prompt if it's a dictionary
-    if isinstance(schema_info, dict):
-        schema_description = format_schema_for_prompt(schema_info)
-    else:
-        # Use the schema string directly if provided
-        schema_description = schema_info
+    # Format schema information for the prompt, keeping only the tables relevant to the question
+    schema_description = _schema_for_prompt(schema_info, user_input)
     
     # Create client with detailed logging
     try:
-        client = OpenAI(api_key=api_key)
+        client = get_openai_client(api_key)
         
         # Log schema information
         if isinstance(schema_info, dict):
@@ -65,8 +1852,11 @@ Important rules:
         # Make the API call to OpenAI
         try:
             print("Making API call to OpenAI...")
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",  # Use GPT-3.5 Turbo - widely available model
+            response = _chat_completion(
+                client,
+                "generate_sql",
+                on_delta=on_delta,
+                model=OPENAI_MODEL,
                 messages=[
                     {"role": "system", "content": system_message},
                     {"role": "user", "content": user_input}
@@ -91,7 +1881,7 @@ Important rules:
         print(error_msg)
         raise Exception(error_msg)
 
-def explain_query(sql_query, schema_info, api_key=None):
+def explain_query(sql_query, schema_info, api_key=None, on_delta=None, use_cache=True):
     """
     Generate a plain English explanation of what the SQL query does.
     
@@ -99,26 +1889,41 @@ def explain_query(sql_query, schema_info, api_key=None):
         sql_query (str): The SQL query to explain
         schema_info (dict or str): Database schema information
         api_key (str, optional): OpenAI API key to use. If not provided, falls back to environment variable.
+        on_delta (callable, optional): Streams the explanation and calls this with each text chunk as it arrives
+        use_cache (bool): Whether to reuse and store explanations in the shared cache keyed by normalized SQL
         
     Returns:
         str: Plain English explanation of the query
     """
+    if use_cache:
+        cached = get_cached_annotation("explanation", sql_query, schema_info)
+        if cached is not None:
+            return cached
+    
+    try:
+        explanation = _explain_query_uncached(sql_query, schema_info, api_key=api_key, on_delta=on_delta)
+    except Exception as e:
+        print(f"Error generating explanation: {str(e)}")
+        return "Unable to generate explanation at this time."
+    
+    if use_cache and explanation:
+        store_annotation("explanation", sql_query, schema_info, explanation)
+    return explanation
+
+def _explain_query_uncached(sql_query, schema_info, api_key=None, on_delta=None):
+    """Explain a query with a fresh LLM call. Raises on failure."""
     # Get API key from parameter or environment variable
     api_key = api_key or os.environ.get("OPENAI_API_KEY")
     if not api_key:
         raise ValueError("OpenAI API key not found. Please provide an API key.")
     
-    # Format schema information for context
-    if isinstance(schema_info, dict):
-        schema_description = format_schema_for_prompt(schema_info)
-    else:
-        schema_description = schema_info
+    # Format schema information for context, keeping only the tables the query touches
+    schema_description = _schema_for_prompt(schema_info, sql_query)
     
-    try:
-        client = OpenAI(api_key=api_key)
-        
-        # Construct prompt for explanation
-        prompt = f"""Given the following SQL query and database schema, explain in simple terms what this query does.
+    client = get_openai_client(api_key)
+    
+    # Construct prompt for explanation
+    prompt = f"""Given the following SQL query and database schema, explain in simple terms what this query does.
 Use plain English, as if explaining to someone without technical knowledge. Keep the explanation concise but comprehensive.
 
 Database Schema:
@@ -133,23 +1938,130 @@ Please provide:
 3. The meaning of any calculations or aggregations
 4. How the results are being filtered or sorted, if applicable
 """
-        
-        print("Generating SQL explanation...")
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.3,
-            max_tokens=250
-        )
-        
-        explanation = response.choices[0].message.content.strip()
-        return explanation
     
-    except Exception as e:
-        print(f"Error generating explanation: {str(e)}")
-        return "Unable to generate explanation at this time."
+    print("Generating SQL explanation...")
+    response = _chat_completion(
+        client,
+        "explain",
+        on_delta=on_delta,
+        model=OPENAI_MODEL,
+        messages=[
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.3,
+        max_tokens=250
+    )
+    
+    explanation = response.choices[0].message.content.strip()
+    return explanation
+
+# Words that leave a question open to interpretation
+_VAGUE_WORDS = frozenset("""
+stuff thing things data info information detail details something anything everything some various
+good bad best worst popular important interesting relevant recent latest it them they
+""".split())
+
+# Words with a clear meaning in SQL even though they are not schema names
+_ANALYTIC_WORDS = frozenset("""
+count total sum average avg mean max maximum min minimum top bottom number many much highest lowest most least
+first last greater less more than over under above below between before after since during year years month
+months week weeks day days today yesterday date per group grouped order ordered sort sorted ascending descending
+distinct unique percent percentage ratio rate compare versus vs not no without only new equal equals exactly
+january february march april may june july august september october november december
+""".split())
+
+_question_improvement_stats = {"questions": 0, "requested": 0, "skipped": 0, "fetched_on_demand": 0}
+_question_improvement_stats_lock = threading.Lock()
+
+# Hits and misses of the SQL-keyed explanation and follow-up caches
+_annotation_cache_stats = {"explanation": {"hits": 0, "misses": 0}, "followups": {"hits": 0, "misses": 0}}
+_annotation_cache_stats_lock = threading.Lock()
+
+def score_question_precision(user_question, schema_info):
+    """
+    Score locally how precisely a question maps onto the schema, to decide whether an LLM
+    rewording suggestion is worth fetching.
+    
+    Content words are resolved against table and column names (directly or through synonyms) and
+    known sample values; numbers, quoted text and capitalized names count as filter values. The
+    score is the share of content words resolved, reduced when no table is named and for each vague word.
+    
+    Args:
+        user_question (str): The user's original question
+        schema_info (dict or str): Database schema information
+    
+    Returns:
+        dict: 'score' (0-1, None for schema strings), 'resolved_terms', 'unresolved_terms',
+            'ambiguous_terms', 'tables' named by the question and 'needs_improvement'
+    """
+    if not isinstance(schema_info, dict) or not schema_info:
+        return {"score": None, "resolved_terms": [], "unresolved_terms": [], "ambiguous_terms": [],
+                "tables": [], "needs_improvement": True}
+    
+    vocabulary = set()
+    sample_values = set()
+    for table_name, columns in schema_info.items():
+        vocabulary |= _identifier_tokens(table_name)
+        for col in columns:
+            vocabulary |= _identifier_tokens(col["name"])
+            sample_values.update(str(value).lower() for value in col.get("sample_values") or [])
+    
+    # Quoted text and capitalized words after the first are filter values, not names to resolve
+    question = re.sub(r"(['\"]).*?\1", " ", user_question)
+    values = {word.lower() for word in re.findall(r"(?<!^)\b[A-Z][a-zA-Z]+", question.strip())}
+    
+    resolved, unresolved, ambiguous = [], [], []
+    question_stems = set()
+    for word in re.findall(r"[a-z0-9_]+", question.lower()):
+        if word in _QUESTION_STOPWORDS or word.isdigit():
+            continue
+        stem = _stem_word(word)
+        if word in _VAGUE_WORDS:
+            ambiguous.append(word)
+            continue
+        targets = {stem, _stem_word(_QUESTION_SYNONYMS.get(stem, stem))}
+        for synonym in _SCHEMA_SYNONYMS.get(stem, []):
+            targets |= _identifier_tokens(synonym)
+        if targets & vocabulary:
+            resolved.append(word)
+            question_stems |= targets & vocabulary
+        elif word in _ANALYTIC_WORDS or word in values or word in sample_values:
+            continue
+        else:
+            unresolved.append(word)
+    
+    tables = [name for name in schema_info if _identifier_tokens(name) <= question_stems]
+    score = len(resolved) / (len(resolved) + len(unresolved)) if resolved or unresolved else 0.0
+    if not tables:
+        score *= 0.6
+    score = max(0.0, score - 0.2 * len(ambiguous))
+    return {
+        "score": score,
+        "resolved_terms": resolved,
+        "unresolved_terms": unresolved,
+        "ambiguous_terms": ambiguous,
+        "tables": tables,
+        "needs_improvement": score < QUESTION_PRECISION_THRESHOLD
+    }
+
+def fetch_question_improvement(user_question, schema_info, api_key=None):
+    """Fetch a rewording suggestion on demand, after the eager call was skipped."""
+    with _question_improvement_stats_lock:
+        _question_improvement_stats["fetched_on_demand"] += 1
+    return suggest_question_improvements(user_question, schema_info, api_key=api_key)
+
+def get_question_improvement_stats():
+    """
+    Report how many question-improvement LLM calls the precision check avoided.
+    
+    Returns:
+        dict: Questions seen, suggestions requested eagerly, skipped, fetched on demand afterwards and
+            the resulting calls avoided
+    """
+    with _question_improvement_stats_lock:
+        stats = dict(_question_improvement_stats)
+    stats["calls_avoided"] = stats["skipped"] - stats["fetched_on_demand"]
+    return stats
 
 def suggest_question_improvements(user_question, schema_info, api_key=None):
     """
@@ -168,14 +2080,11 @@ def suggest_question_improvements(user_question, schema_info, api_key=None):
     if not api_key:
         raise ValueError("OpenAI API key not found. Please provide an API key.")
     
-    # Format schema information for context
-    if isinstance(schema_info, dict):
-        schema_description = format_schema_for_prompt(schema_info)
-    else:
-        schema_description = schema_info
+    # Format schema information for context, keeping only the tables relevant to the question
+    schema_description = _schema_for_prompt(schema_info, user_question)
     
     try:
-        client = OpenAI(api_key=api_key)
+        client = get_openai_client(api_key)
         
         # Construct prompt for question improvement
         prompt = f"""Given the following user question and database schema, suggest an improved version of the question 
@@ -191,8 +2100,10 @@ Provide ONLY the improved question as your response. Do not include any explanat
 """
         
         print("Generating question improvement suggestion...")
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
+        response = _chat_completion(
+            client,
+            "improve_question",
+            model=OPENAI_MODEL,
             messages=[
                 {"role": "user", "content": prompt}
             ],
@@ -207,7 +2118,7 @@ Provide ONLY the improved question as your response. Do not include any explanat
         print(f"Error generating question improvement: {str(e)}")
         return ""
 
-def generate_followup_questions(user_question, sql_query, schema_info, api_key=None):
+def generate_followup_questions(user_question, sql_query, schema_info, api_key=None, use_cache=True):
     """
     Generate follow-up questions based on the current query and results.
     
@@ -216,23 +2127,26 @@ def generate_followup_questions(user_question, sql_query, schema_info, api_key=N
         sql_query (str): The executed SQL query
         schema_info (dict or str): Database schema information
         api_key (str, optional): OpenAI API key to use. If not provided, falls back to environment variable.
+        use_cache (bool): Whether to reuse and store follow-ups in the shared cache keyed by normalized SQL
         
     Returns:
         list: List of suggested follow-up questions
     """
+    if use_cache:
+        cached = get_cached_annotation("followups", sql_query, schema_info)
+        if cached is not None:
+            return cached
+    
     # Get API key from parameter or environment variable
     api_key = api_key or os.environ.get("OPENAI_API_KEY")
     if not api_key:
         raise ValueError("OpenAI API key not found. Please provide an API key.")
     
-    # Format schema information for context
-    if isinstance(schema_info, dict):
-        schema_description = format_schema_for_prompt(schema_info)
-    else:
-        schema_description = schema_info
+    # Format schema information for context, keeping only the tables relevant to the question and query
+    schema_description = _schema_for_prompt(schema_info, f"{user_question}\n{sql_query}")
     
     try:
-        client = OpenAI(api_key=api_key)
+        client = get_openai_client(api_key)
         
         # Construct prompt for follow-up questions
         prompt = f"""Given the following user question, SQL query, and database schema, suggest 3-4 logical follow-up questions 
@@ -252,8 +2166,10 @@ and conversational, and should be different enough to provide new insights.
 """
         
         print("Generating follow-up question suggestions...")
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
+        response = _chat_completion(
+            client,
+            "followups",
+            model=OPENAI_MODEL,
             messages=[
                 {"role": "user", "content": prompt}
             ],
@@ -266,32 +2182,649 @@ and conversational, and should be different enough to provide new insights.
         followup_questions = [q.strip() for q in followup_text.split('\n') if q.strip()]
         
         # Limit to 4 questions maximum
-        return followup_questions[:4]
+        followup_questions = followup_questions[:4]
+        if use_cache and followup_questions:
+            store_annotation("followups", sql_query, schema_info, followup_questions)
+        return followup_questions
     
     except Exception as e:
         print(f"Error generating follow-up questions: {str(e)}")
         return []
 
-def analyze_query(sql_query, schema_info=None, api_key=None):
+class SpeculativeWarmer:
+    """
+    Generates SQL for suggested follow-up questions in the background, and optionally runs it, so that
+    picking a follow-up is answered from the caches.
+    
+    Work is spread over a small shared pool and limited by its own generations-per-minute budget. It only
+    runs while the circuit breaker is closed and the shared token quota has headroom. Starting a new batch
+    for a session cancels that session's previous one.
+    """
+
+    MAX_WARMED_SESSIONS = 256
+
+    def __init__(self, workers, generations_per_minute):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="followup-warmup")
+        self.budget = TokenBucket(generations_per_minute, generations_per_minute / 60.0) if generations_per_minute > 0 else None
+        self.lock = threading.Lock()
+        self.batches = {}
+        self.warmed = collections.OrderedDict()
+        self.stats = {
+            "submitted": 0, "generated": 0, "llm_generations": 0, "executed": 0, "not_executed": 0, "failed": 0,
+            "cancelled": 0, "skipped_for_budget": 0, "used": 0
+        }
+
+    def warm(self, session_id, questions, schema_info, api_key=None, execute=None, dialect="sqlite"):
+        """
+        Start warming a session's follow-up questions, cancelling its previous batch.
+        
+        Args:
+            session_id (str): Identifies the browser session the follow-ups were suggested to
+            questions (list): Follow-up questions to generate SQL for
+            schema_info (dict or str): Database schema information
+            api_key (str, optional): OpenAI API key to use
+            execute (callable, optional): Called with each generated SQL string to run it into a result cache;
+                it returns False when it declines to run the SQL
+            dialect (str): sqlglot dialect of the connected database
+        """
+        self.cancel(session_id)
+        if self.budget is None or not questions:
+            return
+        
+        cancelled = threading.Event()
+        futures = [
+            self.executor.submit(self._warm_one, session_id, question, schema_info, api_key, execute, cancelled, dialect)
+            for question in questions
+        ]
+        with self.lock:
+            self.batches[session_id] = (cancelled, futures)
+            self.stats["submitted"] += len(futures)
+
+    def cancel(self, session_id):
+        """Drop a session's queued warm-ups. Requests already sent finish, but their SQL is not executed."""
+        with self.lock:
+            batch = self.batches.pop(session_id, None)
+        if batch is None:
+            return
+        cancelled, futures = batch
+        cancelled.set()
+        dropped = sum(1 for future in futures if future.cancel())
+        with self.lock:
+            self.stats["cancelled"] += dropped
+
+    def was_warmed(self, session_id, question):
+        """Check (and count) whether a question the user asked had been warmed for their session."""
+        with self.lock:
+            hit = normalize_question(question) in self.warmed.get(session_id, ())
+            if hit:
+                self.stats["used"] += 1
+        return hit
+
+    def _within_budget(self):
+        """Reserve one speculative generation if the provider is healthy and the quotas have room."""
+        if _circuit_breaker.stats()["state"] != CircuitBreaker.CLOSED:
+            return False
+        token_bucket = _rate_limiter.tokens
+        if token_bucket is not None and token_bucket.available() < token_bucket.capacity * SPECULATIVE_MIN_TOKEN_HEADROOM:
+            return False
+        if self.budget.reserve(1) > 0:
+            self.budget.refund(1)
+            return False
+        return True
+
+    def _warm_one(self, session_id, question, schema_info, api_key, execute, cancelled, dialect):
+        if cancelled.is_set():
+            return
+        if not self._within_budget():
+            with self.lock:
+                self.stats["skipped_for_budget"] += 1
+            return
+        
+        try:
+            result = generate_sql_with_metadata(question, schema_info, api_key=api_key, dialect=dialect)
+        except Exception as e:
+            print(f"Follow-up warm-up failed for '{question}': {str(e)}")
+            with self.lock:
+                self.stats["failed"] += 1
+            return
+        if result["source"] != "llm":
+            # Cache and fast path answers cost nothing, so they do not count against the budget
+            self.budget.refund(1)
+        
+        with self.lock:
+            self.stats["generated"] += 1
+            if result["source"] == "llm":
+                self.stats["llm_generations"] += 1
+            self.warmed.setdefault(session_id, set()).add(normalize_question(question))
+            self.warmed.move_to_end(session_id)
+            while len(self.warmed) > self.MAX_WARMED_SESSIONS:
+                self.warmed.popitem(last=False)
+        
+        if execute is None or cancelled.is_set():
+            return
+        try:
+            executed = execute(result["sql"])
+        except Exception as e:
+            print(f"Follow-up warm-up query failed for '{question}': {str(e)}")
+            with self.lock:
+                self.stats["failed"] += 1
+            return
+        with self.lock:
+            self.stats["not_executed" if executed is False else "executed"] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["active_sessions"] = sum(
+                1 for _, futures in self.batches.values() if any(not future.done() for future in futures)
+            )
+        return stats
+
+_speculative_warmer = None
+_speculative_warmer_lock = threading.Lock()
+
+def get_speculative_warmer():
+    """Return the process-wide follow-up warmer, creating it on first use."""
+    global _speculative_warmer
+    with _speculative_warmer_lock:
+        if _speculative_warmer is None:
+            _speculative_warmer = SpeculativeWarmer(SPECULATIVE_WARMUP_WORKERS, SPECULATIVE_WARMUP_RPM)
+    return _speculative_warmer
+
+def generate_sql_bundle(user_input, schema_info, api_key=None):
+    """
+    Generate the SQL, explanation, improved question and follow-ups in a single request.
+    
+    Args:
+        user_input (str): The user's natural language query
+        schema_info (dict or str): Database schema information
+        api_key (str, optional): OpenAI API key to use. If not provided, falls back to environment variable.
+    
+    Returns:
+        dict: Parsed response with 'sql', 'explanation', 'improved_question' and 'followups' keys
+    
+    Raises:
+        ValueError: If the response is not a valid bundle
+    """
+    # Get API key from parameter or environment variable
+    api_key = api_key or os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OpenAI API key not found. Please provide an API key.")
+    
+    # Format schema information for the prompt, keeping only the tables relevant to the question
+    schema_description = _schema_for_prompt(schema_info, user_input)
+    
+    client = get_openai_client(api_key)
+    
+    system_message = f"""You are an expert SQL query generator and data analyst.
+Convert the user's natural language question into a valid SQLite SQL query using the following database schema:
+
+{schema_description}
+
+Rules for the SQL query:
+1. Make sure the query is compatible with SQLite syntax
+2. Use appropriate joins when needed based on the schema
+3. Limit results to a reasonable number (e.g., 100) for large tables unless specified otherwise
+4. Use column aliases for clarity when needed
+5. Make sure to handle NULL values appropriately
+6. For aggregations, always include GROUP BY clauses as needed
+
+Respond with a single JSON object with exactly these keys:
+- "sql": the SQL query only, without comments or markdown
+- "explanation": a concise plain English explanation of what the query does, for someone without technical knowledge, as 2-4 short lines separated by newlines
+- "improved_question": a clearer, more specific version of the user's question using correct terminology from the schema
+- "followups": a list of 3-4 natural follow-up questions that explore different aspects of the data
+"""
+    
+    print("Generating SQL bundle in a single request...")
+    response = _chat_completion(
+        client,
+        "bundle",
+        model=OPENAI_MODEL,
+        messages=[
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": user_input}
+        ],
+        temperature=0.1,
+        max_tokens=900,
+        response_format={"type": "json_object"}
+    )
+    
+    return parse_sql_bundle(response.choices[0].message.content)
+
+def parse_sql_bundle(response_text):
+    """
+    Strictly parse the JSON returned by the combined generation request.
+    
+    Args:
+        response_text (str): Raw model output
+    
+    Returns:
+        dict: Bundle with 'sql', 'explanation', 'improved_question' and 'followups' keys
+    
+    Raises:
+        ValueError: If the text is not a JSON object with the expected fields and types
+    """
+    try:
+        bundle = json.loads(response_text)
+    except (TypeError, json.JSONDecodeError) as e:
+        raise ValueError(f"Response is not valid JSON: {str(e)}")
+    
+    if not isinstance(bundle, dict):
+        raise ValueError("Response is not a JSON object")
+    
+    missing = [key for key in ("sql", "explanation", "improved_question", "followups") if key not in bundle]
+    if missing:
+        raise ValueError(f"Response is missing fields: {', '.join(missing)}")
+    
+    for key in ("sql", "explanation", "improved_question"):
+        if not isinstance(bundle[key], str):
+            raise ValueError(f"Field '{key}' must be a string")
+    if not bundle["sql"].strip():
+        raise ValueError("Field 'sql' is empty")
+    if not isinstance(bundle["followups"], list) or not all(isinstance(q, str) for q in bundle["followups"]):
+        raise ValueError("Field 'followups' must be a list of strings")
+    
+    return {
+        "sql": bundle["sql"].strip(),
+        "explanation": bundle["explanation"].strip(),
+        "improved_question": bundle["improved_question"].strip(),
+        "followups": [q.strip() for q in bundle["followups"] if q.strip()][:4]
+    }
+
+_pipeline_executor = ThreadPoolExecutor(max_workers=LLM_PIPELINE_WORKERS, thread_name_prefix="llm-pipeline")
+
+def iter_question_pipeline(user_input, schema_info, api_key=None, mode="separate", use_cache=True, allow_similar=True, stream=False,
+                           allow_fast_path=True, improve_question="auto", explain="eager", validate=None, dialect="sqlite"):
+    """
+    Run the LLM calls for one question and yield each result as soon as it arrives.
+    
+    In "separate" mode the question-improvement suggestion and SQL generation start together,
+    and the explanation and follow-up questions start as soon as the SQL is available. In
+    "combined" mode a single request returns everything; if its response cannot be parsed the
+    pipeline falls back to the separate calls. Combined mode always makes its request, but the
+    SQL it returns is still written to the generation cache. Questions the rule-based fast path can
+    answer always use the separate calls, so only the explanation and follow-ups reach the LLM.
+    In separate mode the question-improvement call is skipped when score_question_precision finds
+    the question already precise (improve_question="auto") or when suggestions are on demand only.
+    
+    Args:
+        user_input (str): The user's natural language query
+        schema_info (dict or str): Database schema information
+        api_key (str, optional): OpenAI API key to use. If not provided, falls back to environment variable.
+        mode (str): "separate" or "combined"
+        use_cache (bool): Whether to use the persistent generation cache
+        allow_similar (bool): Whether SQL cached for a near-duplicate question may be reused
+        stream (bool): In separate mode, also yield "sql_delta" and "explanation_delta" events with
+            text chunks as tokens arrive. Combined mode returns JSON and is never streamed.
+        allow_fast_path (bool): Whether simple questions may be answered without the LLM
+        improve_question (str): "auto" to ask for a rewording only for imprecise questions, "always",
+            or "on_demand" to never ask up front (see fetch_question_improvement)
+        explain (str): "eager" to explain every query, or "on_demand" to yield an explanation only when
+            one is already cached (separate mode only; call explain_query when the user asks)
+        validate (callable, optional): Takes a query and returns an error message or None. Generated SQL is
+            checked with it and repaired via validate_and_repair_sql before it is explained or yielded.
+        dialect (str): sqlglot dialect of the connected database ("sqlite", "mysql" or "postgres")
+    
+    Yields:
+        tuple: (event, value) pairs where event is "question_precision" (the score_question_precision
+            result plus 'suggestion_skipped', separate mode only), "improved_question", "generation" (the metadata
+            from generate_sql_with_metadata without the SQL), "sql", "explanation" or "followups", followed by a
+            final ("metrics", dict) with the mode used, LLM calls, token counts, per-call timings and wall time
+    
+    Raises:
+        Exception: If SQL generation fails. The other calls fall back to empty results instead.
+    """
+    collector = _new_usage_collector()
+    start_time = time.time()
+    used_mode = mode
+    if mode == "combined" and allow_fast_path and FAST_PATH_ENABLED and match_simple_question(user_input, schema_info, dialect):
+        used_mode = "separate"
+    
+    if used_mode == "combined":
+        token = _usage_collector.set(collector)
+        try:
+            bundle = generate_sql_bundle(user_input, schema_info, api_key=api_key)
+        except Exception as e:
+            print(f"Combined generation failed, falling back to separate calls: {str(e)}")
+            used_mode = "combined_fallback"
+            bundle = None
+        finally:
+            _usage_collector.reset(token)
+        
+        generation = {"source": "llm"}
+        if bundle is not None and validate is not None:
+            token = _usage_collector.set(collector)
+            try:
+                check = validate_and_repair_sql(user_input, bundle["sql"], schema_info, validate, api_key=api_key)
+            finally:
+                _usage_collector.reset(token)
+            # The bundled explanation describes the original query, which is close enough to keep
+            bundle["sql"] = check["sql"]
+            generation.update({key: check[key] for key in ("valid", "validation_error", "repair_attempts", "repair_time")})
+        
+        if bundle is not None:
+            # SQL that failed validation is never cached, so the next ask generates afresh
+            if use_cache and generation.get("valid", True):
+                store_generated_sql(user_input, schema_info, bundle["sql"])
+                if not generation.get("repair_attempts"):
+                    store_annotation("explanation", bundle["sql"], schema_info, bundle["explanation"])
+                    if bundle["followups"]:
+                        store_annotation("followups", bundle["sql"], schema_info, bundle["followups"])
+            yield "improved_question", bundle["improved_question"]
+            generation["generation_time"] = time.time() - start_time
+            yield "generation", generation
+            yield "sql", bundle["sql"]
+            yield "explanation", bundle["explanation"]
+            yield "followups", bundle["followups"]
+    
+    if used_mode != "combined":
+        results = queue.Queue()
+        
+        def run(event, func, *args, **kwargs):
+            _usage_collector.set(collector)
+            try:
+                results.put((event, func(*args, api_key=api_key, **kwargs), None))
+            except Exception as e:
+                results.put((event, None, e))
+        
+        def submit(event, func, *args, **kwargs):
+            # Each task gets its own context copy so the collector never leaks between pool threads
+            _pipeline_executor.submit(contextvars.copy_context().run, run, event, func, *args, **kwargs)
+        
+        def delta_sink(event):
+            if not stream:
+                return None
+            return lambda delta: results.put((event, delta, None))
+        
+        submit(
+            "sql", _generate_checked_sql, user_input, schema_info, validate=validate,
+            use_cache=use_cache, allow_similar=allow_similar, on_delta=delta_sink("sql_delta"),
+            allow_fast_path=allow_fast_path, dialect=dialect
+        )
+        pending = 1
+        
+        precision = score_question_precision(user_input, schema_info)
+        suggestion_skipped = improve_question == "on_demand" or (improve_question == "auto" and not precision["needs_improvement"])
+        with _question_improvement_stats_lock:
+            _question_improvement_stats["questions"] += 1
+            _question_improvement_stats["skipped" if suggestion_skipped else "requested"] += 1
+        if not suggestion_skipped:
+            submit("improved_question", suggest_question_improvements, user_input, schema_info)
+            pending += 1
+        yield "question_precision", {**precision, "suggestion_skipped": suggestion_skipped}
+        
+        while pending:
+            event, value, error = results.get()
+            if event.endswith("_delta"):
+                yield event, value
+                continue
+            pending -= 1
+            
+            if event == "sql":
+                if error:
+                    raise error
+                yield "generation", {key: item for key, item in value.items() if key != "sql"}
+                value = value["sql"]
+                submit("followups", generate_followup_questions, user_input, value, schema_info, use_cache=use_cache)
+                pending += 1
+                if explain == "eager":
+                    submit("explanation", explain_query, value, schema_info, on_delta=delta_sink("explanation_delta"), use_cache=use_cache)
+                    pending += 1
+                elif use_cache:
+                    cached_explanation = get_cached_annotation("explanation", value, schema_info)
+                    if cached_explanation is not None:
+                        results.put(("explanation", cached_explanation, None))
+                        pending += 1
+            elif error:
+                print(f"Error in question pipeline ({event}): {str(error)}")
+                value = [] if event == "followups" else ""
+            
+            yield event, value
+    
+    with collector["lock"]:
+        metrics = {
+            "mode": used_mode,
+            "llm_calls": collector["llm_calls"],
+            "prompt_tokens": collector["prompt_tokens"],
+            "completion_tokens": collector["completion_tokens"],
+            "schema_tokens_saved": collector["schema_tokens_saved"],
+            "coalesced_calls": collector["coalesced_calls"],
+            "timings": dict(collector["timings"]),
+            "wall_time": time.time() - start_time
+        }
+    _record_generation_metrics(metrics)
+    yield "metrics", metrics
+
+def analyze_query(sql_query, schema_info=None, api_key=None, indexes=None, dialect="sqlite"):
     """
     Analyze the SQL query for potential performance issues and suggest optimizations.
     
+    The query is parsed with sqlglot to find its join keys, filter, group-by and sort columns, which are
+    checked against the real indexes so only missing ones are recommended, with exact CREATE INDEX
+    statements. Without sqlglot, or if the query does not parse, substring heuristics are used instead.
+    
     Args:
         sql_query (str): The SQL query to analyze
         schema_info (dict, optional): Database schema information
         api_key (str, optional): OpenAI API key to use. If not provided, falls back to environment variable.
+        indexes (dict, optional): Table name mapped to its indexes as {"name", "columns", "unique"} dicts,
+            e.g. from db_utils.get_sqlite_indexes. Without it only primary keys count as indexed.
+        dialect (str): sqlglot dialect of the query ("sqlite", "mysql" or "postgres")
         
     Returns:
-        dict: Analysis results with suggestions
+        dict: Analysis results with 'suggestions', 'warnings', 'complexity', 'estimated_impact',
+            'index_recommendations' ({"table", "columns", "reason", "ddl"} dicts) and 'analyzer'
+            ("ast" or "heuristic")
     """
-    # For future AI-powered deeper analysis that would require API key
-    # api_key = api_key or os.environ.get("OPENAI_API_KEY")
+    if sqlglot is not None:
+        try:
+            tree = sqlglot.parse_one(sql_query, read=dialect)
+        except Exception as e:
+            print(f"Falling back to heuristic query analysis: {str(e)}")
+            tree = None
+        if isinstance(tree, exp.Query):
+            return _analyze_query_ast(tree, schema_info if isinstance(schema_info, dict) else {}, indexes, dialect)
+    return _analyze_query_heuristic(sql_query, schema_info)
+
+def _indexed_prefixes(table, schema_info, indexes):
+    """Column lists of the table's indexes, with the primary key from the schema when no metadata was given."""
+    if indexes is not None and table in indexes:
+        return [[column.lower() for column in index["columns"]] for index in indexes[table]]
+    primary_key = [col["name"].lower() for col in schema_info.get(table, []) if col.get("is_primary_key")]
+    return [primary_key] if primary_key else []
+
+def _scope_tables(select):
+    """Alias (or name) to table name for the tables of one SELECT, excluding nested subqueries."""
+    tables = {}
+    for table in select.find_all(exp.Table):
+        if table.find_ancestor(exp.Select) is select and table.name:
+            tables[(table.alias_or_name or table.name).lower()] = table.name
+    return tables
+
+def _resolve_column(column, scope_tables, schema_info):
+    """Find the table a column reference belongs to within a SELECT, or None when it is ambiguous or unknown."""
+    if column.table:
+        return scope_tables.get(column.table.lower())
+    if len(set(scope_tables.values())) == 1:
+        return next(iter(scope_tables.values()))
+    owners = {
+        table for table in scope_tables.values()
+        if any(col["name"].lower() == column.name.lower() for col in schema_info.get(table, []))
+    }
+    return owners.pop() if len(owners) == 1 else None
+
+def _analyze_query_ast(tree, schema_info, indexes, dialect):
+    """Parser-based analysis behind analyze_query."""
+    results = {
+        'suggestions': [],
+        'warnings': [],
+        'complexity': 'Simple',
+        'estimated_impact': [],
+        'index_recommendations': [],
+        'analyzer': 'ast'
+    }
+    cte_names = {cte.alias_or_name.lower() for cte in tree.find_all(exp.CTE)}
+    known_tables = {table.lower(): table for table in schema_info}
+    
+    # Columns each table is accessed by, in the order an index should list them
+    wanted = collections.OrderedDict()
+    
+    def want(table, columns, reason):
+        if not table or table.lower() in cte_names or (known_tables and table.lower() not in known_tables):
+            return
+        table = known_tables.get(table.lower(), table)
+        columns = [column for column in dict.fromkeys(columns) if column]
+        if columns:
+            wanted.setdefault((table, tuple(columns)), reason)
+    
+    selects = list(tree.find_all(exp.Select))
+    join_count = 0
+    correlated_subqueries = 0
+    for select in selects:
+        scope_tables = _scope_tables(select)
+        
+        for join in select.args.get("joins") or []:
+            join_count += 1
+            condition = join.args.get("on")
+            for eq in (condition.find_all(exp.EQ) if condition is not None else []):
+                if isinstance(eq.left, exp.Column) and isinstance(eq.right, exp.Column):
+                    for side in (eq.left, eq.right):
+                        want(_resolve_column(side, scope_tables, schema_info), [side.name], "join key")
+        
+        where = select.args.get("where")
+        if where is not None:
+            equality, ranges = {}, {}
+            for predicate in where.find_all(exp.EQ, exp.GT, exp.GTE, exp.LT, exp.LTE, exp.In, exp.Between, exp.Like):
+                if predicate.find_ancestor(exp.Select) is not select:
+                    continue
+                column = predicate.this if isinstance(predicate.this, exp.Column) else None
+                other = predicate.args.get("expression")
+                if isinstance(predicate, exp.EQ) and isinstance(column, exp.Column) and isinstance(other, exp.Column):
+                    # In a correlated subquery the inner side of outer = inner is looked up once per outer row
+                    owners = [_resolve_column(side, scope_tables, schema_info) for side in (column, other)]
+                    if (owners[0] is None) != (owners[1] is None):
+                        inner = column if owners[0] is not None else other
+                        want(owners[0] or owners[1], [inner.name], "correlated lookup")
+                    continue
+                if column is None and isinstance(other, exp.Column) and isinstance(predicate, (exp.EQ, exp.GT, exp.GTE, exp.LT, exp.LTE)):
+                    column, other = other, predicate.this
+                if column is None or isinstance(other, exp.Column):
+                    continue
+                if isinstance(predicate, exp.Like) and not (isinstance(other, exp.Literal) and not other.this.startswith("%")):
+                    continue
+                table = _resolve_column(column, scope_tables, schema_info)
+                target = equality if isinstance(predicate, (exp.EQ, exp.In)) else ranges
+                target.setdefault(table, []).append(column.name)
+            # Equality columns first, then one range column, is the order a B-tree index can use
+            for table in set(equality) | set(ranges):
+                want(table, equality.get(table, []) + ranges.get(table, [])[:1], "filter")
+        
+        group = select.args.get("group")
+        if group is not None and not select.args.get("joins"):
+            by_table = {}
+            for column in group.expressions:
+                if isinstance(column, exp.Column):
+                    by_table.setdefault(_resolve_column(column, scope_tables, schema_info), []).append(column.name)
+            for table, columns in by_table.items():
+                want(table, columns, "group by")
+        
+        order = select.args.get("order")
+        if order is not None and select.args.get("limit") is not None and not select.args.get("joins") and group is None:
+            columns = [ordered.this for ordered in order.expressions if isinstance(ordered.this, exp.Column)]
+            if columns:
+                want(_resolve_column(columns[0], scope_tables, schema_info), [column.name for column in columns], "order by with limit")
+        
+        # A subquery is only a per-row cost when it refers to a table of the enclosing query
+        if select is not tree and select.find_ancestor(exp.Select) is not None:
+            outer = _scope_tables(select.find_ancestor(exp.Select))
+            inner = _scope_tables(select)
+            if any(column.table and column.table.lower() in outer and column.table.lower() not in inner
+                   for column in select.find_all(exp.Column)):
+                correlated_subqueries += 1
+    
+    # Keep only access paths no existing index serves, and drop ones another recommendation already covers
+    recommendations = []
+    for (table, columns), reason in wanted.items():
+        lowered = [column.lower() for column in columns]
+        if any(prefix[:len(lowered)] == lowered for prefix in _indexed_prefixes(table, schema_info, indexes)):
+            continue
+        recommendations.append({"table": table, "columns": list(columns), "reason": reason})
+    recommendations = [
+        rec for rec in recommendations
+        if not any(other is not rec and other["table"] == rec["table"] and len(other["columns"]) > len(rec["columns"])
+                   and [c.lower() for c in other["columns"][:len(rec["columns"])]] == [c.lower() for c in rec["columns"]]
+                   for other in recommendations)
+    ]
+    
+    for rec in recommendations:
+        index_name = re.sub(r"\W+", "_", f"idx_{rec['table']}_{'_'.join(rec['columns'])}").lower()
+        rec["ddl"] = (f"CREATE INDEX {_quote_identifier(index_name)} ON {_quote_identifier(rec['table'])} "
+                      f"({', '.join(_quote_identifier(column) for column in rec['columns'])});")
+        if dialect == "mysql":
+            rec["ddl"] = rec["ddl"].replace('"', '`')
+        results['index_recommendations'].append(rec)
+        results['suggestions'].append({
+            'issue': f"No index for {rec['reason']} on {rec['table']}({', '.join(rec['columns'])})",
+            'suggestion': f"Add an index on {rec['table']}({', '.join(rec['columns'])}) so the {rec['reason']} does not scan the whole table",
+            'impact': 'High' if rec['reason'] in ("join key", "filter", "correlated lookup") else 'Medium',
+            'example': rec["ddl"]
+        })
+    
+    outer_select = tree if isinstance(tree, exp.Select) else None
+    if outer_select is not None and outer_select.args.get("limit") is None:
+        if any(isinstance(expression, exp.Star) for expression in outer_select.expressions) and outer_select.args.get("group") is None:
+            results['suggestions'].append({
+                'issue': 'SELECT * without LIMIT',
+                'suggestion': 'Add a LIMIT clause or select only the columns you need to reduce data transfer',
+                'impact': 'High',
+                'example': tree.limit(100).sql(dialect=dialect)
+            })
+        if outer_select.args.get("order") is not None:
+            results['suggestions'].append({
+                'issue': 'ORDER BY without LIMIT',
+                'suggestion': 'Add LIMIT clause after ORDER BY for large result sets',
+                'impact': 'Medium',
+                'example': tree.limit(100).sql(dialect=dialect)
+            })
+    
+    if correlated_subqueries:
+        results['suggestions'].append({
+            'issue': 'Correlated subquery detected',
+            'suggestion': 'The subquery refers to the outer query, so it may run once per row; consider rewriting it as a JOIN',
+            'impact': 'Medium',
+            'example': "Original: SELECT * FROM t1 WHERE x > (SELECT AVG(x) FROM t2 WHERE t2.k = t1.k)\nOptimized: SELECT t1.* FROM t1 JOIN (SELECT k, AVG(x) AS avg_x FROM t2 GROUP BY k) a ON a.k = t1.k WHERE t1.x > a.avg_x"
+        })
+    
+    if any(select.args.get("distinct") and select.args.get("group") is not None for select in selects):
+        results['suggestions'].append({
+            'issue': 'DISTINCT with GROUP BY',
+            'suggestion': 'DISTINCT is usually unnecessary with GROUP BY as GROUP BY already returns unique rows',
+            'impact': 'Low',
+            'example': "Consider removing DISTINCT when using GROUP BY"
+        })
     
+    has_aggregation = any(select.args.get("group") is not None for select in selects)
+    if correlated_subqueries or join_count > 2 or any(select.args.get("having") is not None for select in selects):
+        results['complexity'] = 'Complex'
+    elif join_count or has_aggregation or len(selects) > 1:
+        results['complexity'] = 'Medium'
+    
+    if results['complexity'] == 'Complex':
+        results['estimated_impact'].append("This query may be resource-intensive on large datasets")
+    if indexes is None:
+        results['warnings'].append("Index metadata was not available, so only primary keys were treated as indexed")
+    return results
+
+def _analyze_query_heuristic(sql_query, schema_info=None):
+    """Substring-based analysis used when sqlglot is not installed or cannot parse the query."""
     results = {
         'suggestions': [],
         'warnings': [],
         'complexity': 'Simple',
-        'estimated_impact': []
+        'estimated_impact': [],
+        'index_recommendations': [],
+        'analyzer': 'heuristic'
     }
     
     # Convert to uppercase for analysis but keep original for display
@@ -379,16 +2912,73 @@ def analyze_query(sql_query, schema_info=None, api_key=None):
     
     return results
 
-def format_schema_for_prompt(schema_info):
+def format_schema_for_prompt(schema_info, style=None):
     """
     Format the schema information into a readable format for the prompt.
     
+    Rendered text is memoized by schema fingerprint and style, so repeated prompts for an
+    unchanged schema skip the rendering work.
+    
     Args:
         schema_info (dict): Dictionary containing database schema information
+        style (str, optional): "bullet" (one line per column) or "ddl" (compact CREATE TABLE
+            statements). Defaults to SCHEMA_PROMPT_STYLE.
     
     Returns:
         str: Formatted schema description
     """
+    return _rendered_schema(schema_info, style or SCHEMA_PROMPT_STYLE)["text"]
+
+def _rendered_schema(schema_info, style):
+    """Return the memoized rendering of a schema as a dict with 'text' and lazily computed 'tokens'."""
+    cache_key = (schema_fingerprint(schema_info), style)
+    with _schema_render_cache_lock:
+        entry = _schema_render_cache.get(cache_key)
+        if entry is not None:
+            _schema_render_cache.move_to_end(cache_key)
+            return entry
+    
+    entry = {"text": _schema_renderer(style)(schema_info), "tokens": None}
+    with _schema_render_cache_lock:
+        _schema_render_cache[cache_key] = entry
+        while len(_schema_render_cache) > SCHEMA_RENDER_CACHE_SIZE:
+            _schema_render_cache.popitem(last=False)
+    return entry
+
+def _schema_renderer(style):
+    """Return the function that renders a schema in the given prompt style."""
+    return render_schema_ddl if style == "ddl" else render_schema_bullets
+
+def _schema_prompt_tokens(schema_info, style=None):
+    """Estimated token count of a rendered schema, memoized with the rendering."""
+    entry = _rendered_schema(schema_info, style or SCHEMA_PROMPT_STYLE)
+    if entry["tokens"] is None:
+        entry["tokens"] = estimate_tokens(entry["text"])
+    return entry["tokens"]
+
+def invalidate_schema_cache(schema_info=None):
+    """
+    Drop memoized schema renderings, either for one schema or all of them.
+    
+    Call this when the connected database or its schema changes, and always after changing a
+    schema dict in place, since fingerprints are memoized per dict object.
+    
+    Args:
+        schema_info (dict, optional): Schema whose renderings to drop. Drops everything if not provided.
+    """
+    with _schema_render_cache_lock:
+        if schema_info is None:
+            _schema_render_cache.clear()
+            _schema_fingerprint_cache.clear()
+            return
+        entry = _schema_fingerprint_cache.pop(id(schema_info), None)
+        if entry is None or entry[0] is not schema_info:
+            return
+        for cache_key in [key for key in _schema_render_cache if key[0] == entry[1]]:
+            del _schema_render_cache[cache_key]
+
+def render_schema_bullets(schema_info):
+    """Render the schema as a table header followed by one bullet per column."""
     schema_text = []
     
     for table_name, columns in schema_info.items():
@@ -406,4 +2996,245 @@ def format_schema_for_prompt(schema_info):
         
         schema_text.append(table_desc)
     
-    return "\n\n".join(schema_text) 
\ No newline at end of file
+    return "\n\n".join(schema_text)
+
+def render_schema_ddl(schema_info):
+    """Render the schema as compact one-line CREATE TABLE statements, including foreign key references."""
+    statements = []
+    
+    for table_name, columns in schema_info.items():
+        column_defs = []
+        for col in columns:
+            column_def = f"{col['name']} {col['type']}".rstrip()
+            if col['is_primary_key']:
+                column_def += " PRIMARY KEY"
+            elif col['notnull']:
+                column_def += " NOT NULL"
+            if col.get('foreign_key'):
+                column_def += f" REFERENCES {col['foreign_key']['table']}({col['foreign_key']['column']})"
+            column_defs.append(column_def)
+        statements.append(f"CREATE TABLE {table_name} ({', '.join(column_defs)});")
+    
+    return "\n".join(statements)
+
+# Question words mapped to the schema vocabulary they usually refer to
+_SCHEMA_SYNONYMS = {
+    "spent": ["amount", "total", "price"],
+    "spend": ["amount", "total", "price"],
+    "revenue": ["amount", "total", "price", "sale"],
+    "sale": ["order", "amount", "total"],
+    "sold": ["order", "quantity"],
+    "earn": ["amount", "total"],
+    "cost": ["price", "amount"],
+    "expensive": ["price"],
+    "cheap": ["price"],
+    "client": ["customer"],
+    "buyer": ["customer"],
+    "user": ["customer"],
+    "purchase": ["order"],
+    "bought": ["order"],
+    "buy": ["order"],
+    "item": ["product", "order_item"],
+    "vendor": ["supplier"],
+    "stock": ["quantity", "inventory"],
+    "inventory": ["stock", "quantity"],
+    "when": ["date", "time", "created"],
+    "date": ["created", "time"],
+    "recent": ["date", "created"],
+    "location": ["city", "state", "address", "country"],
+    "where": ["city", "state", "address", "country"],
+    "contact": ["email", "phone"],
+    "loyal": ["loyalty"]
+}
+
+def _identifier_tokens(name):
+    """Split a snake_case or camelCase identifier into stemmed lowercase words."""
+    words = re.sub(r'([a-z0-9])([A-Z])', r'\1 \2', name).replace('_', ' ').lower().split()
+    return {_stem_word(word) for word in words}
+
+def _relevance_terms(text):
+    """Stemmed words of the text plus the schema vocabulary their synonyms point to."""
+    terms = set()
+    for word in re.findall(r"[a-z0-9_]+", text.lower()):
+        if word in _QUESTION_STOPWORDS:
+            continue
+        terms |= _identifier_tokens(word)
+        for synonym in _SCHEMA_SYNONYMS.get(_stem_word(word), []):
+            terms |= _identifier_tokens(synonym)
+    return terms
+
+def schema_foreign_keys(schema_info):
+    """
+    List foreign key relationships, using declared keys and falling back to <table>_id naming.
+    
+    Args:
+        schema_info (dict): Dictionary containing database schema information
+    
+    Returns:
+        list: (table, column, referenced_table, referenced_column) tuples
+    """
+    tables_by_stem = {_stem_word(table.lower()): table for table in schema_info}
+    foreign_keys = []
+    
+    for table_name, columns in schema_info.items():
+        for col in columns:
+            declared = col.get('foreign_key')
+            if declared:
+                foreign_keys.append((table_name, col['name'], declared['table'], declared['column']))
+                continue
+            
+            name = col['name'].lower()
+            if name.endswith('_id') and not col.get('is_primary_key'):
+                referenced = tables_by_stem.get(_stem_word(name[:-3]))
+                if referenced and referenced != table_name:
+                    referenced_columns = [c['name'] for c in schema_info[referenced]]
+                    if col['name'] in referenced_columns:
+                        foreign_keys.append((table_name, col['name'], referenced, col['name']))
+    return foreign_keys
+
+def estimate_tokens(text):
+    """Estimate the number of prompt tokens in a text, using tiktoken when it is installed."""
+    try:
+        import tiktoken
+        return len(tiktoken.encoding_for_model(OPENAI_MODEL).encode(text))
+    except Exception:
+        # Roughly four characters per token for English text and SQL identifiers
+        return (len(text) + 3) // 4
+
+def prune_schema(schema_info, relevance_text, top_k=None, max_columns=None):
+    """
+    Keep only the tables and columns relevant to a question.
+    
+    Tables are ranked by matches between the question and table names, column names, synonyms and
+    sample values, then expanded along foreign keys to include referenced lookup tables and bridge
+    tables between the selected ones. Wide tables keep key and matching columns first.
+    
+    Args:
+        schema_info (dict): Dictionary containing database schema information
+        relevance_text (str): Question or SQL the prompt is about
+        top_k (int, optional): Tables to keep before foreign key expansion. Defaults to SCHEMA_PRUNE_TOP_K.
+        max_columns (int, optional): Columns to keep per table. Defaults to SCHEMA_PRUNE_MAX_COLUMNS.
+    
+    Returns:
+        dict: Pruned schema, or the original schema when nothing matches or it is already small enough
+    """
+    top_k = SCHEMA_PRUNE_TOP_K if top_k is None else top_k
+    max_columns = SCHEMA_PRUNE_MAX_COLUMNS if max_columns is None else max_columns
+    widest_table = max((len(columns) for columns in schema_info.values()), default=0)
+    if top_k <= 0 or (len(schema_info) <= top_k and widest_table <= max_columns):
+        return schema_info
+    
+    terms = _relevance_terms(relevance_text)
+    text_lower = relevance_text.lower()
+    table_scores = {}
+    column_scores = {}
+    
+    for table_name, columns in schema_info.items():
+        score = 3 * len(_identifier_tokens(table_name) & terms)
+        if table_name.lower() in text_lower:
+            score += 5
+        
+        for col in columns:
+            col_score = 2 * len(_identifier_tokens(col['name']) & terms)
+            if col['name'].lower() in text_lower:
+                col_score += 3
+            if any(str(value).lower() in text_lower for value in col.get('sample_values', []) if len(str(value)) > 2):
+                col_score += 4
+            column_scores[(table_name, col['name'])] = col_score
+            # Column matches count for less than table matches and are capped so wide tables do not dominate
+            score += min(col_score, 4)
+        
+        table_scores[table_name] = score
+    
+    ranked = [table for table in sorted(table_scores, key=table_scores.get, reverse=True) if table_scores[table] > 0]
+    if not ranked:
+        return schema_info
+    selected = set(ranked[:top_k])
+    
+    # Expand along foreign keys: referenced lookup tables and bridge tables joining two selected tables
+    foreign_keys = schema_foreign_keys(schema_info)
+    expansion = set()
+    for table, _, referenced, _ in foreign_keys:
+        if table in selected and referenced not in selected:
+            expansion.add(referenced)
+    for table in schema_info:
+        if table in selected:
+            continue
+        linked = {referenced for source, _, referenced, _ in foreign_keys if source == table and referenced in selected}
+        if len(linked) >= 2:
+            expansion.add(table)
+    selected |= set(sorted(expansion, key=table_scores.get, reverse=True)[:max(1, top_k // 2)])
+    
+    key_columns = {(table, column) for table, column, _, _ in foreign_keys}
+    key_columns |= {(referenced, column) for _, _, referenced, column in foreign_keys}
+    
+    pruned = {}
+    for table_name, columns in schema_info.items():
+        if table_name not in selected:
+            continue
+        if len(columns) <= max_columns:
+            pruned[table_name] = columns
+            continue
+        
+        def column_priority(col):
+            is_key = col.get('is_primary_key') or (table_name, col['name']) in key_columns
+            return (not is_key, -column_scores[(table_name, col['name'])])
+        
+        kept = {col['name'] for col in sorted(columns, key=column_priority)[:max_columns]}
+        # Keep the original column order so the rendered schema stays readable
+        pruned[table_name] = [col for col in columns if col['name'] in kept]
+    return pruned
+
+_schema_pruning_stats = {"prompts": 0, "pruned_prompts": 0, "full_tokens": 0, "prompt_tokens": 0}
+_schema_pruning_stats_lock = threading.Lock()
+
+def _schema_for_prompt(schema_info, relevance_text):
+    """
+    Render the schema for a prompt, pruned to the parts relevant to the question or SQL.
+    
+    Args:
+        schema_info (dict or str): Database schema information
+        relevance_text (str): Question and/or SQL the prompt is about
+    
+    Returns:
+        str: Schema description for the prompt
+    """
+    if not isinstance(schema_info, dict):
+        # Use the schema string directly if provided
+        return schema_info
+    
+    pruned_schema = prune_schema(schema_info, relevance_text)
+    if pruned_schema is schema_info:
+        schema_description = format_schema_for_prompt(schema_info)
+    else:
+        # Pruned schemas are fresh dicts on every prompt; memoizing them would only evict the full schema's entries
+        schema_description = _schema_renderer(SCHEMA_PROMPT_STYLE)(pruned_schema)
+    
+    full_tokens = _schema_prompt_tokens(schema_info)
+    prompt_tokens = full_tokens if pruned_schema is schema_info else estimate_tokens(schema_description)
+    with _schema_pruning_stats_lock:
+        _schema_pruning_stats["prompts"] += 1
+        _schema_pruning_stats["pruned_prompts"] += pruned_schema is not schema_info
+        _schema_pruning_stats["full_tokens"] += full_tokens
+        _schema_pruning_stats["prompt_tokens"] += prompt_tokens
+    
+    collector = _usage_collector.get()
+    if collector is not None:
+        with collector["lock"]:
+            collector["schema_tokens_saved"] += full_tokens - prompt_tokens
+    
+    if pruned_schema is not schema_info:
+        print(f"Schema pruned to {len(pruned_schema)} of {len(schema_info)} tables, saving ~{full_tokens - prompt_tokens} prompt tokens")
+    return schema_description
+
+def get_schema_pruning_stats():
+    """
+    Report how many schema prompt tokens pruning has saved.
+    
+    Returns:
+        dict: Prompt counts, estimated full and sent schema tokens, and tokens saved
+    """
+    with _schema_pruning_stats_lock:
+        stats = dict(_schema_pruning_stats)
+    stats["tokens_saved"] = stats["full_tokens"] - stats["prompt_tokens"]
+    return stats
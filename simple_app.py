@@ -1,17 +1,16 @@
 import streamlit as st
-import sqlite3
 import pandas as pd
-from llm_sql import gpt_generate_sql, explain_query, generate_followup_questions, suggest_question_improvements, analyze_query
+from llm_sql import analyze_query, iter_question_pipeline, get_openai_client, get_openai_connection_stats, get_generation_mode_stats, get_generation_cache, get_schema_pruning_stats, invalidate_schema_cache, get_latency_stats, get_resilience_stats, get_tail_latency_stats, get_coalescing_stats, get_fast_path_stats, fetch_question_improvement, get_question_improvement_stats, explain_query, get_annotation_cache_stats, get_speculative_warmer, get_sql_repair_stats, normalize_sql
+from db_utils import ResultPager, get_result_cache, connection_fingerprint, plan_pagination, result_column_types, get_engine, get_pool_stats, get_sqlite_pool, close_sqlite_pool, get_sqlite_pool_stats, validate_sql, is_read_only_select, get_sqlite_indexes, get_sqlalchemy_indexes, explain_query_plan, plan_needs_confirmation, GovernedQuery, QueryTimeoutError, QueryCancelledError, SQLGLOT_DIALECTS, QUERY_COST_THRESHOLDS, QUERY_TIMEOUT, QUERY_MAX_ROWS, QUERY_MAX_RESULT_MB
 import os
 import tempfile
 import sqlalchemy
 import mysql.connector
-from sqlalchemy import create_engine, inspect
+from sqlalchemy import inspect
 import time
-import hashlib
 import traceback
+import uuid
 from dotenv import load_dotenv
-from openai import OpenAI
 import re
 
 # Load environment variables from .env file
@@ -19,6 +18,9 @@ load_dotenv()
 
 st.set_page_config(page_title="Text-to-SQL AI", layout="wide")
 
+# Distinct sample values read per text column so schema pruning can match values named in questions (0 disables)
+SCHEMA_SAMPLE_VALUES = int(os.environ.get("SCHEMA_SAMPLE_VALUES", "5"))
+
 # Initialize session state for API key
 if 'api_key' not in st.session_state:
     st.session_state.api_key = os.environ.get("OPENAI_API_KEY", "")
@@ -39,9 +41,6 @@ if 'schema_info' not in st.session_state:
 if 'schema_text' not in st.session_state:
     st.session_state.schema_text = ""
 
-# Query cache implementation
-if 'query_cache' not in st.session_state:
-    st.session_state.query_cache = {}
 
 # Pagination state
 if 'page_number' not in st.session_state:
@@ -66,6 +65,14 @@ if 'current_explanation' not in st.session_state:
 if 'improved_question' not in st.session_state:
     st.session_state.improved_question = ""
 
+# How the current SQL was produced (LLM call or generation cache) and how long it took
+if 'last_generation' not in st.session_state:
+    st.session_state.last_generation = {}
+
+# Identifies this browser session to the background follow-up warm-up
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
 # Query history tracking
 if 'query_history' not in st.session_state:
     st.session_state.query_history = []
@@ -111,37 +118,104 @@ def remove_favorite_query(question):
     # Return True if something was removed
     return len(st.session_state.favorite_queries) < initial_length
 
-# Function to generate cache key for a query
-def get_cache_key(query):
-    # Create a hash of the query for cache key
-    return hashlib.md5(query.encode('utf-8')).hexdigest()
+def request_explanation():
+    """Explain the current SQL when the user asks for it in on-demand mode."""
+    sql_query = st.session_state.get('current_sql')
+    if not sql_query:
+        return
+    st.session_state.current_explanation = explain_query(
+        sql_query, st.session_state.schema_info, api_key=st.session_state.api_key
+    )
+    st.session_state.explained_sql = sql_query
+
+def request_question_suggestion():
+    """Fetch the rewording suggestion that was skipped when the question was run."""
+    question = st.session_state.get('suggestion_skipped_for')
+    if not question:
+        return
+    st.session_state.improved_question = fetch_question_improvement(
+        question, st.session_state.schema_info, api_key=st.session_state.api_key
+    )
+    st.session_state.suggestion_skipped_for = None
+
+def request_fresh_generation():
+    """Re-run the current question with a new AI generation instead of reusing similar or rule-based SQL."""
+    st.session_state.force_fresh_generation = True
+
+def confirm_expensive_query(sql_query):
+    """Execute the SQL on screen even though its plan is above the cost threshold or could not be costed."""
+    st.session_state.confirmed_expensive_sql = sql_query
+    st.session_state.force_confirmed_execution = True
+
+def replay_current_sql():
+    """
+    Pipeline events for the SQL already on screen, so a confirmed query runs without asking the AI again.
+    
+    A new generation would cost calls and could return different SQL than the one confirmed.
+    """
+    yield "generation", st.session_state.last_generation
+    yield "sql", st.session_state.current_sql
+    if st.session_state.current_explanation:
+        yield "explanation", st.session_state.current_explanation
+
+def cancel_running_query():
+    """Interrupt the query this session is running."""
+    running_query = st.session_state.get('running_query')
+    if running_query is not None:
+        running_query.stop("cancelled")
+    st.session_state.query_cancelled = True
+
+# Results are cached process-wide, keyed by the connected database and the normalized query
+def get_connection_fingerprint():
+    """Fingerprint of the connected database for result cache keys."""
+    db_type = st.session_state.db_type
+    if db_type == "sqlite":
+        return connection_fingerprint(db_type, db_path=st.session_state.db_path)
+    connection_args = tuple(st.session_state.get(attr) for attr in ['db_host', 'db_port', 'db_name', 'db_user', 'db_password'])
+    return connection_fingerprint(db_type, connection_string=get_connection_string(db_type, *connection_args))
+
+def get_cache_key(query, fingerprint=None, db_type=None):
+    """Key of a query in the shared result cache, against the connected database unless one is given."""
+    db_type = db_type or st.session_state.db_type
+    # MySQL table names can be case-sensitive, so its queries keep their case
+    return fingerprint or get_connection_fingerprint(), normalize_sql(query, lowercase=db_type != "mysql")
 
 # Database connection functions
-def get_sqlite_connection(db_path):
-    """Connect to an SQLite database."""
+def get_sqlite_connection(db_path, immutable=False):
+    """
+    Check a read-only connection to an SQLite database out of its shared pool.
+    
+    Closing the connection returns it to the pool. Uploaded copies are opened as immutable snapshots.
+    """
     try:
         if not db_path:
             return None
             
-        conn = sqlite3.connect(db_path, check_same_thread=False)
+        conn = get_sqlite_pool(db_path, immutable=immutable).acquire()
         print(f"SQLite connection successful to {db_path}")
         return conn
     except Exception as e:
         st.error(f"Error connecting to SQLite database: {str(e)}")
         return None
 
+def get_connection_string(db_type, host, port, database, username, password):
+    """Build the SQLAlchemy URL for a MySQL or PostgreSQL database, or None for other types."""
+    if db_type == "mysql":
+        return f"mysql+mysqlconnector://{username}:{password}@{host}:{port}/{database}"
+    if db_type == "postgresql":
+        return f"postgresql://{username}:{password}@{host}:{port}/{database}"
+    return None
+
 def get_sql_connection(db_type, host, port, database, username, password):
     """Connect to various SQL databases using SQLAlchemy."""
     try:
-        if db_type == "mysql":
-            connection_string = f"mysql+mysqlconnector://{username}:{password}@{host}:{port}/{database}"
-        elif db_type == "postgresql":
-            connection_string = f"postgresql://{username}:{password}@{host}:{port}/{database}"
-        else:
+        connection_string = get_connection_string(db_type, host, port, database, username, password)
+        if connection_string is None:
             st.error(f"Unsupported database type: {db_type}")
             return None, None
             
-        engine = create_engine(connection_string)
+        # The engine and its connection pool are shared by every query and session using this database
+        engine = get_engine(connection_string)
         conn = engine.connect()
         print(f"{db_type.upper()} connection successful to {host}:{port}/{database}")
         return conn, engine
@@ -153,7 +227,7 @@ def get_sql_connection(db_type, host, port, database, username, password):
 def get_database_connection():
     """Get database connection based on session state."""
     if st.session_state.db_type == "sqlite":
-        return get_sqlite_connection(st.session_state.db_path)
+        return get_sqlite_connection(st.session_state.db_path, immutable=st.session_state.get('db_snapshot', False))
     else:
         conn, _ = get_sql_connection(
             st.session_state.db_type,
@@ -172,68 +246,82 @@ def get_sqlite_schema(db_path):
         if not db_path:
             return "", {}
             
-        conn = sqlite3.connect(db_path, check_same_thread=False)
-        cursor = conn.cursor()
+        # The connection goes back to the pool even when reading the schema fails
+        with get_sqlite_pool(db_path).connection() as conn:
+            cursor = conn.cursor()
         
-        # Get all table names
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        tables = cursor.fetchall()
+            # Get all table names
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
+            tables = cursor.fetchall()
         
-        schema_info = {}
-        schema_text = ""
+            schema_info = {}
+            schema_text = ""
         
-        for table in tables:
-            table_name = table[0]
-            schema_text += f"<div class='table-header'>📊 Table: <span class='table-name'>{table_name}</span></div>\n"
-            cursor.execute(f"PRAGMA table_info({table_name});")
-            columns = cursor.fetchall()
+            for table in tables:
+                table_name = table[0]
+                schema_text += f"<div class='table-header'>📊 Table: <span class='table-name'>{table_name}</span></div>\n"
+                cursor.execute(f"PRAGMA table_info({table_name});")
+                columns = cursor.fetchall()
             
-            column_info = []
-            for col in columns:
-                col_type = col[2]
-                # Apply different colors based on data type
-                if 'INT' in col_type.upper():
-                    type_class = 'number-type'
-                elif 'TEXT' in col_type.upper() or 'CHAR' in col_type.upper():
-                    type_class = 'text-type'
-                elif 'REAL' in col_type.upper() or 'FLOAT' in col_type.upper() or 'DOUB' in col_type.upper():
-                    type_class = 'float-type'
-                elif 'DATE' in col_type.upper() or 'TIME' in col_type.upper():
-                    type_class = 'date-type'
-                else:
-                    type_class = 'other-type'
+                # Declared foreign keys: PRAGMA foreign_key_list rows are (id, seq, table, from, to, ...)
+                cursor.execute(f"PRAGMA foreign_key_list({table_name});")
+                foreign_keys = {fk[3]: {"table": fk[2], "column": fk[4] or fk[3]} for fk in cursor.fetchall()}
+            
+                column_info = []
+                for col in columns:
+                    col_type = col[2]
+                    # Apply different colors based on data type
+                    if 'INT' in col_type.upper():
+                        type_class = 'number-type'
+                    elif 'TEXT' in col_type.upper() or 'CHAR' in col_type.upper():
+                        type_class = 'text-type'
+                    elif 'REAL' in col_type.upper() or 'FLOAT' in col_type.upper() or 'DOUB' in col_type.upper():
+                        type_class = 'float-type'
+                    elif 'DATE' in col_type.upper() or 'TIME' in col_type.upper():
+                        type_class = 'date-type'
+                    else:
+                        type_class = 'other-type'
                 
-                # Add primary key indicator
-                pk_class = ' primary-key' if col[5] else ''
+                    # Add primary key indicator
+                    pk_class = ' primary-key' if col[5] else ''
                 
-                schema_text += f"<div class='column-row{pk_class}'>"
-                schema_text += f"<span class='column-name'>{col[1]}</span>"
-                schema_text += f"<span class='column-type {type_class}'>({col_type})</span>"
+                    schema_text += f"<div class='column-row{pk_class}'>"
+                    schema_text += f"<span class='column-name'>{col[1]}</span>"
+                    schema_text += f"<span class='column-type {type_class}'>({col_type})</span>"
                 
-                # Add constraints indicators
-                constraints = []
-                if col[5]:  # is_pk
-                    constraints.append("<span class='pk-badge'>PK</span>")
-                if col[3]:  # not_null
-                    constraints.append("<span class='nn-badge'>NN</span>")
+                    # Add constraints indicators
+                    constraints = []
+                    if col[5]:  # is_pk
+                        constraints.append("<span class='pk-badge'>PK</span>")
+                    if col[3]:  # not_null
+                        constraints.append("<span class='nn-badge'>NN</span>")
                 
-                if constraints:
-                    schema_text += f"<span class='constraints'>{''.join(constraints)}</span>"
+                    if constraints:
+                        schema_text += f"<span class='constraints'>{''.join(constraints)}</span>"
                 
-                schema_text += "</div>\n"
+                    schema_text += "</div>\n"
                 
-                column_info.append({
-                    "name": col[1],
-                    "type": col[2],
-                    "notnull": col[3],
-                    "default_value": col[4],
-                    "is_primary_key": col[5]
-                })
+                    column_entry = {
+                        "name": col[1],
+                        "type": col[2],
+                        "notnull": col[3],
+                        "default_value": col[4],
+                        "is_primary_key": col[5]
+                    }
+                    if col[1] in foreign_keys:
+                        column_entry["foreign_key"] = foreign_keys[col[1]]
+                    if type_class == 'text-type' and SCHEMA_SAMPLE_VALUES > 0:
+                        # Ordered so the same values come back every time; they feed the schema fingerprint the caches are keyed on
+                        cursor.execute(
+                            f'SELECT DISTINCT "{col[1]}" FROM "{table_name}" WHERE "{col[1]}" IS NOT NULL '
+                            f'ORDER BY "{col[1]}" LIMIT {SCHEMA_SAMPLE_VALUES}'
+                        )
+                        column_entry["sample_values"] = [row[0] for row in cursor.fetchall()]
+                    column_info.append(column_entry)
             
-            schema_info[table_name] = column_info
-            print(f"Processed schema for SQLite table: {table_name} ({len(column_info)} columns)")
+                schema_info[table_name] = column_info
+                print(f"Processed schema for SQLite table: {table_name} ({len(column_info)} columns)")
         
-        conn.close()
         return schema_text, schema_info
     except Exception as e:
         st.error(f"Error reading SQLite schema: {str(e)}")
@@ -256,6 +344,12 @@ def get_sql_schema(engine):
             schema_text += f"<div class='table-header'>📊 Table: <span class='table-name'>{table_name}</span></div>\n"
             columns = inspector.get_columns(table_name)
             
+            # Declared foreign keys (single-column references only)
+            foreign_keys = {}
+            for fk in inspector.get_foreign_keys(table_name):
+                for local_col, referred_col in zip(fk['constrained_columns'], fk['referred_columns']):
+                    foreign_keys[local_col] = {"table": fk['referred_table'], "column": referred_col}
+            
             column_info = []
             for col in columns:
                 col_type = str(col['type'])
@@ -291,13 +385,25 @@ def get_sql_schema(engine):
                 
                 schema_text += "</div>\n"
                 
-                column_info.append({
+                column_entry = {
                     "name": col['name'],
                     "type": col_type,
                     "notnull": not col.get('nullable', True),
                     "default_value": str(col.get('default', "")),
                     "is_primary_key": col.get('primary_key', False)
-                })
+                }
+                if col['name'] in foreign_keys:
+                    column_entry["foreign_key"] = foreign_keys[col['name']]
+                if type_class == 'text-type' and SCHEMA_SAMPLE_VALUES > 0:
+                    quote = engine.dialect.identifier_preparer.quote
+                    # Ordered so the same values come back every time; they feed the schema fingerprint the caches are keyed on
+                    with engine.connect() as sample_conn:
+                        rows = sample_conn.execute(sqlalchemy.text(
+                            f"SELECT DISTINCT {quote(col['name'])} FROM {quote(table_name)} "
+                            f"WHERE {quote(col['name'])} IS NOT NULL ORDER BY {quote(col['name'])} LIMIT {SCHEMA_SAMPLE_VALUES}"
+                        )).fetchall()
+                    column_entry["sample_values"] = [str(row[0]) for row in rows]
+                column_info.append(column_entry)
             
             schema_info[table_name] = column_info
             print(f"Processed schema for SQL table: {table_name} ({len(column_info)} columns)")
@@ -309,65 +415,124 @@ def get_sql_schema(engine):
 
 def update_schema():
     """Update schema information based on current connection."""
+    # Drop memoized prompt renderings of the schema being replaced
+    invalidate_schema_cache(st.session_state.schema_info)
     if st.session_state.db_type == "sqlite":
         st.session_state.schema_text, st.session_state.schema_info = get_sqlite_schema(st.session_state.db_path)
     else:
-        # For MySQL/PostgreSQL
-        _, engine = get_sql_connection(
+        # For MySQL/PostgreSQL; the inspector checks connections out of the shared pool itself
+        engine = get_engine(get_connection_string(
             st.session_state.db_type,
             st.session_state.db_host,
             st.session_state.db_port,
             st.session_state.db_name,
             st.session_state.db_user,
             st.session_state.db_password
-        )
+        ))
         if engine:
             st.session_state.schema_text, st.session_state.schema_info = get_sql_schema(engine)
+            try:
+                st.session_state.schema_indexes = get_sqlalchemy_indexes(engine)
+            except Exception as e:
+                print(f"Could not read index metadata: {str(e)}")
+                st.session_state.schema_indexes = None
+
+def get_index_metadata():
+    """Indexes of the connected database for query analysis, or None if they cannot be read."""
+    if st.session_state.db_type == "sqlite":
+        # Read fresh each time so indexes created after connecting are seen
+        try:
+            return get_sqlite_indexes(st.session_state.db_path)
+        except Exception as e:
+            print(f"Could not read index metadata: {str(e)}")
+            return None
+    return st.session_state.get('schema_indexes')
+
+def history_generation_fields(generation_info):
+    """Details about how the SQL was generated, recorded alongside its execution in history."""
+    generation_info = generation_info or {}
+    return {
+        'sql_source': generation_info.get('source', 'manual'),
+        'generation_time': generation_info.get('generation_time', 0),
+        'generation_first_token_time': generation_info.get('first_token_time'),
+        'sql_repair_attempts': generation_info.get('repair_attempts', 0)
+    }
 
 # Execute SQL query with caching
-def execute_sql_query(query, use_cache=True, user_question=""):
-    """Execute SQL query and return results as a DataFrame."""
+def execute_sql_query(query, use_cache=True, user_question="", generation_info=None, timeout=None, max_rows=None, max_bytes=None):
+    """
+    Execute SQL query and return results as a DataFrame.
+    
+    The query runs under the governor limits; timeout, max_rows and max_bytes override the deployment
+    defaults for this query. Details of a truncated result are left in st.session_state.last_execution.
+    """
     conn = None
+    query_run = None
+    generation_fields = history_generation_fields(generation_info)
     try:
         # Check if we have this query in cache
         cache_key = get_cache_key(query)
-        if use_cache and cache_key in st.session_state.query_cache:
-            cache_entry = st.session_state.query_cache[cache_key]
-            # Check if cache is not too old (30 minutes)
-            if time.time() - cache_entry['timestamp'] < 1800:
-                print(f"Using cached result for query (cache age: {int(time.time() - cache_entry['timestamp'])}s)")
-                
-                # Still add to history when using cache
-                if not any(item['query'] == query for item in st.session_state.query_history):
-                    history_entry = {
-                        'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
-                        'user_question': user_question,
-                        'query': query,
-                        'execution_time': cache_entry['execution_time'],
-                        'rows_returned': len(cache_entry['data']),
-                        'from_cache': True
-                    }
-                    st.session_state.query_history.append(history_entry)
-                
-                return cache_entry['data'], None, True
+        cache_entry = get_result_cache().get(*cache_key) if use_cache else None
+        if cache_entry is not None:
+            print(f"Using cached result for query (cache age: {int(time.time() - cache_entry['timestamp'])}s)")
+            
+            # Still add to history when using cache
+            if not any(item['query'] == query for item in st.session_state.query_history):
+                history_entry = {
+                    'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'user_question': user_question,
+                    'query': query,
+                    'execution_time': cache_entry['execution_time'],
+                    'rows_returned': len(cache_entry['data']),
+                    'from_cache': True,
+                    **generation_fields
+                }
+                st.session_state.query_history.append(history_entry)
+            
+            st.session_state.last_execution = None
+            st.session_state.cached_execution_time = cache_entry['execution_time']
+            return cache_entry['data'], None, True
         
-        # Not in cache or cache disabled, execute the query
-        # Create a new connection for each query execution
+        # Not in cache or cache disabled, execute the query on a pooled connection
         conn = get_database_connection()
         if conn is None:
             return None, "Database connection failed", False
             
         print(f"Executing SQL query: {query}")
         
-        start_time = time.time()
-        if st.session_state.db_type == "sqlite":
-            df = pd.read_sql_query(query, conn)
-        else:
-            # For SQL Alchemy connections
-            df = pd.read_sql_query(sqlalchemy.text(query), conn)
-        
-        execution_time = time.time() - start_time
-        print(f"Query executed successfully in {execution_time:.2f}s, returned {len(df)} rows")
+        query_run = GovernedQuery(
+            query, st.session_state.db_type, conn, timeout=timeout, max_rows=max_rows, max_bytes=max_bytes,
+            close_connection=True, column_types=result_column_types(
+                query, st.session_state.schema_info, SQLGLOT_DIALECTS.get(st.session_state.db_type, "sqlite")
+            )
+        ).start()
+        st.session_state.running_query = query_run
+        status_placeholder = st.empty()
+        with status_placeholder.container():
+            st.button("⏹️ Cancel query", key="cancel_query_btn", on_click=cancel_running_query)
+            elapsed_placeholder = st.empty()
+            preview_placeholder = st.empty()
+        try:
+            # Streamlit can only stop a script between its own calls, so poll the worker instead of blocking on it
+            preview_shown = False
+            while not query_run.wait(0.1):
+                if not preview_shown and query_run.rows_fetched:
+                    # Show the first batch while the rest of the result is still arriving
+                    preview_placeholder.dataframe(query_run.batches_since(0, 1)[0], use_container_width=True)
+                    preview_shown = True
+                elapsed_placeholder.caption(f"⏳ {query_run.rows_fetched:,} rows received in {query_run.elapsed():.1f}s")
+        finally:
+            # A rerun (e.g. from the cancel button) stops the script here; do not leave the statement running
+            if not query_run.done():
+                query_run.stop("cancelled")
+            status_placeholder.empty()
+            st.session_state.running_query = None
+        outcome = query_run.result()
+        df = outcome['data']
+        execution_time = outcome['execution_time']
+        st.session_state.last_execution = outcome if outcome['truncated'] else None
+        print(f"Query executed successfully in {execution_time:.2f}s, returned {len(df)} rows"
+              + (f" (truncated at the {outcome['truncated_by']})" if outcome['truncated'] else ""))
         
         # Add to query history
         history_entry = {
@@ -376,17 +541,15 @@ def execute_sql_query(query, use_cache=True, user_question=""):
             'query': query,
             'execution_time': execution_time,
             'rows_returned': len(df),
-            'from_cache': False
+            'truncated': outcome['truncated'],
+            'from_cache': False,
+            **generation_fields
         }
         st.session_state.query_history.append(history_entry)
         
-        # Cache the result
-        if use_cache:
-            st.session_state.query_cache[cache_key] = {
-                'data': df.copy(),
-                'timestamp': time.time(),
-                'execution_time': execution_time
-            }
+        # Cache the result, unless it was cut off by limits a later run might raise
+        if use_cache and not outcome['truncated']:
+            get_result_cache().put(*cache_key, st.session_state.db_type, df, execution_time, nbytes=outcome['bytes'])
         
         return df, None, False
     except Exception as e:
@@ -401,16 +564,123 @@ def execute_sql_query(query, use_cache=True, user_question=""):
             'execution_time': 0,
             'rows_returned': 0,
             'error': str(e),
-            'from_cache': False
+            'from_cache': False,
+            **generation_fields
         }
         st.session_state.query_history.append(history_entry)
         
         return None, error_msg, False
     finally:
-        # Always close the connection
-        if conn:
-            if st.session_state.db_type != "sqlite":
-                conn.close()
+        # A started query returns its connection to the pool itself once the statement has finished
+        if conn and query_run is None:
+            conn.close()
+
+def make_sql_validator():
+    """Build a callable that checks generated SQL against the connected database without running it."""
+    db_type = st.session_state.db_type
+    db_path = st.session_state.db_path
+    
+    def validate(query):
+        return validate_sql(query, db_type, db_path=db_path)
+    
+    return validate
+
+def make_connection_factory():
+    """
+    Build a callable that checks a connection to the connected database out of its pool.
+    
+    Session state cannot be read from background threads, so the connection settings are captured now.
+    """
+    db_type = st.session_state.db_type
+    if db_type == "sqlite":
+        pool = get_sqlite_pool(st.session_state.db_path, immutable=st.session_state.get('db_snapshot', False))
+        return pool.acquire
+    connection_args = tuple(st.session_state.get(attr) for attr in ['db_host', 'db_port', 'db_name', 'db_user', 'db_password'])
+    return get_engine(get_connection_string(db_type, *connection_args)).connect
+
+def make_speculative_executor(cost_threshold):
+    """
+    Build a callable that runs a warmed-up follow-up query off the script thread into the shared result cache.
+    
+    Nobody reviews warm-up SQL before it runs, so only a single read-only SELECT that compiles and whose
+    plan can be read and is under the cost threshold is run, in a read-only transaction on MySQL and
+    PostgreSQL. The callable returns False for SQL it declines to run.
+    
+    Session state cannot be read from background threads, so the connection factory and the cache key
+    function are captured now.
+    """
+    db_type = st.session_state.db_type
+    db_path = st.session_state.db_path
+    connect = make_connection_factory()
+    schema_info = st.session_state.schema_info
+    dialect = SQLGLOT_DIALECTS.get(db_type, "sqlite")
+    result_cache = get_result_cache()
+    fingerprint = get_connection_fingerprint()
+    
+    def run_query(query):
+        cache_key = get_cache_key(query, fingerprint=fingerprint, db_type=db_type)
+        if result_cache.contains(*cache_key):
+            return True
+        if not is_read_only_select(query, db_type):
+            print("Not warming up a follow-up query that is not a single read-only SELECT")
+            return False
+        validation_error = validate_sql(query, db_type, db_path=db_path)
+        if validation_error:
+            print(f"Not warming up an invalid follow-up query: {validation_error}")
+            return False
+        conn = connect()
+        try:
+            if db_type == "sqlite":
+                plan = explain_query_plan(query, db_type, db_path=db_path)
+            else:
+                plan = explain_query_plan(query, db_type, conn=conn)
+                # EXPLAIN may have opened a transaction; start the query's own one read-only
+                conn.rollback()
+                conn.execute(sqlalchemy.text("SET TRANSACTION READ ONLY"))
+            if plan_needs_confirmation(plan, cost_threshold):
+                print("Not warming up a follow-up query whose plan is unreadable or above the cost threshold")
+                return False
+            outcome = GovernedQuery(query, db_type, conn, column_types=result_column_types(query, schema_info, dialect)).start().result()
+            if not outcome['truncated']:
+                result_cache.put(*cache_key, db_type, outcome['data'], outcome['execution_time'], nbytes=outcome['bytes'])
+            print(f"Warmed up follow-up query ({outcome['rows']} rows)")
+            return True
+        finally:
+            conn.close()
+    
+    return run_query
+
+def get_query_plan(query):
+    """Execution plan of a query on the connected database, read without running the query."""
+    if st.session_state.db_type == "sqlite":
+        return explain_query_plan(query, "sqlite", db_path=st.session_state.db_path)
+    conn = get_database_connection()
+    if conn is None:
+        return explain_query_plan(query, None)
+    try:
+        return explain_query_plan(query, st.session_state.db_type, conn=conn)
+    finally:
+        conn.close()
+
+def render_plan_nodes(nodes, depth=0):
+    """Render plan nodes as an indented tree, highlighting full scans, temporary structures and row estimates."""
+    for node in nodes:
+        badges = []
+        if node['full_scan']:
+            badges.append('<span style="color: #EF5350; font-weight: bold;">FULL SCAN</span>')
+        if node['temp_structure']:
+            badges.append('<span style="color: #FFA726; font-weight: bold;">TEMP STRUCTURE</span>')
+        if node['rows'] is not None:
+            badges.append(f'<strong>~{node["rows"]:,} rows</strong>')
+        if node['cost'] is not None:
+            badges.append(f'cost {node["cost"]:,.1f}')
+        border_color = "#EF5350" if node['full_scan'] else "#FFA726" if node['temp_structure'] else "#7c3aed"
+        st.markdown(f"""
+        <div style="margin: 2px 0 2px {depth * 24}px; padding: 4px 8px; border-left: 3px solid {border_color}; font-family: monospace; font-size: 0.9em;">
+            {node['label']} {' · '.join(badges)}
+        </div>
+        """, unsafe_allow_html=True)
+        render_plan_nodes(node['children'], depth + 1)
 
 # Function to display paginated results
 def display_paginated_results(df):
@@ -464,6 +734,132 @@ def display_paginated_results(df):
     # Display the paginated dataframe
     st.dataframe(df.iloc[start_row:end_row], use_container_width=True)
 
+def change_result_page(step):
+    """Move the database-paged result forward or back by a page."""
+    pager = st.session_state.get('result_pager')
+    if pager is not None:
+        pager.page_number = max(pager.page_number + step, 0)
+
+def jump_to_result_page():
+    """Open the page number typed in for an offset-paged result."""
+    pager = st.session_state.get('result_pager')
+    if pager is not None:
+        pager.page_number = max(int(st.session_state.result_page_input) - 1, 0)
+
+def resize_result_pages():
+    """Start the database-paged result over with the newly chosen page size."""
+    pager = st.session_state.get('result_pager')
+    if pager is not None:
+        st.session_state.result_pager = ResultPager(
+            pager.sql_query, pager.db_type, pager.connect, st.session_state.schema_info,
+            page_size=st.session_state.result_page_size_select, dialect=pager.dialect, timeout=pager.timeout
+        )
+
+# Function to display a result paged in the database, one page read per view
+def display_database_pages(pager):
+    st.markdown("### 📊 Query Results")
+    try:
+        page = pager.page()
+    except Exception as e:
+        st.error(f"❌ Could not read page {pager.page_number + 1}: {str(e)}")
+        return
+    estimated_total = pager.estimated_total()
+    start_row = pager.page_number * pager.page_size
+    
+    col1, col2, col3, col4 = st.columns([2, 1, 1, 2])
+    with col1:
+        st.button("◀️ Previous", key="result_prev_page_btn", disabled=pager.page_number <= 0,
+                  on_click=change_result_page, args=(-1,))
+    with col2:
+        if estimated_total:
+            st.write(f"Page {pager.page_number + 1} of ~{max(1, -(-estimated_total // pager.page_size)):,}")
+        else:
+            st.write(f"Page {pager.page_number + 1}")
+    with col3:
+        st.selectbox(
+            "Rows per page:",
+            options=[10, 25, 50, 100],
+            index=[10, 25, 50, 100].index(pager.page_size) if pager.page_size in [10, 25, 50, 100] else 0,
+            key="result_page_size_select",
+            on_change=resize_result_pages
+        )
+    with col4:
+        st.button("Next ▶️", key="result_next_page_btn", disabled=not page['has_next'],
+                  on_click=change_result_page, args=(1,))
+    
+    if pager.can_jump():
+        st.number_input("Go to page:", min_value=1, value=pager.page_number + 1, step=1,
+                        key="result_page_input", on_change=jump_to_result_page)
+    
+    st.caption(
+        f"Showing rows {start_row + 1:,} to {start_row + len(page['data']):,}"
+        + (f" of ~{estimated_total:,} (estimated)" if estimated_total else "")
+        + f" · {'keyset' if pager.mode == 'keyset' else 'LIMIT/OFFSET'} paging in the database"
+        + f" · page read in {page['read_time'] * 1000:.0f} ms"
+        + (" · prefetched" if page['prefetched'] else "")
+    )
+    st.dataframe(page['data'], use_container_width=True)
+
+# Function to display the plain English explanation of a query
+def render_explanation(explanation):
+    """Render an AI explanation as a list of bullet points."""
+    st.markdown("### 📖 Query Explanation")
+    
+    try:
+        # Clean the explanation - remove any unwanted HTML tags and content
+        explanation = explanation.replace("</div>", "")
+        # Remove any HTML tags using a more thorough approach
+        explanation = re.sub(r'<[^>]*>', '', explanation)
+        # Also remove any HTML entities that might cause issues
+        explanation = explanation.replace("&lt;", "<").replace("&gt;", ">").replace("&amp;", "&")
+        
+        # Add a custom styled container without nested HTML
+        st.markdown("""
+        <div class="explanation-box">
+            <span class="ai-badge">SQL Explained</span>
+        </div>
+        """, unsafe_allow_html=True)
+        
+        # Process and display each bullet point separately
+        explanation_lines = [line.strip() for line in explanation.split("\n") if line.strip()]
+        
+        # Check if we have any explanation lines
+        if not explanation_lines:
+            st.markdown("""
+            <div class="explanation-bullet">
+                <span class="bullet-point">•</span>
+                <span class="bullet-text">This query retrieves data from the database based on your request.</span>
+            </div>
+            """, unsafe_allow_html=True)
+        else:
+            for line in explanation_lines:
+                # Remove existing bullet points or numbers if present
+                if line.startswith(('•', '-', '*', '1.', '2.', '3.', '4.', '5.', '6.', '7.', '8.', '9.')):
+                    # Extract the content after the bullet point or number
+                    parts = line.split(' ', 1)
+                    if len(parts) > 1:
+                        line = parts[1].strip()
+                
+                # Only add non-empty lines that don't start with HTML tags
+                if line and not line.strip().startswith("<"):
+                    st.markdown(f"""
+                    <div class="explanation-bullet">
+                        <span class="bullet-point">•</span>
+                        <span class="bullet-text">{line}</span>
+                    </div>
+                    """, unsafe_allow_html=True)
+    except Exception as e:
+        # Log the error
+        print(f"Error rendering explanation: {str(e)}")
+        
+        # Display a fallback explanation
+        st.markdown("""
+        <div class="explanation-bullet">
+            <span class="bullet-point">•</span>
+            <span class="bullet-text">This SQL query will retrieve data from your database based on your request.</span>
+        </div>
+        """, unsafe_allow_html=True)
+
 # Custom CSS with additions for AI enhancements
 dark_theme_css = """
     <style>
@@ -1212,7 +1608,7 @@ with st.sidebar:
             try:
                 with st.spinner("Validating API key..."):
                     # Make a quick test call to the OpenAI API
-                    client = OpenAI(api_key=st.session_state.api_key)
+                    client = get_openai_client(st.session_state.api_key)
                     response = client.chat.completions.create(
                         model="gpt-3.5-turbo",
                         messages=[{"role": "user", "content": "test"}],
@@ -1235,6 +1631,81 @@ with st.sidebar:
     
     st.markdown("---")
     
+    # AI generation settings
+    st.header("🧠 AI Settings")
+    
+    llm_mode_label = st.radio(
+        "LLM call mode:",
+        ["Separate calls", "Combined call"],
+        key="llm_mode_select",
+        help="Combined mode sends the schema once and gets the SQL, explanation, improved question and follow-ups in a single response. Separate mode runs four concurrent calls."
+    )
+    llm_mode = "combined" if llm_mode_label == "Combined call" else "separate"
+    
+    stream_output = st.checkbox(
+        "Stream AI output",
+        value=True,
+        key="stream_output_checkbox",
+        help="Show the SQL and explanation as they are written instead of waiting for the full response (separate mode only)"
+    )
+    
+    suggestion_label = st.selectbox(
+        "Question suggestions:",
+        ["Only for unclear questions", "Always", "On demand"],
+        key="question_suggestion_select",
+        help="Asking the AI for a clearer wording costs an extra call. By default it is skipped when the question already names your tables and columns (separate mode only)."
+    )
+    improve_question_mode = {"Always": "always", "On demand": "on_demand"}.get(suggestion_label, "auto")
+    
+    explanation_label = st.radio(
+        "Query explanations:",
+        ["Automatic", "On demand"],
+        key="explanation_mode_select",
+        help="On demand skips the explanation call unless you ask for it; explanations already cached for the same SQL are still shown (separate mode only)"
+    )
+    explain_mode = "on_demand" if explanation_label == "On demand" else "eager"
+    
+    warm_followups = st.checkbox(
+        "Warm up follow-up questions",
+        value=True,
+        key="warm_followups_checkbox",
+        help="Generate SQL for the suggested follow-up questions in the background so picking one is instant"
+    )
+    run_warm_followups = st.checkbox(
+        "Also run follow-up queries in advance",
+        value=False,
+        key="run_warm_followups_checkbox",
+        disabled=not warm_followups,
+        help="Execute the warmed-up SQL into the result cache too. This puts extra load on your database."
+    )
+    
+    st.markdown("---")
+    
+    st.header("🛡️ Query Execution")
+    
+    result_paging_label = st.radio(
+        "Result paging:",
+        ["In memory", "In the database"],
+        key="result_paging_select",
+        help="In the database, only the page being viewed is read, using keyset pagination on the primary key when "
+             "the query allows it and LIMIT/OFFSET otherwise. LIMIT/OFFSET needs an ORDER BY for stable pages, so "
+             "unordered queries are paged in memory. Charts and exports need the in-memory mode."
+    )
+    result_paging = "database" if result_paging_label == "In the database" else "memory"
+    
+    cost_threshold_db_type = st.session_state.db_type if st.session_state.db_type in QUERY_COST_THRESHOLDS else "sqlite"
+    cost_threshold = st.number_input(
+        "Confirm plans costing more than:",
+        min_value=0.0,
+        value=QUERY_COST_THRESHOLDS[cost_threshold_db_type],
+        step=10000.0,
+        key=f"cost_threshold_{cost_threshold_db_type}",
+        help="Queries whose estimated plan cost is above this need confirmation before they run (0 disables the check). "
+             "SQLite plans are costed in estimated rows examined, MySQL and PostgreSQL plans in planner cost units."
+    )
+    
+    st.markdown("---")
+    
     st.header("🔌 Database Connection")
     
     # Database type selection
@@ -1290,11 +1761,12 @@ with st.sidebar:
                         tmp_file.write(uploaded_file.getvalue())
                         temp_db_path = tmp_file.name
                     
-                    # Test connection
-                    conn = get_sqlite_connection(temp_db_path)
+                    # Test connection; nothing else writes to the uploaded copy, so it is opened as an immutable snapshot
+                    conn = get_sqlite_connection(temp_db_path, immutable=True)
                     if conn:
                         st.session_state.db_type = "sqlite"
                         st.session_state.db_path = temp_db_path
+                        st.session_state.db_snapshot = True
                         st.session_state.db_connected = True
                         conn.close()
                         st.success(f"Connected to uploaded database: {uploaded_file.name}")
@@ -1305,6 +1777,7 @@ with st.sidebar:
                     if conn:
                         st.session_state.db_type = "sqlite"
                         st.session_state.db_path = db_path_input
+                        st.session_state.db_snapshot = False
                         st.session_state.db_connected = True
                         conn.close()
                         st.success(f"Connected to database: {db_path_input}")
@@ -1342,7 +1815,15 @@ with st.sidebar:
                 for attr in ['db_host', 'db_port', 'db_name', 'db_user', 'db_password']:
                     if attr in st.session_state:
                         del st.session_state[attr]
+            invalidate_schema_cache(st.session_state.schema_info)
+            get_speculative_warmer().cancel(st.session_state.session_id)
+            if st.session_state.db_type == "sqlite" and st.session_state.get('db_snapshot'):
+                # Nobody else uses an uploaded copy, so release its pooled connections and cached results
+                get_result_cache().invalidate(get_connection_fingerprint())
+                close_sqlite_pool(st.session_state.db_path)
             st.session_state.schema_info = {}
+            st.session_state.schema_indexes = None
+            st.session_state.result_pager = None
             st.session_state.schema_text = ""
             st.success("Database disconnected")
     
@@ -1361,6 +1842,166 @@ with st.sidebar:
         st.markdown("### Database Schema")
         st.markdown(f'<div class="schema-viewer">{st.session_state.schema_text}</div>', unsafe_allow_html=True)
 
+    # Performance statistics; everything but the database pool is process-wide and shared by all sessions
+    with st.expander("📈 Performance Stats", expanded=False):
+        conn_stats = get_openai_connection_stats()
+        st.markdown("**OpenAI connections**")
+        st.caption(
+            f"{conn_stats['requests']} requests · {conn_stats['reused_connections']} reused · "
+            f"{conn_stats['new_connections']} new · reuse ratio {conn_stats['reuse_ratio']:.0%} · "
+            f"{conn_stats['clients']} shared client(s)"
+        )
+        
+        st.markdown("**Database connection pool**")
+        pool = None
+        if st.session_state.db_connected and st.session_state.db_type in ("mysql", "postgresql"):
+            # Only this session's database; other sessions' hosts and users must not show up here
+            connection_args = tuple(st.session_state.get(attr) for attr in ['db_host', 'db_port', 'db_name', 'db_user', 'db_password'])
+            pool = get_pool_stats(get_connection_string(st.session_state.db_type, *connection_args))
+        if pool:
+            st.caption(
+                f"{pool['url']}: {pool['checkouts']} checkouts · {pool['connects']} connections opened · "
+                f"reuse ratio {pool['reuse_ratio']:.0%} · {pool['checked_out']} in use of {pool['pool_size']} "
+                f"(+{pool['overflow']} overflow) · {pool['invalidated']} invalidated"
+            )
+        else:
+            st.caption("No pooled MySQL or PostgreSQL connections for this session")
+        
+        st.markdown("**SQLite connection pools**")
+        sqlite_pool_stats = get_sqlite_pool_stats()
+        if sqlite_pool_stats:
+            for pool in sqlite_pool_stats:
+                st.caption(
+                    f"{os.path.basename(pool['db_path'])}{' (snapshot)' if pool['immutable'] else ''}: "
+                    f"{pool['checkouts']} checkouts · {pool['connects']} connections opened · "
+                    f"reuse ratio {pool['reuse_ratio']:.0%} · {pool['in_use']} in use, {pool['idle']} idle"
+                )
+        else:
+            st.caption("No SQLite connections yet")
+        
+        result_cache_stats = get_result_cache().stats()
+        st.markdown("**Query result cache**")
+        st.caption(
+            f"{result_cache_stats['entries']} results · {result_cache_stats['bytes'] / (1024 * 1024):.1f}/"
+            f"{result_cache_stats['max_bytes'] / (1024 * 1024):.0f} MB ({result_cache_stats['policy'].upper()}) · "
+            f"{result_cache_stats['hits']} hits · {result_cache_stats['misses']} misses "
+            f"({result_cache_stats['hit_rate']:.0%} hit rate) · {result_cache_stats['evictions']} evictions · "
+            f"{result_cache_stats['expirations']} expired · {result_cache_stats['rejections']} too large to cache"
+        )
+        
+        resilience_stats = get_resilience_stats()
+        limiter_stats = resilience_stats['limiter']
+        breaker_stats = resilience_stats['breaker']
+        retry_stats = resilience_stats['retries']
+        st.markdown("**OpenAI rate limiter**")
+        quota_parts = []
+        if limiter_stats['requests_capacity'] is not None:
+            quota_parts.append(f"{max(0, limiter_stats['requests_available']):.0f}/{limiter_stats['requests_capacity']:.0f} requests")
+        if limiter_stats['tokens_capacity'] is not None:
+            quota_parts.append(f"{max(0, limiter_stats['tokens_available']):.0f}/{limiter_stats['tokens_capacity']:.0f} tokens")
+        quota_parts.append(f"{limiter_stats['waits']} waits ({limiter_stats['total_wait_time']:.1f}s)")
+        quota_parts.append(f"{limiter_stats['rejections']} rejected")
+        if limiter_stats['paused_for'] > 0:
+            quota_parts.append(f"paused {limiter_stats['paused_for']:.0f}s by Retry-After")
+        st.caption(" · ".join(quota_parts))
+        
+        breaker_label = {"closed": "🟢 closed", "half_open": "🟡 half-open", "open": "🔴 open"}[breaker_stats['state']]
+        breaker_caption = (
+            f"Circuit breaker {breaker_label} · {breaker_stats['consecutive_failures']} consecutive failures · "
+            f"opened {breaker_stats['times_opened']}x · {breaker_stats['rejected_calls']} calls failed fast"
+        )
+        if breaker_stats['state'] == "open":
+            breaker_caption += f" · retrying in {breaker_stats['retry_in']:.0f}s"
+        st.caption(breaker_caption)
+        st.caption(
+            f"{retry_stats['retries']} retries · {retry_stats['retry_after_honored']} honored Retry-After · "
+            f"{retry_stats['gave_up']} gave up"
+        )
+        
+        coalescing_stats = get_coalescing_stats()
+        st.caption(
+            f"{coalescing_stats['coalesced_calls']} calls shared an identical in-flight request "
+            f"({coalescing_stats['coalesced_ratio']:.0%}) · {coalescing_stats['in_flight']} in flight now"
+        )
+        
+        tail_stats = get_tail_latency_stats()
+        st.markdown("**Deadlines and hedging**")
+        st.caption(
+            f"{tail_stats['deadlines_exceeded']} deadlines exceeded · {tail_stats['hedges_fired']}/"
+            f"{tail_stats['hedge_eligible_calls']} calls hedged ({tail_stats['fire_rate']:.0%}) · "
+            f"{tail_stats['hedge_wins']} hedge wins · avg {tail_stats['avg_time_saved']:.2f}s saved · "
+            f"{tail_stats['hedge_extra_tokens']} extra tokens"
+        )
+        
+        generation_cache = get_generation_cache()
+        if generation_cache is not None:
+            cache_stats = generation_cache.stats()
+            st.markdown("**SQL generation cache**")
+            st.caption(
+                f"{cache_stats['entries']}/{cache_stats['max_entries']} entries · {cache_stats['hits']} hits · "
+                f"{cache_stats['misses']} misses · {cache_stats['evictions']} evictions"
+            )
+        
+        fast_path_stats = get_fast_path_stats()
+        st.markdown("**Rule-based fast path**")
+        st.caption(
+            f"{fast_path_stats['hits']}/{fast_path_stats['attempts']} questions answered without the AI "
+            f"({fast_path_stats['hit_rate']:.0%}) · avg match {fast_path_stats['avg_match_ms']:.2f} ms"
+        )
+        
+        improvement_stats = get_question_improvement_stats()
+        st.markdown("**Question suggestions**")
+        st.caption(
+            f"{improvement_stats['requested']} requested · {improvement_stats['skipped']} skipped as precise or on demand · "
+            f"{improvement_stats['fetched_on_demand']} fetched later · {improvement_stats['calls_avoided']} LLM calls avoided"
+        )
+        
+        annotation_stats = get_annotation_cache_stats()
+        st.caption(
+            f"Explanation cache {annotation_stats['explanation']['hits']} hits / {annotation_stats['explanation']['misses']} misses · "
+            f"follow-up cache {annotation_stats['followups']['hits']} hits / {annotation_stats['followups']['misses']} misses"
+        )
+        
+        warmup_stats = get_speculative_warmer().get_stats()
+        st.markdown("**Follow-up warm-up**")
+        st.caption(
+            f"{warmup_stats['generated']}/{warmup_stats['submitted']} follow-ups warmed ({warmup_stats['llm_generations']} LLM calls) · "
+            f"{warmup_stats['executed']} run in advance · {warmup_stats['not_executed']} not run (unsafe or costly) · "
+            f"{warmup_stats['used']} used · {warmup_stats['cancelled']} cancelled · "
+            f"{warmup_stats['skipped_for_budget']} skipped for budget · {warmup_stats['failed']} failed"
+        )
+        
+        repair_stats = get_sql_repair_stats()
+        st.markdown("**SQL validation and repair**")
+        repair_caption = (
+            f"{repair_stats['invalid']}/{repair_stats['validated']} generated queries invalid · "
+            f"{repair_stats['repaired']} repaired ({repair_stats['repair_success_rate']:.0%}) · "
+            f"avg check {repair_stats['avg_validation_time'] * 1000:.1f} ms · avg repair {repair_stats['avg_repair_time']:.2f}s"
+        )
+        if repair_stats['p50_generation_time'] is not None:
+            repair_caption += f" vs {repair_stats['p50_generation_time']:.2f}s for a fresh generation"
+        st.caption(repair_caption)
+        
+        pruning_stats = get_schema_pruning_stats()
+        st.markdown("**Schema pruning**")
+        st.caption(
+            f"{pruning_stats['pruned_prompts']}/{pruning_stats['prompts']} prompts pruned · "
+            f"~{pruning_stats['tokens_saved']} of {pruning_stats['full_tokens']} schema tokens saved"
+        )
+        
+        latency_stats = get_latency_stats()
+        if latency_stats:
+            st.markdown("**LLM latency (recent calls)**")
+            latency_df = pd.DataFrame.from_dict(latency_stats, orient='index')
+            st.dataframe(latency_df.round(2), use_container_width=True)
+        
+        mode_stats = get_generation_mode_stats()
+        if mode_stats:
+            st.markdown("**Generation modes (per question)**")
+            mode_df = pd.DataFrame.from_dict(mode_stats, orient='index')
+            mode_df['avg_wall_time'] = mode_df['avg_wall_time'].apply(lambda x: f"{x:.2f}s")
+            st.dataframe(mode_df.round(1), use_container_width=True)
+
 # Main application UI
 st.title("🤖 Ask Your Data – Natural Language to SQL")
 
@@ -1435,6 +2076,15 @@ with col2:
         key="generate_run_button"
     )
 
+# The suggestion call was skipped for this question; offer it on demand
+if user_input and st.session_state.get('suggestion_skipped_for') == user_input:
+    st.button(
+        "💡 Suggest a clearer question",
+        key="suggest_question_btn",
+        on_click=request_question_suggestion,
+        help="Ask the AI for a more precise wording of your question"
+    )
+
 # Question improvement suggestion (if available)
 if st.session_state.improved_question and st.session_state.improved_question != user_input:
     st.markdown(f"""<div class="improved-question">
@@ -1447,7 +2097,29 @@ if st.session_state.improved_question and st.session_state.improved_question !=
         st.session_state.user_input = st.session_state.improved_question
         st.experimental_rerun()
 
+# A fresh generation requested from a reused similar-question or fast path answer re-runs the question
+fresh_generation = st.session_state.pop('force_fresh_generation', False)
+# Confirming an expensive plan runs the confirmed SQL again without a new generation
+confirmed_execution = st.session_state.pop('force_confirmed_execution', False)
+run = run or fresh_generation or confirmed_execution
+
+if st.session_state.pop('query_cancelled', False):
+    st.info("⏹️ The running query was cancelled.")
+
+# Explanation requested on demand for the current SQL
+if not run and st.session_state.current_explanation and st.session_state.get('explained_sql') == st.session_state.current_sql:
+    render_explanation(st.session_state.current_explanation)
+
 if run:
+    # A new run replaces the result being browsed
+    st.session_state.result_pager = None
+    
+    # The user moved on, so stop warming the previous question's follow-ups
+    warmer = get_speculative_warmer()
+    if user_input and warmer.was_warmed(st.session_state.session_id, user_input):
+        print(f"Follow-up question was warmed up in advance: '{user_input}'")
+    warmer.cancel(st.session_state.session_id)
+    
     if not user_input:
         st.warning("⚠️ Please enter a question first")
     elif not st.session_state.api_key:
@@ -1464,127 +2136,147 @@ if run:
                 with st.spinner("🔄 Reading database schema..."):
                     update_schema()
             
-            # Generate question improvement suggestion
-            with st.spinner("🔄 Analyzing your question..."):
-                improved_question = suggest_question_improvements(
-                    user_input, 
-                    st.session_state.schema_info,
-                    api_key=st.session_state.api_key
-                )
-                if improved_question and improved_question != user_input:
-                    st.session_state.improved_question = improved_question
+            # Placeholders are filled in as each concurrent LLM call finishes
+            improvement_placeholder = st.empty()
+            sql_placeholder = st.empty()
+            explanation_placeholder = st.empty()
             
             with st.spinner("💡 Generating SQL using AI..."):
                 try:
-                    # Generate SQL query using GPT
-                    generated_sql = gpt_generate_sql(
-                        user_input, 
-                        st.session_state.schema_info,
-                        api_key=st.session_state.api_key
-                    )
-                    st.session_state.current_sql = generated_sql
-                    
-                    # SQL editing option
-                    st.markdown("### 🧾 Generated SQL")
-                    st.markdown('<span class="ai-badge">AI Generated</span> You can edit this SQL before execution:', unsafe_allow_html=True)
-                    
-                    # Allow user to edit the SQL
-                    edited_sql = st.text_area("Edit SQL Query:", value=generated_sql, height=150, key="sql_editor")
-                    
-                    # Check if SQL was edited
-                    sql_to_execute = edited_sql
-                    st.session_state.sql_edited = (edited_sql != generated_sql)
+                    sql_to_execute = ""
+                    if confirmed_execution and st.session_state.current_sql:
+                        pipeline = replay_current_sql()
+                    else:
+                        pipeline = iter_question_pipeline(
+                            user_input, 
+                            st.session_state.schema_info,
+                            api_key=st.session_state.api_key,
+                            mode=llm_mode,
+                            use_cache=use_cache,
+                            allow_similar=not fresh_generation,
+                            stream=stream_output,
+                            allow_fast_path=not fresh_generation,
+                            improve_question=improve_question_mode,
+                            explain=explain_mode,
+                            validate=make_sql_validator(),
+                            dialect=SQLGLOT_DIALECTS.get(st.session_state.db_type, "sqlite")
+                        )
+                    streamed_sql = ""
+                    streamed_explanation = ""
                     
-                    # Display SQL explanation in plain English
-                    with st.spinner("🔄 Generating explanation..."):
-                        try:
-                            explanation = explain_query(
-                                sql_to_execute, 
-                                st.session_state.schema_info,
-                                api_key=st.session_state.api_key
-                            )
-                            st.session_state.current_explanation = explanation
-                            
-                            # Clean the explanation - remove any unwanted HTML tags and content
-                            explanation = explanation.replace("</div>", "")
-                            # Remove any HTML tags using a more thorough approach
-                            explanation = re.sub(r'<[^>]*>', '', explanation)
-                            # Also remove any HTML entities that might cause issues
-                            explanation = explanation.replace("&lt;", "<").replace("&gt;", ">").replace("&amp;", "&")
-                            
-                            # Convert explanation text to bullet points using a simplified approach
-                            # to avoid HTML nesting issues
-                            st.markdown("### 📖 Query Explanation")
-                            
-                            # Create a custom container for the explanation using st.container
-                            explanation_container = st.container()
+                    for event, value in pipeline:
+                        if event == "question_precision":
+                            st.session_state.suggestion_skipped_for = user_input if value['suggestion_skipped'] else None
+                            if value['suggestion_skipped']:
+                                st.session_state.improved_question = ""
+                        
+                        elif event == "improved_question":
+                            if value and value != user_input:
+                                st.session_state.improved_question = value
+                                improvement_placeholder.markdown(f"""<div class="improved-question">
+                                    <span class="ai-badge">AI Suggestion</span>
+                                    Try this improved question: "{value}"
+                                    </div>""", unsafe_allow_html=True)
+                        
+                        elif event == "sql_delta":
+                            streamed_sql += value
+                            sql_placeholder.code(streamed_sql, language="sql")
+                        
+                        elif event == "explanation_delta":
+                            streamed_explanation += value
+                            explanation_placeholder.markdown(streamed_explanation)
+                        
+                        elif event == "generation":
+                            st.session_state.last_generation = value
+                        
+                        elif event == "sql":
+                            generated_sql = value
+                            st.session_state.current_sql = generated_sql
                             
-                            with explanation_container:
-                                # Add a custom styled container without nested HTML
-                                st.markdown("""
-                                <div class="explanation-box">
-                                    <span class="ai-badge">SQL Explained</span>
-                                </div>
-                                """, unsafe_allow_html=True)
-                                
-                                # Process and display each bullet point separately
-                                explanation_lines = [line.strip() for line in explanation.split("\n") if line.strip()]
+                            with sql_placeholder.container():
+                                # SQL editing option
+                                st.markdown("### 🧾 Generated SQL")
+                                if st.session_state.last_generation.get('source') == "cache":
+                                    st.markdown(f"""<div class="cache-indicator">
+                                        <span>⚡ SQL loaded from generation cache</span>
+                                        <span>({st.session_state.last_generation['generation_time'] * 1000:.0f} ms)</span>
+                                    </div>""", unsafe_allow_html=True)
+                                elif st.session_state.last_generation.get('source') == "fast_path":
+                                    st.markdown(f"""<div class="cache-indicator">
+                                        <span>🏎️ Simple {st.session_state.last_generation['intent'].replace('_', ' ')} question answered without the AI</span>
+                                        <span>({st.session_state.last_generation['generation_time'] * 1000:.1f} ms)</span>
+                                    </div>""", unsafe_allow_html=True)
+                                    st.button(
+                                        "🔄 Generate fresh SQL instead",
+                                        key="fresh_generation_btn",
+                                        on_click=request_fresh_generation,
+                                        help="Ask the AI for SQL instead of using the rule-based answer"
+                                    )
+                                elif st.session_state.last_generation.get('source') == "similar":
+                                    st.markdown(f"""<div class="cache-indicator">
+                                        <span>♻️ Reused SQL from a similar question: "{st.session_state.last_generation['matched_question']}"</span>
+                                        <span>(similarity {st.session_state.last_generation['similarity']:.0%})</span>
+                                    </div>""", unsafe_allow_html=True)
+                                    st.button(
+                                        "🔄 Generate fresh SQL instead",
+                                        key="fresh_generation_btn",
+                                        on_click=request_fresh_generation,
+                                        help="Ask the AI for new SQL instead of reusing the answer to a similar question"
+                                    )
+                                if st.session_state.last_generation.get('repair_attempts'):
+                                    if st.session_state.last_generation.get('valid'):
+                                        st.markdown(f"""<div class="cache-indicator">
+                                            <span>🩹 SQL fixed automatically after a validation error</span>
+                                            <span>({st.session_state.last_generation['repair_attempts']} attempt(s), {st.session_state.last_generation['repair_time']:.2f}s)</span>
+                                        </div>""", unsafe_allow_html=True)
+                                        st.caption(f"Original error: {st.session_state.last_generation['validation_error']}")
+                                if st.session_state.last_generation.get('valid') is False:
+                                    st.warning(f"⚠️ This SQL still fails validation: {st.session_state.last_generation['validation_error']}")
+                                st.markdown('<span class="ai-badge">AI Generated</span> You can edit this SQL before execution:', unsafe_allow_html=True)
                                 
-                                # Check if we have any explanation lines
-                                if not explanation_lines:
-                                    st.markdown("""
-                                    <div class="explanation-bullet">
-                                        <span class="bullet-point">•</span>
-                                        <span class="bullet-text">This query retrieves data from the database based on your request.</span>
-                                    </div>
-                                    """, unsafe_allow_html=True)
-                                else:
-                                    for i, line in enumerate(explanation_lines):
-                                        # Remove existing bullet points or numbers if present
-                                        if line.startswith(('•', '-', '*', '1.', '2.', '3.', '4.', '5.', '6.', '7.', '8.', '9.')):
-                                            # Extract the content after the bullet point or number
-                                            parts = line.split(' ', 1)
-                                            if len(parts) > 1:
-                                                line = parts[1].strip()
-                                        
-                                        # Only add non-empty lines that don't start with HTML tags
-                                        if line and not line.strip().startswith("<"):
-                                            st.markdown(f"""
-                                            <div class="explanation-bullet">
-                                                <span class="bullet-point">•</span>
-                                                <span class="bullet-text">{line}</span>
-                                            </div>
-                                            """, unsafe_allow_html=True)
-                        except Exception as e:
-                            # Log the error
-                            print(f"Error generating explanation: {str(e)}")
-                            
-                            # Display a fallback explanation
-                            st.markdown("### 📖 Query Explanation")
+                                # Allow user to edit the SQL
+                                edited_sql = st.text_area("Edit SQL Query:", value=generated_sql, height=150, key="sql_editor")
                             
-                            explanation_container = st.container()
+                            # Check if SQL was edited
+                            sql_to_execute = edited_sql
+                            st.session_state.sql_edited = (edited_sql != generated_sql)
+                            if explain_mode == "on_demand" and llm_mode == "separate":
+                                explanation_placeholder.button(
+                                    "📖 Explain this query",
+                                    key="explain_query_btn",
+                                    on_click=request_explanation,
+                                    help="Ask the AI for a plain English explanation of the generated SQL"
+                                )
+                            else:
+                                explanation_placeholder.info("🔄 Generating explanation...")
+                        
+                        elif event == "explanation":
+                            st.session_state.current_explanation = value
                             
-                            with explanation_container:
-                                st.markdown("""
-                                <div class="explanation-box">
-                                    <span class="ai-badge">SQL Explained</span>
-                                </div>
-                                """, unsafe_allow_html=True)
-                                
-                                st.markdown("""
-                                <div class="explanation-bullet">
-                                    <span class="bullet-point">•</span>
-                                    <span class="bullet-text">This SQL query will retrieve data from your database based on your request.</span>
-                                </div>
-                                """, unsafe_allow_html=True)
-                                
-                                # Show actual SQL for reference since we don't have an explanation
-                                st.markdown(f"""
-                                <div class="explanation-bullet">
-                                    <span class="bullet-point">•</span>
-                                    <span class="bullet-text">The generated SQL will be executed to get your results.</span>
-                                </div>
-                                """, unsafe_allow_html=True)
+                            # Display SQL explanation in plain English
+                            with explanation_placeholder.container():
+                                render_explanation(value)
+                        
+                        elif event == "followups":
+                            st.session_state.follow_up_questions = value
+                            if warm_followups and value:
+                                get_speculative_warmer().warm(
+                                    st.session_state.session_id,
+                                    value,
+                                    st.session_state.schema_info,
+                                    api_key=st.session_state.api_key,
+                                    execute=make_speculative_executor(cost_threshold) if run_warm_followups and use_cache else None,
+                                    dialect=SQLGLOT_DIALECTS.get(st.session_state.db_type, "sqlite")
+                                )
+                        
+                        elif event == "metrics":
+                            st.session_state.last_generation_metrics = value
+                            st.caption(
+                                f"🧮 {value['mode'].replace('_', ' ')} mode · {value['llm_calls']} LLM call(s) · "
+                                f"{value['coalesced_calls']} shared · "
+                                f"{value['prompt_tokens'] + value['completion_tokens']} tokens · "
+                                f"~{value['schema_tokens_saved']} schema tokens saved by pruning · {value['wall_time']:.2f}s"
+                            )
                     
                     # Execute button for the possibly edited SQL
                     col1, col2 = st.columns([4, 1])
@@ -1598,12 +2290,43 @@ if run:
                             else:
                                 st.info("Already in favorites")
                     
+                    # Governor limits for this execution, defaulting to the deployment settings
+                    with st.expander("⏱️ Execution limits", expanded=False):
+                        limit_col1, limit_col2, limit_col3 = st.columns(3)
+                        with limit_col1:
+                            query_timeout = st.number_input("Time limit (s)", min_value=0.0, value=QUERY_TIMEOUT, step=5.0, key="query_timeout_input", help="0 for no limit")
+                        with limit_col2:
+                            query_max_rows = st.number_input("Row limit", min_value=0, value=QUERY_MAX_ROWS, step=10000, key="query_max_rows_input", help="0 for no limit")
+                        with limit_col3:
+                            query_max_mb = st.number_input("Result size limit (MB)", min_value=0.0, value=QUERY_MAX_RESULT_MB, step=50.0, key="query_max_mb_input", help="0 for no limit")
+                    
+                    # The plan is read once and used for both the analysis panel and the cost check
+                    query_plan = get_query_plan(sql_to_execute)
+                    
                     # SQL Analysis for optimization
                     with st.expander("🔍 Query Analysis & Optimization", expanded=False):
+                        st.markdown("#### Execution Plan:")
+                        if query_plan['error']:
+                            st.caption(f"The execution plan is not available: {query_plan['error']}")
+                        else:
+                            if query_plan['estimated_cost'] is not None:
+                                st.caption(
+                                    f"Estimated cost {query_plan['estimated_cost']:,.1f} {query_plan['cost_unit']}"
+                                    + (f" · ~{query_plan['estimated_rows']:,} rows" if query_plan['estimated_rows'] is not None else "")
+                                    + f" · {len(query_plan['full_scans'])} full scan(s) · {len(query_plan['temp_structures'])} temporary structure(s)"
+                                )
+                            render_plan_nodes(query_plan['nodes'])
+                        
                         st.markdown('<span class="ai-badge">AI Analysis</span> Suggestions to improve your query:', unsafe_allow_html=True)
                         
                         try:
-                            analysis_result = analyze_query(sql_to_execute, st.session_state.schema_info, api_key=st.session_state.api_key)
+                            analysis_result = analyze_query(
+                                sql_to_execute,
+                                st.session_state.schema_info,
+                                api_key=st.session_state.api_key,
+                                indexes=get_index_metadata(),
+                                dialect=SQLGLOT_DIALECTS.get(st.session_state.db_type, "sqlite")
+                            )
                             
                             # Display query complexity
                             complexity_colors = {
@@ -1644,6 +2367,11 @@ if run:
                                             st.code(suggestion['example'], language="sql")
                             else:
                                 st.markdown("✅ No optimization suggestions for this query.")
+                            
+                            # All missing indexes as one script
+                            if analysis_result.get('index_recommendations'):
+                                st.markdown("#### Recommended Indexes:")
+                                st.code("\n".join(rec['ddl'] for rec in analysis_result['index_recommendations']), language="sql")
                                 
                             # Display warnings if any
                             if analysis_result.get('warnings'):
@@ -1661,11 +2389,101 @@ if run:
                             st.error(f"Error analyzing query: {str(e)}")
                             st.markdown("Unable to provide optimization suggestions at this time.")
                     
-                    if execute_query:
+                    if confirmed_execution and st.session_state.get('confirmed_expensive_sql') == sql_to_execute:
+                        execute_query = True
+                    
+                    # Expensive plans need explicit confirmation unless the result is already cached
+                    result_cached = use_cache and get_result_cache().contains(*get_cache_key(sql_to_execute))
+                    # An unfiltered keyset page is an index seek, whatever the cost of the whole query. A filtered one
+                    # can scan the whole table for every page, so it goes through the cost check like any other query.
+                    pagination = plan_pagination(
+                        sql_to_execute, st.session_state.schema_info, SQLGLOT_DIALECTS.get(st.session_state.db_type, "sqlite")
+                    ) if result_paging == "database" else None
+                    cheap_pages = pagination is not None and pagination['mode'] == "keyset" and not pagination['filtered']
+                    if (execute_query and not result_cached and not cheap_pages
+                            and plan_needs_confirmation(query_plan, cost_threshold)
+                            and st.session_state.get('confirmed_expensive_sql') != sql_to_execute):
+                        execute_query = False
+                        if query_plan['estimated_cost'] is None:
+                            st.warning(
+                                "⚠️ This query's execution plan could not be read"
+                                + (f" ({query_plan['error']})" if query_plan['error'] else "")
+                                + ", so its cost is unknown. Check the query before running it."
+                            )
+                        else:
+                            st.warning(
+                                f"⚠️ This query's estimated cost ({query_plan['estimated_cost']:,.0f} {query_plan['cost_unit']}) "
+                                f"is above the limit of {cost_threshold:,.0f}"
+                                + (f" and it fully scans {', '.join(query_plan['full_scans'])}" if query_plan['full_scans'] else "")
+                                + ". Check the execution plan under Query Analysis before running it."
+                            )
+                        st.button(
+                            "⚠️ Run anyway",
+                            key="confirm_expensive_query_btn",
+                            on_click=confirm_expensive_query,
+                            args=(sql_to_execute,),
+                            help="Execute this query despite its estimated or unknown cost"
+                        )
+                    
+                    # Offset pages re-run the query, so without an ORDER BY they could overlap or skip rows
+                    page_in_database = result_paging == "database" and pagination['ordered']
+                    if execute_query and result_paging == "database" and not page_in_database:
+                        st.info("ℹ️ This query has no ORDER BY, so its pages could overlap or skip rows. "
+                                "It is loaded and paged in memory instead.")
+                    page_in_memory = execute_query and not page_in_database
+                    if execute_query and page_in_database:
+                        generation_info = {} if st.session_state.sql_edited else st.session_state.last_generation
+                        pager = ResultPager(
+                            sql_to_execute,
+                            st.session_state.db_type,
+                            make_connection_factory(),
+                            st.session_state.schema_info,
+                            page_size=st.session_state.rows_per_page,
+                            dialect=SQLGLOT_DIALECTS.get(st.session_state.db_type, "sqlite"),
+                            timeout=query_timeout
+                        )
+                        try:
+                            with st.spinner("⚙️ Reading the first page..."):
+                                first_page = pager.page()
+                            st.session_state.result_pager = pager
+                            st.session_state.query_history.append({
+                                'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+                                'user_question': user_input,
+                                'query': sql_to_execute,
+                                'execution_time': first_page['read_time'],
+                                'rows_returned': len(first_page['data']),
+                                # Pages are read on demand, so no row cap applies; only the first page is counted
+                                'truncated': False,
+                                'paged': True,
+                                'from_cache': False,
+                                **history_generation_fields(generation_info)
+                            })
+                        except Exception as e:
+                            if pager.mode == "offset" and not isinstance(e, (QueryTimeoutError, QueryCancelledError)):
+                                # Offset pages wrap the query in a derived table, which can fail where the query
+                                # itself runs: MySQL rejects the duplicate column names of SELECT * over a join.
+                                # Reading the result into memory also reports any error of the query itself.
+                                print(f"Paging in the database failed, paging in memory instead: {str(e)}")
+                                st.info("ℹ️ This result cannot be paged in the database, so it is loaded and paged in memory.")
+                                page_in_memory = True
+                            else:
+                                st.error("❌ SQL Execution Error")
+                                with st.expander("See error details"):
+                                    st.markdown(f'<div class="error-box">{str(e)}</div>', unsafe_allow_html=True)
+                    
+                    if page_in_memory:
                         try:
                             # Execute the SQL query with caching
                             with st.spinner("⚙️ Executing SQL query..."):
-                                df, error, from_cache = execute_sql_query(sql_to_execute, use_cache=use_cache, user_question=user_input)
+                                df, error, from_cache = execute_sql_query(
+                                    sql_to_execute,
+                                    use_cache=use_cache,
+                                    user_question=user_input,
+                                    generation_info=None if st.session_state.sql_edited else st.session_state.last_generation,
+                                    timeout=query_timeout,
+                                    max_rows=int(query_max_rows),
+                                    max_bytes=int(query_max_mb * 1024 * 1024)
+                                )
                             
                             if error:
                                 st.error("❌ SQL Execution Error")
@@ -1676,12 +2494,20 @@ if run:
                                 if from_cache:
                                     st.markdown(f"""<div class="cache-indicator">
                                         <span>⚡ Results loaded from cache</span>
-                                        <span>(Query execution time: {st.session_state.query_cache[get_cache_key(sql_to_execute)]['execution_time']:.2f}s)</span>
+                                        <span>(Query execution time: {st.session_state.cached_execution_time:.2f}s)</span>
                                     </div>""", unsafe_allow_html=True)
                                 
                                 # Display a message about query history
                                 st.success(f"✅ Query executed and added to history. View query history below.")
                                 
+                                last_execution = st.session_state.get('last_execution')
+                                if last_execution:
+                                    st.warning(
+                                        f"✂️ Showing the first {last_execution['rows']:,} rows "
+                                        f"({last_execution['bytes'] / (1024 * 1024):.1f} MB): the result was cut off at the {last_execution['truncated_by']}. "
+                                        "Raise the limits under Execution limits or add a LIMIT or filter to the query."
+                                    )
+                                
                                 st.markdown("### 📊 Query Results")
                                 
                                 # Display results with pagination if more than 10 rows
@@ -1742,7 +2568,8 @@ if run:
                                     
                                     # JSON Export
                                     with col3:
-                                        json_str = df.to_json(orient='records')
+                                        # ISO dates also cover Arrow date columns, which the epoch format cannot write
+                                        json_str = df.to_json(orient='records', date_format='iso')
                                         st.download_button(
                                             label="📋 Download as JSON",
                                             data=json_str,
@@ -1750,15 +2577,8 @@ if run:
                                             mime="application/json",
                                         )
                                 
-                                # Generate follow-up questions after seeing the results
-                                with st.spinner("🔄 Generating follow-up questions..."):
-                                    follow_up_questions = generate_followup_questions(
-                                        user_input,
-                                        sql_to_execute,
-                                        st.session_state.schema_info,
-                                        api_key=st.session_state.api_key
-                                    )
-                                    st.session_state.follow_up_questions = follow_up_questions
+                                # Follow-up questions were generated alongside the explanation
+                                follow_up_questions = st.session_state.follow_up_questions
                                 
                                 if follow_up_questions:
                                     st.markdown("### 🔍 Follow-up Questions")
@@ -1782,6 +2602,10 @@ if run:
                         st.markdown(f'<div class="error-box">{str(e)}</div>', unsafe_allow_html=True)
                         st.code(traceback.format_exc(), language="python")
 
+# A result paged in the database stays browsable across reruns
+if st.session_state.get('result_pager') is not None:
+    display_database_pages(st.session_state.result_pager)
+
 # Display Query History Report Section if there are queries in history
 if 'query_history' in st.session_state and len(st.session_state.query_history) > 0:
     # Display query history section
@@ -1802,6 +2626,19 @@ if 'query_history' in st.session_state and len(st.session_state.query_history) >
     # Create a DataFrame from the query history
     history_df = pd.DataFrame(st.session_state.query_history)
     
+    # Fast path hit rate and generation latency compared with the AI-generated queries
+    if 'sql_source' in history_df.columns:
+        generated_df = history_df[history_df['sql_source'] != 'manual']
+        if not generated_df.empty:
+            fast_df = generated_df[generated_df['sql_source'] == 'fast_path']
+            llm_df = generated_df[generated_df['sql_source'] == 'llm']
+            fast_path_summary = f"🏎️ Fast path answered {len(fast_df)} of {len(generated_df)} generated queries ({len(fast_df) / len(generated_df):.0%})"
+            if not fast_df.empty:
+                fast_path_summary += f" · avg {fast_df['generation_time'].mean() * 1000:.1f} ms"
+            if not llm_df.empty:
+                fast_path_summary += f" vs {llm_df['generation_time'].mean():.2f}s for AI generation"
+            st.caption(fast_path_summary)
+    
     # Format the DataFrame for display
     display_df = history_df.copy()
     if not display_df.empty:
@@ -1813,16 +2650,32 @@ if 'query_history' in st.session_state and len(st.session_state.query_history) >
         if 'execution_time' in display_df.columns:
             display_df['execution_time'] = display_df['execution_time'].apply(lambda x: f"{x:.3f}s")
         
+        # Mark row counts of results cut off by the query governor, and of paged results (first page only)
+        if 'truncated' in display_df.columns:
+            display_df['rows_returned'] = display_df.apply(
+                lambda row: f"{row['rows_returned']}+" if row['truncated'] == True
+                else f"{row['rows_returned']} (first page)" if row.get('paged') == True
+                else str(row['rows_returned']), axis=1
+            )
+        
         # Add a cached indicator
         if 'from_cache' in display_df.columns:
             display_df['cached'] = display_df['from_cache'].apply(lambda x: '✅' if x else '❌')
             
+        # Format SQL generation time
+        if 'generation_time' in display_df.columns:
+            display_df['generation_time'] = display_df['generation_time'].apply(
+                lambda x: f"{x * 1000:.1f}ms" if x < 1 else f"{x:.2f}s"
+            )
+        
         # Reorder and rename columns for better display
-        cols_order = ['timestamp', 'user_question', 'query', 'rows_returned', 'execution_time', 'cached']
+        cols_order = ['timestamp', 'user_question', 'query', 'sql_source', 'generation_time', 'rows_returned', 'execution_time', 'cached']
         cols_rename = {
             'user_question': 'Question',
             'timestamp': 'Time',
             'query': 'SQL Query',
+            'sql_source': 'SQL Source',
+            'generation_time': 'Generation',
             'rows_returned': 'Rows',
             'execution_time': 'Duration',
             'cached': 'Cached'
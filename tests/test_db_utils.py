@@ -0,0 +1,36 @@
+from decimal import Decimal
+
+import pytest
+
+import db_utils
+
+SCHEMA = {
+    "orders": [
+        {"name": "id", "type": "INTEGER", "is_primary_key": 1},
+        {"name": "status", "type": "TEXT", "is_primary_key": 0},
+    ]
+}
+
+def test_declared_decimal_keeps_full_precision():
+    pa = pytest.importorskip("pyarrow")
+    pytest.importorskip("sqlglot")
+    schema = {"payments": [{"name": "id", "type": "INTEGER"}, {"name": "amount", "type": "DECIMAL(20,2)"}]}
+    amount = Decimal("12345678901234567.89")
+
+    column_types = db_utils.result_column_types("SELECT id, amount FROM payments", schema)
+    table = db_utils.arrow_table([(1, amount)], ["id", "amount"], column_types)
+
+    assert pa.types.is_decimal(table.column("amount").type)
+    assert table.column("amount").to_pylist() == [amount]
+    assert table.column("id").type == pa.int64()
+
+def test_offset_pages_need_an_order_by():
+    pytest.importorskip("sqlglot")
+
+    unordered = db_utils.plan_pagination("SELECT status, COUNT(*) FROM orders GROUP BY status", SCHEMA)
+    ordered = db_utils.plan_pagination("SELECT status, COUNT(*) FROM orders GROUP BY status ORDER BY status", SCHEMA)
+    keyset = db_utils.plan_pagination("SELECT * FROM orders", SCHEMA)
+
+    assert (unordered["mode"], unordered["ordered"]) == ("offset", False)
+    assert (ordered["mode"], ordered["ordered"]) == ("offset", True)
+    assert (keyset["mode"], keyset["ordered"]) == ("keyset", True)
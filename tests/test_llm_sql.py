@@ -0,0 +1,84 @@
+import pytest
+
+import llm_sql
+
+SCHEMA = "orders(id INTEGER, total REAL)"
+
+@pytest.fixture
+def generation_cache(tmp_path, monkeypatch):
+    """A fresh generation cache and similarity index, with the rule-based fast path off."""
+    cache = llm_sql.PersistentCache(str(tmp_path / "generation_cache.db"))
+    monkeypatch.setattr(llm_sql, "_generation_cache", cache)
+    monkeypatch.setattr(llm_sql, "_similar_indexes", {})
+    monkeypatch.setattr(llm_sql, "FAST_PATH_ENABLED", False)
+    return cache
+
+def fake_generation(monkeypatch, sql_query):
+    """Answer every generation with the given SQL and count the calls."""
+    calls = []
+
+    def generate(user_input, schema_info, api_key=None, on_delta=None):
+        calls.append(user_input)
+        return sql_query
+
+    monkeypatch.setattr(llm_sql, "_gpt_generate_sql_uncached", generate)
+    return calls
+
+def test_unrepaired_sql_is_not_cached(generation_cache, monkeypatch):
+    calls = fake_generation(monkeypatch, "SELECT missing FROM orders")
+    monkeypatch.setattr(llm_sql, "repair_sql", lambda *args, **kwargs: "SELECT still_missing FROM orders")
+
+    def validate(sql_query):
+        return "no such column"
+
+    first = llm_sql._generate_checked_sql("total of all orders", SCHEMA, validate=validate)
+    second = llm_sql._generate_checked_sql("total of all orders", SCHEMA, validate=validate)
+
+    assert not first["valid"]
+    assert second["source"] == "llm"
+    assert len(calls) == 2
+    assert generation_cache.stats()["entries"] == 0
+
+def test_valid_sql_is_cached(generation_cache, monkeypatch):
+    calls = fake_generation(monkeypatch, "SELECT SUM(total) FROM orders")
+
+    def validate(sql_query):
+        return None
+
+    llm_sql._generate_checked_sql("total of all orders", SCHEMA, validate=validate)
+    second = llm_sql._generate_checked_sql("total of all orders", SCHEMA, validate=validate)
+
+    assert second["source"] == "cache"
+    assert second["sql"] == "SELECT SUM(total) FROM orders"
+    assert len(calls) == 1
+
+def test_cached_sql_that_stops_validating_is_evicted(generation_cache, monkeypatch):
+    calls = fake_generation(monkeypatch, "SELECT SUM(total) FROM orders")
+    llm_sql._generate_checked_sql("total of all orders", SCHEMA, validate=lambda sql_query: None)
+    monkeypatch.setattr(llm_sql, "repair_sql", lambda *args, **kwargs: "SELECT still_missing FROM orders")
+
+    def validate(sql_query):
+        return "no such table"
+
+    stale = llm_sql._generate_checked_sql("total of all orders", SCHEMA, validate=validate)
+    fresh = llm_sql._generate_checked_sql("total of all orders", SCHEMA, validate=validate)
+
+    assert stale["source"] == "cache"
+    assert fresh["source"] == "llm"
+    assert len(calls) == 2
+
+def test_fast_path_quotes_identifiers_for_the_dialect():
+    schema = {"order": [{"name": "id", "type": "INTEGER"}, {"name": "status", "type": "TEXT"}]}
+
+    mysql = llm_sql.match_simple_question("how many order", schema, "mysql")
+    sqlite = llm_sql.match_simple_question("how many order", schema, "sqlite")
+
+    assert mysql["sql"] == "SELECT COUNT(*) AS total_count FROM `order`;"
+    assert sqlite["sql"] == 'SELECT COUNT(*) AS total_count FROM "order";'
+
+def test_fast_path_list_returns_every_row():
+    schema = {"customers": [{"name": "id", "type": "INTEGER"}]}
+
+    match = llm_sql.match_simple_question("show me all customers", schema)
+
+    assert match["sql"] == "SELECT * FROM customers;"